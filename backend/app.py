@@ -3,18 +3,33 @@
 Resources
 - https://github.com/tiangolo/fastapi
 """
+from contextlib import asynccontextmanager
+
 import uvicorn
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
+from starlette.responses import JSONResponse
 
 from backend.config import CONFIG, override_schema
 CONFIG['importer'] = 'app.py'
+from backend.db.utils import dispose_async_db_engines, dispose_db_engines
 from backend.routes import cset_crud, db, graph
 
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """Startup: load the relationship graph in the background, so that routes that don't need it (most of them) can be
+    served immediately. Shutdown: close pooled DB connections."""
+    graph.start_loading_rel_graph()
+    yield
+    await dispose_async_db_engines()
+    dispose_db_engines()
+
+
 # users on the same server
 # APP = FastAPI()
-APP = FastAPI(client_max_size=100_000_000) # trying this, but it shouldn't be necessary
+APP = FastAPI(client_max_size=100_000_000, lifespan=lifespan) # trying this, but it shouldn't be necessary
 APP.include_router(cset_crud.router)
 APP.include_router(graph.router)
 APP.include_router(db.router)
@@ -45,6 +60,17 @@ def run(port: int = 8000):
     uvicorn.run(APP, host='0.0.0.0', port=port)
 
 
+@APP.get("/ready")
+def ready():
+    """Readiness check: 200 once the relationship graph is loaded, else 503. The app is alive and serving non-graph
+    routes as soon as it starts; use this to know when graph routes will work too."""
+    status = graph.rel_graph_status()
+    if status['ready']:
+        return status
+    return JSONResponse(
+        status_code=503, content=status, headers={'Retry-After': str(graph.GRAPH_NOT_READY_RETRY_AFTER_SECONDS)})
+
+
 @APP.get("/")
 def read_root():
     """Root route"""
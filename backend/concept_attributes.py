@@ -0,0 +1,174 @@
+"""In-memory column store of the concept attributes that graph requests filter and sort on
+
+One array per attribute, all aligned to `concept_ids` (sorted). Text attributes are dictionary-encoded: the array holds
+a small integer code, and the matching dictionary array holds the strings. Code 0 is always NULL / missing.
+
+It is loaded from `concepts_with_counts` when the graph is built, and saved in the graph snapshot, so hiding
+vocabularies or non-standard concepts is a couple of vectorized lookups instead of a database round trip per request.
+"""
+from typing import Any, Dict, List, Sequence, Set, Tuple, Union
+
+import numpy as np
+
+from backend.csr_graph import INDEX_DTYPE, NODE_ID_DTYPE, Ids, _to_id_array
+
+CODE_DTYPE = np.int16
+STANDARD_CONCEPT_DTYPE = np.uint8  # ASCII code of standard_concept ('S', 'C'), or 0 if NULL
+COUNT_DTYPE = np.int64
+
+
+class ConceptAttributes:
+    """Vocabulary, domain, class, standard_concept and total_cnt for every concept, as parallel arrays"""
+    ARRAY_NAMES = (
+        'concept_ids', 'vocabulary', 'domain', 'concept_class', 'standard_concept', 'total_cnt', 'vocabularies',
+        'domains', 'concept_classes')
+    ARRAY_PREFIX = 'attr_'
+
+    def __init__(
+        self, concept_ids: np.ndarray, vocabulary: np.ndarray, domain: np.ndarray, concept_class: np.ndarray,
+        standard_concept: np.ndarray, total_cnt: np.ndarray, vocabularies: np.ndarray, domains: np.ndarray,
+        concept_classes: np.ndarray
+    ):
+        self.concept_ids = concept_ids
+        self.vocabulary = vocabulary
+        self.domain = domain
+        self.concept_class = concept_class
+        self.standard_concept = standard_concept
+        self.total_cnt = total_cnt
+        self.vocabularies = vocabularies
+        self.domains = domains
+        self.concept_classes = concept_classes
+
+    @classmethod
+    def from_columns(
+        cls, concept_ids: np.ndarray, vocabulary: np.ndarray, domain: np.ndarray, concept_class: np.ndarray,
+        standard_concept: np.ndarray, total_cnt: np.ndarray, vocabularies: Sequence[str], domains: Sequence[str],
+        concept_classes: Sequence[str]
+    ) -> 'ConceptAttributes':
+        """Build from unsorted columns of codes
+
+        :param vocabularies, domains, concept_classes: Dictionaries, where code i means `vocabularies[i - 1]`; 0 is
+         NULL."""
+        order = np.argsort(concept_ids, kind='stable')
+        return cls(
+            _to_id_array(concept_ids)[order],
+            np.asarray(vocabulary, dtype=CODE_DTYPE)[order],
+            np.asarray(domain, dtype=CODE_DTYPE)[order],
+            np.asarray(concept_class, dtype=CODE_DTYPE)[order],
+            np.asarray(standard_concept, dtype=STANDARD_CONCEPT_DTYPE)[order],
+            np.asarray(total_cnt, dtype=COUNT_DTYPE)[order],
+            _dictionary(vocabularies), _dictionary(domains), _dictionary(concept_classes))
+
+    @classmethod
+    def from_records(cls, records: List[Dict[str, Any]]) -> 'ConceptAttributes':
+        """Build from rows with concept_id, vocabulary_id, domain_id, concept_class_id, standard_concept, total_cnt"""
+        columns: Dict[str, Tuple[List[str], np.ndarray]] = {}
+        for key in ('vocabulary_id', 'domain_id', 'concept_class_id'):
+            values = [r.get(key) for r in records]
+            names = sorted({v for v in values if v is not None})
+            code = {name: i + 1 for i, name in enumerate(names)}
+            columns[key] = names, np.array([code.get(v, 0) for v in values], dtype=CODE_DTYPE)
+        return cls.from_columns(
+            np.array([r['concept_id'] for r in records], dtype=NODE_ID_DTYPE),
+            columns['vocabulary_id'][1], columns['domain_id'][1], columns['concept_class_id'][1],
+            np.array([ord(r['standard_concept']) if r.get('standard_concept') else 0 for r in records]),
+            np.array([r.get('total_cnt') or 0 for r in records]),
+            columns['vocabulary_id'][0], columns['domain_id'][0], columns['concept_class_id'][0])
+
+    def __len__(self) -> int:
+        return len(self.concept_ids)
+
+    def index_of(self, concept_ids: Ids) -> Tuple[np.ndarray, np.ndarray]:
+        """Row indexes for concept ids
+
+        :returns (idxs, found): `idxs` for the ids that are in the table, and a boolean mask over the input saying which
+        ids were found."""
+        ids = _to_id_array(concept_ids)
+        n = len(self.concept_ids)
+        if not n:
+            return np.empty(0, dtype=INDEX_DTYPE), np.zeros(len(ids), dtype=bool)
+        pos = np.minimum(np.searchsorted(self.concept_ids, ids), n - 1)
+        found = self.concept_ids[pos] == ids
+        return pos[found].astype(INDEX_DTYPE, copy=False), found
+
+    def vocabulary_code(self, vocabulary_id: str) -> int:
+        """Code for a vocabulary id, or -1 if no concept has it"""
+        return _code(self.vocabularies, vocabulary_id)
+
+    def filter(
+        self, concept_ids: Ids, hide_vocabs: List[str], hide_nonstandard_concepts=False
+    ) -> Tuple[np.ndarray, Dict[str, Set[int]], Set[int]]:
+        """Vectorized equivalent of graph.filter_concepts(), for concept ids rather than concept rows
+
+        Concepts that aren't in the table are never hidden.
+        :returns (kept, hidden_by_voc, nonstandard_concepts_hidden): kept is the ids in `concept_ids` that aren't
+         hidden."""
+        ids = np.unique(_to_id_array(concept_ids))
+        idxs, found = self.index_of(ids)
+        known = ids[found]
+        hidden = np.zeros(len(ids), dtype=bool)
+        hidden_by_voc: Dict[str, Set[int]] = {}
+        vocabulary = self.vocabulary[idxs]
+        for vocab in hide_vocabs:
+            is_vocab = vocabulary == self.vocabulary_code(vocab)
+            if is_vocab.any():
+                hidden_by_voc[vocab] = set(known[is_vocab].tolist())
+                hidden[np.flatnonzero(found)[is_vocab]] = True
+        nonstandard_concepts_hidden: Set[int] = set()
+        if hide_nonstandard_concepts:
+            is_nonstandard = self.standard_concept[idxs] != ord('S')
+            nonstandard_concepts_hidden = set(known[is_nonstandard].tolist())
+            hidden[np.flatnonzero(found)[is_nonstandard]] = True
+        return ids[~hidden], hidden_by_voc, nonstandard_concepts_hidden
+
+    def records(self, concept_ids: Ids) -> List[Dict[str, Any]]:
+        """Decoded attributes for the concept ids that are in the table, like rows from `concepts_with_counts`"""
+        idxs, _ = self.index_of(concept_ids)
+        return [
+            {
+                'concept_id': concept_id,
+                'vocabulary_id': _decode(self.vocabularies, vocab),
+                'domain_id': _decode(self.domains, domain),
+                'concept_class_id': _decode(self.concept_classes, concept_class),
+                'standard_concept': chr(standard) if standard else None,
+                'total_cnt': total_cnt,
+            }
+            for concept_id, vocab, domain, concept_class, standard, total_cnt in zip(
+                self.concept_ids[idxs].tolist(), self.vocabulary[idxs].tolist(), self.domain[idxs].tolist(),
+                self.concept_class[idxs].tolist(), self.standard_concept[idxs].tolist(),
+                self.total_cnt[idxs].tolist())]
+
+    def nbytes(self) -> int:
+        """Memory used by the arrays"""
+        return sum(a.nbytes for a in self.arrays().values())
+
+    # Serialization ----------------------------------------------------------------------------------------------------
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Arrays by their name in the graph snapshot"""
+        return {self.ARRAY_PREFIX + name: getattr(self, name) for name in self.ARRAY_NAMES}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> Union['ConceptAttributes', None]:
+        """Inverse of arrays(). None if the arrays aren't there, e.g. in a snapshot from before this table existed."""
+        if not all(cls.ARRAY_PREFIX + name in arrays for name in cls.ARRAY_NAMES):
+            return None
+        return cls(*[arrays[cls.ARRAY_PREFIX + name] for name in cls.ARRAY_NAMES])
+
+    def __repr__(self):
+        return f'ConceptAttributes(concepts={len(self)}, vocabularies={len(self.vocabularies) - 1})'
+
+
+def _dictionary(names: Sequence[str]) -> np.ndarray:
+    """Dictionary array for codes: index 0 is the empty string, for NULL"""
+    return np.array([''] + list(names), dtype=str)
+
+
+def _code(dictionary: np.ndarray, name: str) -> int:
+    """Code of `name` in a dictionary, or -1"""
+    matches = np.flatnonzero(dictionary[1:] == name)
+    return int(matches[0]) + 1 if len(matches) else -1
+
+
+def _decode(dictionary: np.ndarray, code: int):
+    """Inverse of _code(). None for code 0."""
+    return str(dictionary[code]) if code else None
@@ -0,0 +1,113 @@
+"""Concept set expression expansion, done in process with the relationship graph, instead of waiting on the Enclave
+
+An expression is a list of items, each a concept with the `includeDescendants`, `includeMapped` and `isExcluded` flags
+of `concept_set_version_item`. The members are, as in OHDSI ATLAS:
+  - each item's concept,
+  - plus, with includeDescendants, all of its descendants in the hierarchy (the graph is `concept_ancestor` at one level
+    of separation, so these are the same as its `concept_ancestor` descendants),
+  - plus, with includeMapped, every concept that "Maps to" any of those,
+for the items that aren't excluded, minus the same for the items that are.
+
+Descendants of all the items are found with one breadth-first search per kind of item rather than one per item, so a
+set with tens of thousands of members expands in milliseconds. "Maps to" relationships are in a ConceptMappings index,
+loaded with the graph and saved in its snapshot.
+
+Unlike ATLAS, invalid concepts aren't left out of descendants, since the graph doesn't have invalid_reason.
+"""
+from typing import Any, Dict, Iterable, List, Union
+
+import numpy as np
+
+from backend.csr_graph import CsrGraph, INDEX_DTYPE, Ids, NODE_ID_DTYPE, _to_id_array, build_csr, gather_neighbors
+
+FLAGS = ('includeDescendants', 'includeMapped', 'isExcluded')
+
+
+class ConceptMappings:
+    """Which concepts "Maps to" each concept: for each distinct target, in sorted order, the sources that map to it"""
+    ARRAY_NAMES = ('targets', 'offsets', 'sources')
+    ARRAY_PREFIX = 'mapsto_'
+
+    def __init__(self, targets: np.ndarray, offsets: np.ndarray, sources: np.ndarray):
+        self.targets = targets
+        self.offsets = offsets
+        self.sources = sources
+
+    @classmethod
+    def from_pairs(cls, sources: Ids, targets: Ids) -> 'ConceptMappings':
+        """Build from parallel arrays of `concept_id_1 "Maps to" concept_id_2` concept ids. Self-mappings are dropped."""
+        sources, targets = _to_id_array(sources), _to_id_array(targets)
+        keep = sources != targets
+        sources, targets = sources[keep], targets[keep]
+        distinct = np.unique(targets)
+        offsets, source_idxs = build_csr(np.searchsorted(distinct, targets), np.arange(len(sources)), len(distinct))
+        return cls(distinct, offsets, sources[source_idxs])
+
+    def mapped_from(self, concept_ids: Ids) -> np.ndarray:
+        """Unique concept ids that map to any of `concept_ids`"""
+        ids = _to_id_array(concept_ids)
+        if not len(self.targets) or not len(ids):
+            return np.empty(0, dtype=NODE_ID_DTYPE)
+        pos = np.minimum(np.searchsorted(self.targets, ids), len(self.targets) - 1)
+        pos = pos[self.targets[pos] == ids].astype(INDEX_DTYPE)
+        _, sources = gather_neighbors(self.offsets, self.sources, pos)
+        return np.unique(sources).astype(NODE_ID_DTYPE, copy=False)
+
+    def __len__(self) -> int:
+        """Number of mappings"""
+        return len(self.sources)
+
+    # Serialization ----------------------------------------------------------------------------------------------------
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Mapping arrays by their name in the snapshot"""
+        return {self.ARRAY_PREFIX + name: getattr(self, name) for name in self.ARRAY_NAMES}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> Union['ConceptMappings', None]:
+        """Inverse of arrays(). None if the arrays aren't there, e.g. in a snapshot from before mappings existed."""
+        if not all(cls.ARRAY_PREFIX + name in arrays for name in cls.ARRAY_NAMES):
+            return None
+        return cls(*[arrays[cls.ARRAY_PREFIX + name] for name in cls.ARRAY_NAMES])
+
+
+def expand_expression(
+    g: CsrGraph, items: Iterable[Dict[str, Any]], mappings: ConceptMappings = None
+) -> np.ndarray:
+    """Members of a concept set expression, as sorted concept ids
+
+    :param items: Dicts with concept_id and the FLAGS. Missing or NULL flags are false.
+    :param mappings: Defaults to the graph's. Required if any item has includeMapped."""
+    items = list(items)
+    mappings = mappings if mappings is not None else g.mappings
+    excluded = np.array([bool(item.get('isExcluded')) for item in items], dtype=bool)
+    included_ids = _resolve(g, [item for item, x in zip(items, excluded) if not x], mappings)
+    excluded_ids = _resolve(g, [item for item, x in zip(items, excluded) if x], mappings)
+    return np.setdiff1d(included_ids, excluded_ids)
+
+
+def expand_expressions(
+    g: CsrGraph, items: Iterable[Dict[str, Any]], mappings: ConceptMappings = None
+) -> Dict[int, List[int]]:
+    """Members of several concept sets at once, from expression items that also have a codeset_id"""
+    by_codeset: Dict[int, List[Dict[str, Any]]] = {}
+    for item in items:
+        by_codeset.setdefault(item['codeset_id'], []).append(item)
+    return {
+        codeset_id: expand_expression(g, codeset_items, mappings).tolist()
+        for codeset_id, codeset_items in by_codeset.items()}
+
+
+def _resolve(g: CsrGraph, items: List[Dict[str, Any]], mappings: Union[ConceptMappings, None]) -> np.ndarray:
+    """Concepts of items, with descendants and mapped concepts as flagged, ignoring isExcluded"""
+    ids = np.array([item['concept_id'] for item in items], dtype=NODE_ID_DTYPE)
+    descendants = np.array([bool(item.get('includeDescendants')) for item in items], dtype=bool)
+    mapped = np.array([bool(item.get('includeMapped')) for item in items], dtype=bool)
+    # Descendants of items that also include mapped concepts have theirs included too, so they're searched separately
+    mapped_descendants = g.descendants_of(ids[descendants & mapped])
+    other_descendants = g.descendants_of(ids[descendants & ~mapped])
+    parts = [ids, mapped_descendants, other_descendants]
+    if mapped.any():
+        if mappings is None:
+            raise ValueError('includeMapped needs "Maps to" mappings, but the graph has none loaded')
+        parts.append(mappings.mapped_from(np.concatenate([ids[mapped], mapped_descendants])))
+    return np.unique(np.concatenate(parts))
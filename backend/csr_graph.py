@@ -0,0 +1,558 @@
+"""Compact, array-backed directed graph for the OMOP concept hierarchy
+
+The hierarchy is stored in compressed sparse row (CSR) form: `node_ids` holds the sorted concept ids, and the edges out
+of node index `i` are `fwd_targets[fwd_offsets[i]:fwd_offsets[i+1]]`. The reverse (parent) direction is stored the same
+way. Nodes are addressed internally by their index into `node_ids`; everything public takes and returns concept ids.
+
+This replaces the networkx DiGraph we used to hold in memory. It supports the subset of the networkx interface that the
+graph routes use (`subgraph()`, `successors()`, `has_node()`, `nodes`, `edges`, etc), so it can be used as a drop-in.
+"""
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Set, Tuple, Union
+
+import numpy as np
+
+NODE_ID_DTYPE = np.int64
+INDEX_DTYPE = np.int32
+OFFSET_DTYPE = np.int64
+Ids = Union[List[int], Set[int], Tuple[int, ...], np.ndarray]
+
+if TYPE_CHECKING:
+    from backend.concept_attributes import ConceptAttributes
+    from backend.concept_expansion import ConceptMappings
+    from backend.graph_components import ConnectedComponents
+    from backend.graph_reachability import Pairs, ReachabilityIndex
+    from backend.graph_rollups import DescendantRollups
+
+
+def _to_id_array(ids: Union[Ids, Iterable[int]]) -> np.ndarray:
+    """Convert a collection of concept ids to a 1d id array"""
+    if isinstance(ids, np.ndarray):
+        return ids.astype(NODE_ID_DTYPE, copy=False).ravel()
+    if not isinstance(ids, (list, tuple)):
+        ids = list(ids)
+    return np.asarray(ids, dtype=NODE_ID_DTYPE).ravel()
+
+
+def build_csr(sources: np.ndarray, targets: np.ndarray, n_nodes: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Build CSR offsets & neighbor arrays from parallel arrays of source & target node indexes"""
+    order = np.argsort(sources, kind='stable')
+    neighbors = targets[order].astype(INDEX_DTYPE, copy=False)
+    counts = np.bincount(sources, minlength=n_nodes)
+    offsets = np.zeros(n_nodes + 1, dtype=OFFSET_DTYPE)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets, neighbors
+
+
+def gather_neighbors(
+    offsets: np.ndarray, neighbors: np.ndarray, idxs: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Gather all neighbors of the node indexes `idxs` without a Python loop
+
+    :returns (sources, targets): parallel arrays, one entry per edge out of `idxs`."""
+    starts = offsets[idxs]
+    counts = offsets[idxs + 1] - starts
+    total = int(counts.sum())
+    if not total:
+        return np.empty(0, dtype=INDEX_DTYPE), np.empty(0, dtype=INDEX_DTYPE)
+    # Positions into `neighbors`: for each range, start + 0..count-1
+    range_starts = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    positions = range_starts + np.arange(total, dtype=OFFSET_DTYPE)
+    return np.repeat(idxs, counts).astype(INDEX_DTYPE, copy=False), neighbors[positions]
+
+
+def bfs(
+    offsets: np.ndarray, neighbors: np.ndarray, sources: np.ndarray, max_depth: int = None, max_nodes: int = None,
+    deadline: float = None
+) -> Tuple[np.ndarray, np.ndarray, bool]:
+    """Breadth-first search over CSR arrays. See bfs_by()."""
+    return bfs_by(
+        lambda frontier: gather_neighbors(offsets, neighbors, frontier)[1], len(offsets) - 1, sources, max_depth,
+        max_nodes, deadline)
+
+
+def bfs_by(
+    expand: Callable[[np.ndarray], np.ndarray], n_nodes: int, sources: np.ndarray, max_depth: int = None,
+    max_nodes: int = None, deadline: float = None
+) -> Tuple[np.ndarray, np.ndarray, bool]:
+    """Level-synchronous breadth-first search from all of `sources` at once
+
+    Each level is expanded with one vectorized gather over the whole frontier, so the number of Python-level iterations
+    is the depth of the search, not the number of nodes.
+
+    :param expand: Node indexes of all neighbors of a frontier of node indexes, with repeats
+    :param max_depth: Stop after this many levels. None for no limit.
+    :param max_nodes: Stop once this many nodes have been reached. The last level is cut short, keeping its lowest
+     indexes, so results are deterministic.
+    :param deadline: `time.monotonic()` time after which to stop, between levels.
+    :returns (idxs, depths, complete): Indexes of the nodes reached, not including `sources`, in the order they were
+     reached; each one's distance from the nearest source; and False if `max_nodes` or `deadline` cut the search
+     short."""
+    visited = np.zeros(n_nodes, dtype=bool)
+    frontier = np.unique(sources).astype(INDEX_DTYPE, copy=False)
+    visited[frontier] = True
+    found: List[np.ndarray] = []
+    depths: List[np.ndarray] = []
+    n_found = 0
+    depth = 0
+    complete = True
+    while len(frontier) and (max_depth is None or depth < max_depth):
+        if deadline is not None and time.monotonic() > deadline:
+            complete = False
+            break
+        depth += 1
+        targets = expand(frontier)
+        frontier = np.unique(targets[~visited[targets]])
+        if max_nodes is not None and n_found + len(frontier) > max_nodes:
+            frontier = frontier[:max_nodes - n_found]
+            complete = False
+        visited[frontier] = True
+        found.append(frontier)
+        depths.append(np.full(len(frontier), depth, dtype=np.int32))
+        n_found += len(frontier)
+        if not complete:
+            break
+    if not found:
+        return np.empty(0, dtype=INDEX_DTYPE), np.empty(0, dtype=np.int32), complete
+    return np.concatenate(found), np.concatenate(depths), complete
+
+
+class CsrGraph:
+    """Directed graph over concept ids, stored as forward and reverse CSR arrays
+
+    :param meta: Free-form information about where the graph came from, e.g. the vocab version it was built from.
+    :attr attributes: Concept attributes loaded and saved with the graph, if any. See backend.concept_attributes.
+    :attr mappings: "Maps to" relationships loaded and saved with the graph, if any. See backend.concept_expansion."""
+    CSR_ARRAY_NAMES = ('fwd_offsets', 'fwd_targets', 'rev_offsets', 'rev_sources')
+
+    def __init__(
+        self, node_ids: np.ndarray, fwd_offsets: np.ndarray, fwd_targets: np.ndarray, rev_offsets: np.ndarray,
+        rev_sources: np.ndarray, meta: Dict[str, Any] = None
+    ):
+        self.node_ids = node_ids
+        self.fwd_offsets = fwd_offsets
+        self.fwd_targets = fwd_targets
+        self.rev_offsets = rev_offsets
+        self.rev_sources = rev_sources
+        self.meta: Dict[str, Any] = meta or {}
+        self._reachability: Union['ReachabilityIndex', None] = None
+        self._components: Union['ConnectedComponents', None] = None
+        self.attributes: Union['ConceptAttributes', None] = None
+        self.rollups: Union['DescendantRollups', None] = None
+        self.mappings: Union['ConceptMappings', None] = None
+
+    # Construction -----------------------------------------------------------------------------------------------------
+    @classmethod
+    def from_edges(cls, sources: Ids, targets: Ids, node_ids: Ids = None) -> 'CsrGraph':
+        """Build from parallel arrays of source & target concept ids
+
+        :param node_ids: Optional extra nodes to include even if they have no edges."""
+        sources = _to_id_array(sources)
+        targets = _to_id_array(targets)
+        if len(sources) != len(targets):
+            raise ValueError(f'sources and targets differ in length: {len(sources)} != {len(targets)}')
+        all_ids = np.concatenate([sources, targets] + ([_to_id_array(node_ids)] if node_ids is not None else []))
+        ids = np.unique(all_ids)
+        # Dedupe edges, as networkx would
+        src_idx = np.searchsorted(ids, sources)
+        tgt_idx = np.searchsorted(ids, targets)
+        if len(src_idx):
+            edge_keys = np.unique(src_idx.astype(np.int64) * len(ids) + tgt_idx)
+            src_idx, tgt_idx = np.divmod(edge_keys, len(ids))
+        fwd_offsets, fwd_targets = build_csr(src_idx, tgt_idx, len(ids))
+        rev_offsets, rev_sources = build_csr(tgt_idx, src_idx, len(ids))
+        return cls(ids, fwd_offsets, fwd_targets, rev_offsets, rev_sources)
+
+    @classmethod
+    def from_networkx(cls, g) -> 'CsrGraph':
+        """Build from a networkx DiGraph, e.g. an old relationship_graph.pickle"""
+        edges = np.array(list(g.edges), dtype=NODE_ID_DTYPE).reshape(-1, 2)
+        return cls.from_edges(edges[:, 0], edges[:, 1], list(g.nodes))
+
+    # Id <-> index -----------------------------------------------------------------------------------------------------
+    def index_of(self, concept_ids: Ids) -> Tuple[np.ndarray, np.ndarray]:
+        """Look up node indexes for concept ids
+
+        :returns (idxs, found): `idxs` for the ids that are in the graph, and a boolean mask over the input saying which
+        ids were found."""
+        ids = _to_id_array(concept_ids)
+        n = len(self.node_ids)
+        if not n:
+            return np.empty(0, dtype=INDEX_DTYPE), np.zeros(len(ids), dtype=bool)
+        pos = np.searchsorted(self.node_ids, ids)
+        pos_clipped = np.minimum(pos, n - 1)
+        found = self.node_ids[pos_clipped] == ids
+        return pos_clipped[found].astype(INDEX_DTYPE, copy=False), found
+
+    def mask_of(self, concept_ids: Ids) -> np.ndarray:
+        """Boolean node mask with True for each of `concept_ids` in the graph"""
+        mask = np.zeros(len(self.node_ids), dtype=bool)
+        mask[self.index_of(concept_ids)[0]] = True
+        return mask
+
+    def ids_of(self, idxs: np.ndarray) -> np.ndarray:
+        """Concept ids for node indexes"""
+        return self.node_ids[idxs]
+
+    # networkx-compatible interface ------------------------------------------------------------------------------------
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    def __contains__(self, concept_id: int) -> bool:
+        return self.has_node(concept_id)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.node_ids.tolist())
+
+    def has_node(self, concept_id: int) -> bool:
+        """Is concept in graph?"""
+        return bool(self.index_of([concept_id])[1][0])
+
+    def number_of_nodes(self) -> int:
+        """Number of nodes"""
+        return len(self.node_ids)
+
+    def number_of_edges(self) -> int:
+        """Number of edges"""
+        return len(self.fwd_targets)
+
+    @property
+    def nodes(self) -> List[int]:
+        """Concept ids of all nodes"""
+        return self.node_ids.tolist()
+
+    @property
+    def edges(self) -> List[Tuple[int, int]]:
+        """All edges as (source, target) concept id tuples"""
+        sources, targets = self.edge_arrays()
+        return list(zip(sources.tolist(), targets.tolist()))
+
+    def edge_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        """All edges as parallel arrays of source and target concept ids, ordered by source"""
+        sources = np.repeat(self.node_ids, np.diff(self.fwd_offsets))
+        return sources, self.node_ids[self.fwd_targets]
+
+    def successors(self, concept_id: int) -> List[int]:
+        """Children of a concept"""
+        return self._neighbors(concept_id, reverse=False)
+
+    def predecessors(self, concept_id: int) -> List[int]:
+        """Parents of a concept"""
+        return self._neighbors(concept_id, reverse=True)
+
+    def _neighbors(self, concept_id: int, reverse: bool) -> List[int]:
+        """Neighbors of a concept in one direction"""
+        idxs, found = self.index_of([concept_id])
+        if not found[0]:
+            raise KeyError(f'Concept {concept_id} is not in the graph.')
+        return self.node_ids[self._gather(idxs, reverse)[1]].tolist()
+
+    def out_degree(self) -> List[Tuple[int, int]]:
+        """(concept_id, number of children) for every node"""
+        return list(zip(self.node_ids.tolist(), self._degrees(np.arange(len(self), dtype=INDEX_DTYPE)).tolist()))
+
+    def in_degree(self) -> List[Tuple[int, int]]:
+        """(concept_id, number of parents) for every node"""
+        return list(zip(
+            self.node_ids.tolist(), self._degrees(np.arange(len(self), dtype=INDEX_DTYPE), reverse=True).tolist()))
+
+    def subgraph(self, concept_ids: Ids) -> 'CsrGraph':
+        """Induced subgraph on `concept_ids`. Ids not in the graph are ignored, as in networkx."""
+        idxs = np.unique(self.index_of(concept_ids)[0])
+        mask = np.zeros(len(self.node_ids), dtype=bool)
+        mask[idxs] = True
+        sources, targets = self._gather(idxs)
+        keep = mask[targets]
+        sources, targets = sources[keep], targets[keep]
+        # Re-index to the subgraph's own node numbering. `idxs` is sorted, so node_ids stay sorted.
+        new_index = np.cumsum(mask) - 1
+        sub_sources = new_index[sources]
+        sub_targets = new_index[targets]
+        n = len(idxs)
+        fwd_offsets, fwd_targets = build_csr(sub_sources, sub_targets, n)
+        rev_offsets, rev_sources = build_csr(sub_targets, sub_sources, n)
+        return CsrGraph(self.node_ids[idxs], fwd_offsets, fwd_targets, rev_offsets, rev_sources)
+
+    # Traversal --------------------------------------------------------------------------------------------------------
+    def _gather(self, idxs: np.ndarray, reverse=False) -> Tuple[np.ndarray, np.ndarray]:
+        """Edges out of (or, if `reverse`, into) node indexes `idxs`, as for gather_neighbors(): grouped by node in the
+        order of `idxs`, each node's neighbors in ascending order. Traversals only read edges through here and
+        _degrees(), so a graph stored differently (see ShardedGraph) only needs to override those."""
+        if reverse:
+            return gather_neighbors(self.rev_offsets, self.rev_sources, idxs)
+        return gather_neighbors(self.fwd_offsets, self.fwd_targets, idxs)
+
+    def _degrees(self, idxs: np.ndarray, reverse=False) -> np.ndarray:
+        """Number of children (or, if `reverse`, parents) of each of node indexes `idxs`"""
+        offsets = self.rev_offsets if reverse else self.fwd_offsets
+        return offsets[idxs + 1] - offsets[idxs]
+
+    def _bfs(
+        self, idxs: np.ndarray, reverse=False, max_depth: int = None, max_nodes: int = None, deadline: float = None
+    ) -> Tuple[np.ndarray, np.ndarray, bool]:
+        """bfs_by() from node indexes `idxs`, following edges to children, or to parents if `reverse`"""
+        return bfs_by(
+            lambda frontier: self._gather(frontier, reverse)[1], len(self), idxs, max_depth, max_nodes, deadline)
+
+    def children_of(self, concept_ids: Ids) -> np.ndarray:
+        """Unique concept ids of all direct children of `concept_ids`"""
+        idxs = self.index_of(concept_ids)[0]
+        _, targets = self._gather(idxs)
+        return self.node_ids[np.unique(targets)]
+
+    def descendants_of(self, concept_ids: Ids, max_depth: int = None, max_nodes: int = None) -> np.ndarray:
+        """Concept ids of all descendants of `concept_ids`, up to `max_depth` levels down. See bfs_by().
+
+        Concepts in `concept_ids` are not included, even if one is a descendant of another."""
+        return self.traverse(concept_ids, max_depth, max_nodes)[0]
+
+    def ancestors_of(self, concept_ids: Ids, max_depth: int = None, max_nodes: int = None) -> np.ndarray:
+        """Concept ids of all ancestors of `concept_ids`, up to `max_depth` levels up. See bfs_by()."""
+        return self.traverse(concept_ids, max_depth, max_nodes, reverse=True)[0]
+
+    def traverse(
+        self, concept_ids: Ids, max_depth: int = None, max_nodes: int = None, reverse=False, deadline: float = None
+    ) -> Tuple[np.ndarray, np.ndarray, bool]:
+        """Breadth-first search from `concept_ids`, following edges to children, or to parents if `reverse`
+
+        :returns (concept_ids, depths, complete): as for bfs_by(), but with concept ids instead of node indexes."""
+        idxs, depths, complete = self._bfs(self.index_of(concept_ids)[0], reverse, max_depth, max_nodes, deadline)
+        return self.node_ids[idxs], depths, complete
+
+    def nodes_between(
+        self, concept_ids: Ids, max_depth: int = 4, deadline: float = None
+    ) -> Tuple[np.ndarray, bool]:
+        """Gap filling: concepts not in `concept_ids` that are on a path from one of `concept_ids` down to another
+
+        Searches down from the whole set and up from the whole set at once, a level at a time, always extending the
+        side with the smaller frontier. A concept is in a gap if it is reachable going down and going up, and the two
+        distances add up to no more than `max_depth`.
+
+        :param max_depth: Longest path, in edges, between two of `concept_ids` to look for gaps in.
+        :param deadline: `time.monotonic()` time after which to stop searching and return what has been found.
+        :returns (concept_ids, complete): complete is False if the deadline was hit."""
+        idxs = self.index_of(concept_ids)[0]
+        # A concept alone in its component has no path to any of the others, so there's nothing to search from it
+        component = self.components.component[idxs]
+        idxs = idxs[np.bincount(component, minlength=len(self.components))[component] > 1]
+        down = np.full(len(self.node_ids), -1, dtype=np.int16)  # distance below the nearest of concept_ids
+        up = np.full(len(self.node_ids), -1, dtype=np.int16)  # distance above the nearest of concept_ids
+        down[idxs] = 0
+        up[idxs] = 0
+        sides = [
+            {'dist': down, 'reverse': False, 'frontier': idxs, 'depth': 0},
+            {'dist': up, 'reverse': True, 'frontier': idxs, 'depth': 0}]
+        complete = True
+        while True:
+            # Each side needs to go at most max_depth - 1 levels, since a gap node is at least 1 level from the other
+            open_sides = [s for s in sides if len(s['frontier']) and s['depth'] < max_depth - 1]
+            if not open_sides:
+                break
+            if deadline is not None and time.monotonic() > deadline:
+                complete = False
+                break
+            side = min(open_sides, key=lambda s: len(s['frontier']))
+            _, targets = self._gather(side['frontier'], side['reverse'])
+            side['frontier'] = np.unique(targets[side['dist'][targets] < 0])
+            side['depth'] += 1
+            side['dist'][side['frontier']] = side['depth']
+        between = np.flatnonzero((down > 0) & (up > 0) & (down.astype(np.int32) + up <= max_depth))
+        return self.node_ids[between], complete
+
+    # Reachability -----------------------------------------------------------------------------------------------------
+    @property
+    def reachability(self) -> 'ReachabilityIndex':
+        """Reachability index, loaded from the snapshot, or else built on first use"""
+        if self._reachability is None:
+            from backend.graph_reachability import ReachabilityIndex
+            self._reachability = ReachabilityIndex.build(self)
+        return self._reachability
+
+    @property
+    def components(self) -> 'ConnectedComponents':
+        """Weakly connected components, loaded from the snapshot, or else built on first use"""
+        if self._components is None:
+            from backend.graph_components import ConnectedComponents
+            self._components = ConnectedComponents.build(self)
+        return self._components
+
+    def build_indexes(self):
+        """Build all derived indexes now, e.g. before saving a snapshot, rather than on first use"""
+        _ = self.reachability
+        _ = self.components
+
+    def is_descendant(self, pairs: 'Pairs') -> np.ndarray:
+        """For each (descendant, ancestor) pair of concept ids, is the first a strict descendant of the second?
+
+        :param pairs: Iterable of (descendant, ancestor) tuples, or an (n, 2) array.
+        :returns: Boolean array, one entry per pair. False for pairs with a concept that isn't in the graph."""
+        from backend.graph_reachability import pairs_to_arrays
+        descendants, ancestors = pairs_to_arrays(pairs)
+        result = np.zeros(len(descendants), dtype=bool)
+        d_idxs, d_found = self.index_of(descendants)
+        a_idxs, a_found = self.index_of(ancestors)
+        both = d_found & a_found
+        result[both] = self.reachability.is_descendant(self, d_idxs[both[d_found]], a_idxs[both[a_found]])
+        return result
+
+    def ancestors_within(self, concept_ids: Ids) -> Dict[int, Set[int]]:
+        """For each of `concept_ids` in the graph, which of the other `concept_ids` are its ancestors
+
+        Members with no ancestors in the set are the set's roots."""
+        idxs, _ = self.index_of(concept_ids)
+        by_idx = self.reachability.ancestors_within(self, idxs)
+        return {int(self.node_ids[i]): set(self.node_ids[ancestors].tolist()) for i, ancestors in by_idx.items()}
+
+    def component_of(self, concept_ids: Ids) -> np.ndarray:
+        """Weakly connected component of each concept. -1 for ids not in the graph. Concepts in different components
+        have no path between them in either direction."""
+        return self.components.of(self, concept_ids)
+
+    def components_spanned(self, concept_ids: Ids) -> Dict[int, List[int]]:
+        """Concepts grouped by weakly connected component, leaving out ids not in the graph"""
+        return self.components.spanned(self, concept_ids)
+
+    def depth_of(self, concept_ids: Ids) -> np.ndarray:
+        """Distance of each concept from its nearest root (see ReachabilityIndex). -1 for ids not in the graph."""
+        ids = _to_id_array(concept_ids)
+        depth = np.full(len(ids), -1, dtype=np.int32)
+        idxs, found = self.index_of(ids)
+        depth[found] = self.reachability.depth[idxs]
+        return depth
+
+    def lowest_common_ancestors(self, concept_ids: Ids) -> List[int]:
+        """Deepest concepts that are ancestors of (or are) all of `concept_ids`, deepest first. Ids not in the graph
+        are ignored. Empty if the concepts are in different hierarchies."""
+        idxs, _ = self.index_of(concept_ids)
+        if len(np.unique(self.components.component[idxs])) > 1:
+            return []
+        return self.node_ids[self.reachability.lowest_common_ancestors(self, idxs)].tolist()
+
+    def shortest_path(self, ancestor: int, descendant: int) -> List[int]:
+        """Concepts on a shortest path down from `ancestor` to `descendant`, inclusive. Empty if there is none."""
+        idxs, found = self.index_of([ancestor, descendant])
+        if not found.all() or self.components.component[idxs[0]] != self.components.component[idxs[1]]:
+            return []
+        top, bottom = idxs.tolist()
+        if top == bottom:
+            return [ancestor]
+        parents, children = self._shortest_path_edges(top, np.array([bottom]))
+        parent_of: Dict[int, int] = dict(zip(children.tolist(), parents.tolist()))
+        if bottom not in parent_of:
+            return []
+        path = [bottom]
+        while path[-1] != top:
+            path.append(parent_of[path[-1]])
+        return self.node_ids[path[::-1]].tolist()
+
+    def _shortest_path_edges(self, top: int, bottoms: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Edges, as (parent, child) node index arrays, of a shortest path down from node index `top` to each of
+        `bottoms` that it reaches. Where paths meet, they share the rest of the way up.
+
+        Every node on such a path is an ancestor of its bottom, so one search up from all of `bottoms` at once bounds
+        the search down from `top`, and nothing is the size of the whole graph."""
+        above = np.union1d(bottoms, self._bfs(bottoms, reverse=True)[0])
+        dist = np.full(len(above), -1, dtype=np.int32)  # distance down from `top`, for each node in `above`
+
+        def position(idxs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+            """Positions of `idxs` in `above`, and whether each is in it"""
+            pos = np.minimum(np.searchsorted(above, idxs), len(above) - 1)
+            return pos, above[pos] == idxs
+
+        top_pos, top_above = position(np.array([top]))
+        if not top_above[0]:
+            return np.empty(0, dtype=INDEX_DTYPE), np.empty(0, dtype=INDEX_DTYPE)
+        dist[top_pos] = 0
+        frontier, depth = np.array([top], dtype=INDEX_DTYPE), 0
+        while len(frontier):
+            _, children = self._gather(frontier)
+            pos, ok = position(children)
+            pos = np.unique(pos[ok][dist[pos[ok]] < 0])
+            depth += 1
+            dist[pos] = depth
+            frontier = above[pos]
+        # Walk up from all bottoms at once, each step to a parent one closer to `top`
+        pos, _ = position(np.unique(bottoms))
+        current = above[pos[dist[pos] > 0]]
+        walked = np.zeros(len(above), dtype=bool)
+        found_parents, found_children = [], []
+        while len(current):
+            pos, _ = position(current)
+            current = current[~walked[pos]]
+            walked[pos] = True
+            children, parents = self._gather(current, reverse=True)
+            parent_pos, ok = position(parents)
+            ok &= dist[parent_pos] == dist[position(children)[0]] - 1
+            children, parents, parent_pos = children[ok], parents[ok], parent_pos[ok]
+            _, first = np.unique(children, return_index=True)
+            found_parents.append(parents[first])
+            found_children.append(children[first])
+            current = np.unique(parents[first][dist[parent_pos[first]] > 0])
+        if not found_parents:
+            return np.empty(0, dtype=INDEX_DTYPE), np.empty(0, dtype=INDEX_DTYPE)
+        return np.concatenate(found_parents), np.concatenate(found_children)
+
+    def connect_roots(self, concept_ids: Ids) -> Tuple[List[int], List[int], List[Tuple[int, int]]]:
+        """Where separate fragments of a concept set meet: the set's roots, their lowest common ancestors, and edges on
+        shortest paths down to each root from the deepest common ancestor
+
+        :returns (roots, common_ancestors, edges): roots are the concepts with no ancestor in the set. common_ancestors
+         and edges are empty if there is only one root or the roots have no common ancestor."""
+        roots = sorted(c for c, ancestors in self.ancestors_within(concept_ids).items() if not ancestors)
+        common = self.lowest_common_ancestors(roots) if len(roots) > 1 else []
+        if not common:
+            return roots, common, []
+        parents, children = self._shortest_path_edges(self.index_of([common[0]])[0][0], self.index_of(roots)[0])
+        edges = zip(self.node_ids[parents].tolist(), self.node_ids[children].tolist())
+        return roots, common, sorted(set(edges))
+
+    def nbytes(self) -> int:
+        """Memory used by the graph arrays"""
+        return sum(a.nbytes for a in self.arrays().values())
+
+    # Serialization ----------------------------------------------------------------------------------------------------
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """The arrays that fully describe the graph, plus any indexes built so far, by name"""
+        arrays = {
+            'node_ids': self.node_ids,
+            'fwd_offsets': self.fwd_offsets,
+            'fwd_targets': self.fwd_targets,
+            'rev_offsets': self.rev_offsets,
+            'rev_sources': self.rev_sources,
+        }
+        if self._reachability is not None:
+            arrays.update(self._reachability.arrays())
+        if self._components is not None:
+            arrays.update(self._components.arrays())
+        if self.attributes is not None:
+            arrays.update(self.attributes.arrays())
+        if self.rollups is not None:
+            arrays.update(self.rollups.arrays())
+        if self.mappings is not None:
+            arrays.update(self.mappings.arrays())
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], meta: Dict[str, Any] = None) -> 'CsrGraph':
+        """Inverse of arrays()"""
+        g = cls(
+            arrays['node_ids'], arrays['fwd_offsets'], arrays['fwd_targets'], arrays['rev_offsets'],
+            arrays['rev_sources'], meta)
+        g._set_extras(arrays)
+        return g
+
+    def _set_extras(self, arrays: Dict[str, np.ndarray]):
+        """Set the indexes, attributes, rollups and mappings that are in `arrays`, per arrays()"""
+        from backend.concept_attributes import ConceptAttributes
+        from backend.concept_expansion import ConceptMappings
+        from backend.graph_components import ConnectedComponents
+        from backend.graph_reachability import ReachabilityIndex
+        from backend.graph_rollups import DescendantRollups
+        self._reachability = ReachabilityIndex.from_arrays(arrays)
+        self._components = ConnectedComponents.from_arrays(arrays)
+        self.attributes = ConceptAttributes.from_arrays(arrays)
+        self.rollups = DescendantRollups.from_arrays(arrays)
+        self.mappings = ConceptMappings.from_arrays(arrays)
+
+    def __repr__(self):
+        return f'CsrGraph(nodes={self.number_of_nodes()}, edges={self.number_of_edges()})'
@@ -25,8 +25,9 @@ BACKEND_DIR = os.path.join(DB_DIR, '..')
 PROJECT_ROOT = os.path.join(BACKEND_DIR, '..')
 sys.path.insert(0, str(PROJECT_ROOT))
 from backend.db.analysis import counts_update
-from backend.db.utils import SCHEMA, check_db_status_var, current_datetime, get_db_connection, get_ddl_statements, \
-    load_csv, refresh_derived_tables, reset_temp_refresh_tables, run_sql, update_db_status_var
+from backend.db.utils import SCHEMA, check_db_status_var, clear_table_metadata_cache, current_datetime, \
+    get_db_connection, get_ddl_statements, load_csv, refresh_derived_tables, reset_temp_refresh_tables, run_sql, \
+    update_db_status_var
 from enclave_wrangler.config import DATASET_GROUPS_CONFIG
 from enclave_wrangler.datasets import download_datasets, get_datetime_dataset_last_updated
 
@@ -59,6 +60,7 @@ def load_dataset_group(dataset_group_name: str, schema: str = SCHEMA, alternate_
                 statements: List[str] = get_ddl_statements(schema, ['primary_keys'], return_type='flat')
                 for statement in statements:
                     run_sql(con, statement)
+                clear_table_metadata_cache(con)
 
                 # Indexes
                 statements: List[str] = get_ddl_statements(schema, ['indexes'], return_type='flat')
@@ -116,11 +118,9 @@ def refresh_dataset_group_tables(
             counts_update(f'DB refresh: {",".join(dataset_group)}', schema)
 
         # Vocab refresh only
-        # todo: ideally this notification would happen differently. More comments near bottom of refresh_voc.yml
-        if group_name == 'vocab' and len(dataset_group) == 1:  # Will be the case for GH actions
-            raise NotAnError('Notification: Restart deployment backend.\nThis is not an error. It is only being raised '
-                'as an easy way to trigger a GitHub action notification. Vocabulary refresh has completed '
-                'successfully. Please restart backend to refresh networkx graph.')
+        if group_name == 'vocab' and not download_only:
+            print('Running backends will notice the new vocabulary within a few minutes, rebuild the relationship '
+                  'graph in the background, and swap it in. No restart needed.')
 
     print('Done')
 
@@ -7,7 +7,9 @@ todo's
 """
 import json
 import os
+import struct
 import sys
+import threading
 import time
 from argparse import ArgumentParser
 from pathlib import Path
@@ -18,18 +20,22 @@ import dateutil.parser as dp
 from datetime import datetime, timedelta, timezone
 from glob import glob
 import re
+from contextlib import contextmanager
 
+import numpy as np
 import pandas as pd
 from jinja2 import Template
 # noinspection PyUnresolvedReferences
 from psycopg2.errors import UndefinedTable
 from sqlalchemy import create_engine, event, CursorResult
-from sqlalchemy.engine import Row, RowMapping
+from sqlalchemy.engine import Engine, Row, RowMapping
 from sqlalchemy.engine.base import Connection
 from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql import text
 from sqlalchemy.sql.elements import TextClause
-from typing import Any, Dict, Set, Tuple, Union, List
+from typing import Any, Callable, Dict, Iterable, Iterator, Set, Tuple, Union, List
 
 
 DB_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -43,10 +49,31 @@ from enclave_wrangler.models import pkey
 
 
 DDL_JINJA_PATH_PATTERN = os.path.join(DB_DIR, 'ddl-*.jinja.sql')
+PG_BINARY_COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
 TIMEZONE_DEFAULT = ['UTC/GMT', 'EST/EDT'][1]
 DEBUG = False
 DB = CONFIG["db"]
 SCHEMA = CONFIG["schema"]
+# Connection pools, per engine. Connections past the recycle age are replaced at checkout, and pre-ping replaces ones
+#  that kill_idle_cons() killed while they sat in the pool.
+DB_POOL_SIZE = int(os.getenv('TERMHUB_DB_POOL_SIZE', '5'))
+DB_POOL_MAX_OVERFLOW = int(os.getenv('TERMHUB_DB_POOL_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT_SECONDS = 30
+DB_POOL_RECYCLE_SECONDS = 5 * 60
+_DB_ENGINES: Dict[Tuple[bool, str, str], Engine] = {}
+_DB_ENGINES_LOCK = threading.Lock()
+# insert_from_dicts() and update_from_dicts() batches at least this big are written with COPY, through a staging table
+COPY_MIN_ROWS = 500
+ASYNC_DB_DRIVER = 'asyncpg'
+# Table metadata caches are dropped when the `manage` table's TABLE_METADATA_STATUS_VAR changes, which DDL in any
+#  process records via clear_table_metadata_cache(). It's re-read at most every TABLE_METADATA_CHECK_SECONDS.
+TABLE_METADATA_STATUS_VAR = 'last_table_metadata_change'
+TABLE_METADATA_CHECK_SECONDS = 30
+_UNIQUE_KEYS_CACHE: Dict[Tuple[Engine, str], List[Set[str]]] = {}
+_COLUMN_TYPES_CACHE: Dict[Tuple[Engine, str], Dict[str, str]] = {}
+_FIELD_DATA_TYPES_CACHE: Dict[Tuple[str, str], Dict[str, str]] = {}
+_TABLE_METADATA_CHECKED: Dict[Tuple[str, str], Tuple[float, Union[str, None]]] = {}  # DB -> (time, status var)
+_ASYNC_DB_ENGINES: Dict[Tuple[bool, str, str], AsyncEngine] = {}
 
 
 def dedupe_dicts(list_of_dicts: List[Dict]) -> List[Dict]:
@@ -205,6 +232,7 @@ def refresh_derived_tables_exec(
 
     for module in ddl_modules_queue:
         run_sql(con, f'DROP TABLE IF EXISTS {schema}.{module}_old;')
+    clear_table_metadata_cache(con)
     t1 = datetime.now()
     print(f' - completed in {(t1 - t0).seconds} seconds')
 
@@ -248,71 +276,131 @@ def refresh_derived_tables(
             break
 
 
-# todo: Any use to having this? If not, remove. Otherwise, needs fixing. It was working when in get_db_connection() we
-#  were not passing schema... but that's not really working. We need to be able to control the schema. After changing to
-#  pass schema, sometimes it worked, and sometimes we got err: AttributeError: 'dict' object has no attribute 'cursor',
-#  indicating that the kwargs weren't getting passed appropriately.
-# from functools import partial
-# from sqlalchemy.pool import QueuePool
-# def set_search_path(dbapi_connection, schema=SCHEMA, connection_record=None):
-#     """Set the search_path when connecting.
-#
-#     Source: https://chat.openai.com/share/0472ba44-0e58-44ad-bbcb-5eabffae3d39
-#
-#     Note: This hasn't helped w/ a problem we were having. If it continues to not help, we could rever to the old
-#     version of get_db_connection().
-#     """
-#     cursor = dbapi_connection.cursor()
-#     cursor.execute(f"SET SESSION search_path='{schema}'")
-#     cursor.close()
-#
-#
-# def get_db_connection(isolation_level='AUTOCOMMIT', schema: str = SCHEMA, local=False) -> Connection:
-#     """Get database connection object
-#
-#     :param local: If True, connection is on local instead of production database.
-#     """
-#     if schema == None:
-#         raise ValueError('Must pass schema to get_db_connection()')
-#     engine = create_engine(
-#         get_pg_connect_url(local),
-#         poolclass=QueuePool,
-#         isolation_level=isolation_level,
-#     )
-#     # event.listen(engine, "connect", set_search_path)
-#     event.listen(engine, "connect", partial(set_search_path, {'schema': schema}))
-#     return engine.connect()
+def get_db_engine(isolation_level='AUTOCOMMIT', schema: str = SCHEMA, local=False) -> Engine:
+    """Get the process-wide engine for these connection settings, creating it on first use
+
+    Engines are kept in a registry keyed by (local, schema, isolation_level), so connections are pooled instead of a
+    new Postgres connection (TCP + auth handshake) being opened for every query. The search_path is set through the
+    connection's startup options, so it's also the session default that `DISCARD ALL` resets to when a connection goes
+    back into the pool. Discarding on checkin means temp tables (e.g. the ones DDL creates during refreshes) and session
+    settings don't leak from one use of a pooled connection to the next."""
+    key = (local, schema, isolation_level)
+    engine = _DB_ENGINES.get(key)
+    if engine is not None:
+        return engine
+    with _DB_ENGINES_LOCK:
+        if key not in _DB_ENGINES:
+            engine = create_engine(
+                get_pg_connect_url(local),
+                isolation_level=isolation_level,
+                poolclass=QueuePool,
+                pool_size=DB_POOL_SIZE,
+                max_overflow=DB_POOL_MAX_OVERFLOW,
+                pool_timeout=DB_POOL_TIMEOUT_SECONDS,
+                pool_recycle=DB_POOL_RECYCLE_SECONDS,
+                pool_pre_ping=True,
+                connect_args={'options': f'-c search_path={schema}'} if schema else {})
+            event.listen(engine, 'checkin', _discard_session_state)
+            _DB_ENGINES[key] = engine
+        return _DB_ENGINES[key]
+
+
+# noinspection PyUnusedLocal
+def _discard_session_state(dbapi_connection, connection_record):
+    """Reset a connection returned to the pool to a fresh session: drop temp tables, reset settings, release locks"""
+    if dbapi_connection is None:  # invalidated
+        return
+    existing_autocommit = dbapi_connection.autocommit
+    dbapi_connection.autocommit = True  # DISCARD can't run in a transaction block
+    cursor = dbapi_connection.cursor()
+    cursor.execute('DISCARD ALL')
+    cursor.close()
+    dbapi_connection.autocommit = existing_autocommit
 
 
 # todo: make 'isolation_level' the final param, since we never override it. this would it so we dont' have to pass the
 #  other params as named params.
 def get_db_connection(isolation_level='AUTOCOMMIT', schema: str = SCHEMA, local=False) -> Connection:
-    """Get DB connection object.
+    """Get DB connection object, from the pool of the engine for these settings. Closing it returns it to the pool.
 
     :param local: If True, connection is on local instead of production database.
     """
-    engine = create_engine(get_pg_connect_url(local), isolation_level=isolation_level)
-
-    # noinspection PyUnusedLocal
-    @event.listens_for(engine, "connect", insert=True)
-    def set_search_path(dbapi_connection, connection_record):
-        """This does "set search_path to n3c;" when you connect.
-        https://docs.sqlalchemy.org/en/14/dialects/postgresql.html#setting-alternate-search-paths-on-connect
-        :param connection_record: Part of the example but we're not using yet.
-
-        Ideally, we'd want to be able to call this whenever we want. But cannot be called outside of context of
-        initializing a connection.
-        """
-        if not schema:
-            return
-        existing_autocommit = dbapi_connection.autocommit
-        dbapi_connection.autocommit = True
-        cursor = dbapi_connection.cursor()
-        cursor.execute(f"SET SESSION search_path='{schema}'")
-        cursor.close()
-        dbapi_connection.autocommit = existing_autocommit
+    return get_db_engine(isolation_level, schema, local).connect()
+
+
+def db_pool_stats() -> List[Dict[str, Any]]:
+    """Connection pool usage of each engine in this process, sync and async"""
+    stats = []
+    engines = [(False, key, engine) for key, engine in list(_DB_ENGINES.items())] + \
+        [(True, key, engine) for key, engine in list(_ASYNC_DB_ENGINES.items())]
+    for is_async, (local, schema, isolation_level), engine in engines:
+        pool: QueuePool = engine.pool
+        stats.append({
+            'async': is_async, 'local': local, 'schema': schema, 'isolation_level': isolation_level,
+            'size': pool.size(), 'checked_in': pool.checkedin(), 'checked_out': pool.checkedout(),
+            'overflow': pool.overflow()})
+    return stats
+
+
+def dispose_db_engines(close=True):
+    """Close the pooled connections of every engine and forget the engines, e.g. when the app shuts down
+
+    :param close: False in a forked child process: the connections are the parent's too, so they're dropped from the
+     child's pools without being closed."""
+    with _DB_ENGINES_LOCK:
+        for engine in _DB_ENGINES.values():
+            engine.dispose(close=close)
+        _DB_ENGINES.clear()
+
+
+def _forget_db_engines_in_child():
+    """Give a forked child, e.g. a gunicorn worker, engines of its own instead of sharing the parent's connections"""
+    global _DB_ENGINES_LOCK
+    _DB_ENGINES_LOCK = threading.Lock()  # another thread of the parent may have held it when forking
+    dispose_db_engines(close=False)
+    for engine in _ASYNC_DB_ENGINES.values():
+        engine.sync_engine.dispose(close=False)
+    _ASYNC_DB_ENGINES.clear()
+
+
+if hasattr(os, 'register_at_fork'):  # not on Windows
+    os.register_at_fork(after_in_child=_forget_db_engines_in_child)
+
+
+def get_async_db_engine(isolation_level='AUTOCOMMIT', schema: str = SCHEMA, local=False) -> AsyncEngine:
+    """Get the process-wide async (asyncpg) engine for these connection settings, creating it on first use
+
+    For async routes, so that a worker can wait on many queries at once instead of blocking its event loop on each one.
+    Pooled like get_db_engine(). Meant for reads and single-statement writes (the default isolation level autocommits):
+    connections aren't discarded on checkin, so don't leave temp tables or session settings on them."""
+    key = (local, schema, isolation_level)
+    if key not in _ASYNC_DB_ENGINES:  # no lock needed: engines are only created on the event loop's thread
+        _ASYNC_DB_ENGINES[key] = create_async_engine(
+            get_pg_connect_url(local, driver=ASYNC_DB_DRIVER),
+            isolation_level=isolation_level,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_POOL_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT_SECONDS,
+            pool_recycle=DB_POOL_RECYCLE_SECONDS,
+            pool_pre_ping=True,
+            connect_args={'server_settings': {'search_path': schema}} if schema else {})
+    return _ASYNC_DB_ENGINES[key]
+
+
+def get_async_db_connection(isolation_level='AUTOCOMMIT', schema: str = SCHEMA, local=False) -> AsyncConnection:
+    """Get async DB connection object, to use as `async with get_async_db_connection() as con:`
+
+    :param local: If True, connection is on local instead of production database.
+    """
+    return get_async_db_engine(isolation_level, schema, local).connect()
+
 
-    return engine.connect()
+async def dispose_async_db_engines():
+    """Close the pooled connections of every async engine and forget the engines, e.g. when the app shuts down"""
+    engines = list(_ASYNC_DB_ENGINES.values())
+    _ASYNC_DB_ENGINES.clear()
+    for engine in engines:
+        await engine.dispose()
 
 
 def chunk_list(input_list: List, chunk_size) -> List[List]:
@@ -353,6 +441,14 @@ def check_db_status_var(key: str,  local=False):
         return results[0] if results else None
 
 
+async def check_db_status_var_async(key: str, local=False):
+    """Like check_db_status_var(), without blocking the event loop"""
+    async with get_async_db_connection(schema='', local=local) as con:
+        results: List = await sql_query_single_col_async(
+            con, 'SELECT value FROM public.manage WHERE key = :key;', {'key': key})
+        return results[0] if results else None
+
+
 def delete_db_status_var(key: str, local=False):
     """Delete information from the `manage` table """
     with get_db_connection(schema='', local=local) as con2:
@@ -489,6 +585,12 @@ def run_sql(con: Connection, query: str, params: Dict[str, Any] = {}) -> CursorR
     return con.execute(query, params) if params else con.execute(query)
 
 
+async def run_sql_async(con: AsyncConnection, query: str, params: Dict[str, Any] = {}) -> CursorResult:
+    """Like run_sql(), on an async connection"""
+    query = text(query) if not isinstance(query, TextClause) else query
+    return await (con.execute(query, params) if params else con.execute(query))
+
+
 def sql_handle_none_to_null(query: str, params: Dict[str, Any], table: str, schema=SCHEMA) -> str:
     """Convert None to NULL for certain fields.
 
@@ -498,20 +600,16 @@ def sql_handle_none_to_null(query: str, params: Dict[str, Any], table: str, sche
     # Find numeric fields
     field_data_types: Dict[str, str] = get_field_data_types(table, schema)
     numeric_fields: Set[str] = set([k for k, v in field_data_types.items() if v in PG_DATATYPES_BY_GROUP['numeric']])
-    # Figure out which fields need replacement
-    fields_with_none: List[str] = [k for k, v in params.items() if v is None]
-    # todo: this is really inefficient: O(n^2)
-    numeric_fields_with_none: List[str] = []
-    for fld1 in fields_with_none:
-        for fld2 in numeric_fields:
-            if fld1.startswith(fld2):
-                numeric_fields_with_none.append(fld2)
-                # numeric_fields.remove(fld2)  # would be performance optimization; but causes set size change err
+    # Figure out which fields need replacement: params are named <field><row number>, so look up each prefix of the
+    # names of params that are None, rather than comparing every one of them with every numeric field
+    fields_with_none: Set[str] = set([k for k, v in params.items() if v is None])
+    numeric_fields_with_none: Set[str] = set(
+        [fld[:i] for fld in fields_with_none for i in range(1, len(fld) + 1) if fld[:i] in numeric_fields])
     # Make replacements
     query2 = query
     for fld in numeric_fields_with_none:
-        query2 = query2.replace(f'"{fld}" = v.{fld}',
-            f'"{fld}" = CASE WHEN v.{fld}::text = \'None\' THEN NULL ELSE v.{fld}::double precision END')
+        query2 = query2.replace(f'"{fld}" = v."{fld}"',
+            f'"{fld}" = CASE WHEN v."{fld}"::text = \'None\' THEN NULL ELSE v."{fld}"::double precision END')
     return query2
 
 
@@ -569,6 +667,33 @@ def sql_query_single_col(*argv) -> List:
     return [r[0] for r in results]
 
 
+async def sql_query_async(
+    con: AsyncConnection, query: Union[text, str], params: Dict = {}, debug: bool = DEBUG, return_with_keys=True
+) -> Union[List[RowMapping], List[List[Any]]]:
+    """Like sql_query(), on an async connection"""
+    try:
+        query = text(query) if not isinstance(query, TextClause) else query
+        q: CursorResult = await (con.execute(query, params) if params else con.execute(query))
+        if debug:
+            print(f'{query}\n{json.dumps(params, indent=2)}')
+        if return_with_keys:
+            # noinspection PyTypeChecker
+            results: List[RowMapping] = q.mappings().all()  # Key value pairs
+            return results
+        # noinspection PyTypeChecker
+        results: List[Row] = q.fetchall()  # Row tuples, with additional properties
+        return [list(x) for x in results]
+    except (ProgrammingError, OperationalError) as err:
+        raise RuntimeError(
+            f'Got an error [{err}] executing the following statement:\n{query}, {json.dumps(params, indent=2)}')
+
+
+async def sql_query_single_col_async(*argv) -> List:
+    """Run SQL query on single column, on an async connection"""
+    results: List = await sql_query_async(*argv, return_with_keys=False)
+    return [r[0] for r in results]
+
+
 # todo: consider adding 'schema' param
 def delete_obj_by_composite_key(con, table: str, key_ids: Dict[str, Union[str, int]]):
     """Delete object by ID"""
@@ -650,21 +775,35 @@ def fix_jagged_rows(rows: List[Dict]) -> List[Dict]:
 
 
 def update_from_dicts(con: Connection, table: str, rows: List[Dict]):
-    """Update rows in table from a list of dictionaries"""
-    pk: str = pkey(table)
-    rows = fix_jagged_rows(rows)
+    """Update rows in table from a list of dictionaries, matching them on the table's primary key, per pkey()
+
+    Batches of COPY_MIN_ROWS or more are copied into a staging table typed like the table, and applied with one
+    UPDATE ... FROM join on it. Smaller ones are joined on a VALUES list."""
+    if not rows:
+        return
+    pk_fields: List[str] = pkey_fields(table)
+    if not pk_fields:
+        raise ValueError(f'Can\'t update {table} from dicts: it has no primary key to match rows on. See pkey().')
+    fields: List[str] = list(dict.fromkeys(k for row in rows for k in row.keys()))
+    updates = ', '.join(f'"{x}" = v."{x}"' for x in fields if x not in pk_fields)
+    if not updates:
+        return
+    matches_key = ' AND '.join(f't."{x}" = v."{x}"' for x in pk_fields)
+    if len(rows) >= COPY_MIN_ROWS:
+        with copy_to_staging(con, table, last_row_per_key(rows, pk_fields), fields) as staging:
+            run_sql(con, f'UPDATE {table} t SET {updates} FROM {staging} v WHERE {matches_key};')
+        return
+    rows = [{x: row.get(x, None) for x in fields} for row in rows]  # same fields, in the same order, for VALUES
     # todo: fully use parameterized queries to prevent SQL injection
     key_vals: Dict[str, Any] = key_vals_for_sqlalchemy_query(rows)
     values: str = value_str_for_sqlalchemy_query(rows)
-    fields: str = ', '.join([f'"{x}"' for x in rows[0].keys()])
-    field_set_str: str= ', '.join([f'"{x}" = v.{x}' for x in [x for x in rows[0].keys() if x != pk]])
     statement = f"""
-        UPDATE {table}
-        SET {field_set_str}
+        UPDATE {table} t
+        SET {updates}
         FROM (VALUES
             {values}
-        ) AS v({fields})
-        WHERE {table}.{pk} = v.{pk};"""
+        ) AS v({', '.join(f'"{x}"' for x in fields)})
+        WHERE {matches_key};"""
     run_sql_update(con, statement, key_vals, handle_none_as_null_on_table=table)
 
 
@@ -677,47 +816,440 @@ def value_str_for_sqlalchemy_query(rows: List[Dict]) -> str:
     """Get a string of values for a non-idempotent SQL query."""
     return  ', '.join([f"({', '.join([':' + str(k) + str(i) for k in d.keys()])})" for i, d in enumerate(rows)])
 
-def insert_from_dicts(con: Connection, table: str, rows: List[Dict], skip_if_already_exists=True):
-    """Insert rows into table from a list of dictionaries"""
-    pk: str = pkey(table)
-    if skip_if_already_exists:
-        if pk and isinstance(pk, str):  # normal, single primary key
-            already_in_db: List[Dict] = get_objs_by_id(con, table, pk, [row[pk] for row in rows])
-            already_in_db_ids = set([row[pk] for row in already_in_db])
-            rows = [row for row in rows if row[pk] not in already_in_db_ids]
-        elif pk and isinstance(pk, list):  # composite key
-            already_in_db: List[Dict] = get_objs_by_composite_key(con, table, pk, rows)
-            already_in_db_ids = [[row[pk_n] for pk_n in pk] for row in already_in_db]
-            rows = [row for row in rows if [row[pk_n] for pk_n in pk] not in already_in_db_ids]
-    if rows:
-        rows = fix_jagged_rows(rows)
-        # todo: fully use parameterized queries to prevent SQL injection
-        key_vals: Dict[str, Any] = key_vals_for_sqlalchemy_query(rows)
-        values: str = value_str_for_sqlalchemy_query(rows)
-        statement = f"""INSERT INTO {table} ({', '.join([f'"{x}"' for x in rows[0].keys()])}) VALUES {values}"""
-        run_sql(con, statement, key_vals)
-
-
-def insert_from_dict(con: Connection, table: str, d: Union[Dict, List[Dict]], skip_if_already_exists=True):
-    """Insert row into table from a dictionary"""
+def insert_from_dicts(
+    con: Connection, table: str, rows: List[Dict], skip_if_already_exists=True, update_if_already_exists=False
+):
+    """Insert rows into table from a list of dictionaries
+
+    :param skip_if_already_exists: Skip rows whose primary key, per pkey(), is already in the table
+    :param update_if_already_exists: Instead of skipping them, update those rows with the new values
+    Either is done by Postgres as part of the insert: with `ON CONFLICT` if the table has a unique index on the key,
+    otherwise with `NOT EXISTS`. Batches of COPY_MIN_ROWS or more go through copy_from_dicts(), instead of one big
+    INSERT ... VALUES."""
+    if not rows:
+        return
+    if len(rows) >= COPY_MIN_ROWS:
+        return copy_from_dicts(con, table, rows, skip_if_already_exists, update_if_already_exists)
+    rows = fix_jagged_rows(rows)
+    fields: List[str] = list(rows[0].keys())
+    pk_fields: List[str] = pkey_fields(table) if skip_if_already_exists or update_if_already_exists else []
+    pk_fields = pk_fields if all(x in fields for x in pk_fields) else []
+    target: Union[str, None] = conflict_target(con, table, pk_fields) if pk_fields else None
+    if pk_fields and not target:
+        return _merge_values(con, table, rows, fields, pk_fields, update_if_already_exists)
+    on_conflict = ''
+    if target:
+        if update_if_already_exists:
+            rows = last_row_per_key(rows, pk_fields)
+        on_conflict = on_conflict_clause(target, pk_fields, fields, update_if_already_exists)
+    rows = [{x: row.get(x, None) for x in fields} for row in rows]  # same fields, in the same order, for VALUES
+    # todo: fully use parameterized queries to prevent SQL injection
+    key_vals: Dict[str, Any] = key_vals_for_sqlalchemy_query(rows)
+    values: str = value_str_for_sqlalchemy_query(rows)
+    statement = f"""INSERT INTO {table} ({', '.join([f'"{x}"' for x in fields])}) VALUES {values} {on_conflict}"""
+    run_sql(con, statement, key_vals)
+
+
+def _merge_values(
+    con: Connection, table: str, rows: List[Dict], fields: List[str], pk_fields: List[str], update=False
+):
+    """Insert rows whose key isn't in the table yet, and with `update`, update the rest, joining on a VALUES list
+
+    For a table with no unique index on its key, so no `ON CONFLICT`. The values are cast to the table's column types,
+    since unlike in INSERT ... VALUES, Postgres doesn't take them from the table."""
+    if update:
+        rows = last_row_per_key(rows, pk_fields)
+    types: Dict[str, str] = column_types(con, table)
+    cols = ', '.join(f'"{x}"' for x in fields)
+    values = ', '.join(
+        '(' + ', '.join(f'CAST(:{x}{i} AS {types[x]})' for x in fields) + ')' for i in range(len(rows)))
+    source = f'(VALUES {values}) AS v({cols})'
+    key_vals: Dict[str, Any] = {f'{x}{i}': row.get(x, None) for i, row in enumerate(rows) for x in fields}
+    matches_key = ' AND '.join(f't."{x}" = v."{x}"' for x in pk_fields)
+    updates = ', '.join(f'"{x}" = v."{x}"' for x in fields if x not in pk_fields)
+    if update and updates:
+        run_sql(con, f'UPDATE {table} t SET {updates} FROM {source} WHERE {matches_key};', key_vals)
+    run_sql(con, f'INSERT INTO {table} ({cols}) SELECT {cols} FROM {source} '
+                 f'WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE {matches_key});', key_vals)
+
+
+def copy_from_dicts(
+    con: Connection, table: str, rows: List[Dict], skip_if_already_exists=True, update_if_already_exists=False
+):
+    """Bulk insert rows into table from dictionaries, by streaming them with `COPY ... FROM STDIN` into a temp staging
+    table, then inserting from that into the table
+
+    Rows are encoded as COPY reads them, so memory use doesn't grow with the size of the batch beyond the rows
+    themselves, and there is no SQL string or bind parameter per value.
+    :param rows: Fields missing from some rows are NULL in those, as in fix_jagged_rows().
+    :param skip_if_already_exists: Skip rows whose primary key, per pkey(), is already in the table. Done in the merge
+     into the table, rather than by querying for the keys first: with `ON CONFLICT` if the table has a unique index on
+     the key, otherwise with `NOT EXISTS`.
+    :param update_if_already_exists: Instead of skipping them, update those rows with the new values"""
+    if not rows:
+        return
+    fields: List[str] = list(dict.fromkeys(k for row in rows for k in row.keys()))
+    pk_fields: List[str] = pkey_fields(table) if skip_if_already_exists or update_if_already_exists else []
+    pk_fields = pk_fields if all(x in fields for x in pk_fields) else []
+    if pk_fields and update_if_already_exists:
+        rows = last_row_per_key(rows, pk_fields)
+    cols = ', '.join(f'"{x}"' for x in fields)
+    with copy_to_staging(con, table, rows, fields) as staging:
+        insert = f'INSERT INTO {table} ({cols}) SELECT {cols} FROM {staging} s'
+        target: Union[str, None] = conflict_target(con, table, pk_fields) if pk_fields else None
+        if target:
+            run_sql(con, f'{insert} {on_conflict_clause(target, pk_fields, fields, update_if_already_exists)};')
+        elif pk_fields:
+            matches_key = ' AND '.join(f't."{x}" = s."{x}"' for x in pk_fields)
+            updates = ', '.join(f'"{x}" = s."{x}"' for x in fields if x not in pk_fields)
+            if update_if_already_exists and updates:
+                run_sql(con, f'UPDATE {table} t SET {updates} FROM {staging} s WHERE {matches_key};')
+            run_sql(con, f'{insert} WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE {matches_key});')
+        else:
+            run_sql(con, f'{insert};')
+
+
+@contextmanager
+def copy_to_staging(con: Connection, table: str, rows: List[Dict], fields: List[str]) -> Iterator[str]:
+    """Temp table of rows, with the given columns of the table, filled with `COPY ... FROM STDIN`. Dropped on exit.
+
+    Its columns have the same types as the table's, but none of its constraints, indexes, or triggers.
+    :returns: The temp table's name"""
+    cols = ', '.join(f'"{x}"' for x in fields)
+    staging = f'_copy_staging_{table.split(".")[-1]}'
+    run_sql(con, f'DROP TABLE IF EXISTS pg_temp.{staging};')
+    run_sql(con, f'CREATE TEMP TABLE {staging} AS SELECT {cols} FROM {table} WITH NO DATA;')
+    try:
+        cursor = con.connection.cursor()
+        try:
+            cursor.copy_expert(f'COPY {staging} ({cols}) FROM STDIN', CopyTextWriter(rows, fields))
+        finally:
+            cursor.close()
+        yield staging
+    finally:
+        run_sql(con, f'DROP TABLE IF EXISTS pg_temp.{staging};')
+
+
+def pkey_fields(table: str) -> List[str]:
+    """Primary key fields of a table, per pkey(). Empty if it has none."""
+    pk: Union[str, List[str], None] = pkey(table)
+    return [pk] if isinstance(pk, str) and pk else list(pk or [])
+
+
+def unique_keys(con: Connection, table: str) -> List[Set[str]]:
+    """Column sets of the table's primary key and other unique indexes, not counting partial ones
+
+    Cached per engine, each of which is for one schema (see get_db_engine()), until tables change. See
+    expire_table_metadata()."""
+    expire_table_metadata(con.engine)
+    cache_key = (con.engine, table)
+    if cache_key not in _UNIQUE_KEYS_CACHE:
+        results: List[List] = sql_query(con, """
+            SELECT array_agg(a.attname::text)
+            FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+            WHERE i.indrelid = to_regclass(:table) AND i.indisunique AND i.indpred IS NULL
+            GROUP BY i.indexrelid;""", {'table': table}, return_with_keys=False)
+        _UNIQUE_KEYS_CACHE[cache_key] = [set(row[0]) for row in results]
+    return _UNIQUE_KEYS_CACHE[cache_key]
+
+
+def column_types(con: Connection, table: str) -> Dict[str, str]:
+    """SQL type of each column of the table, e.g. 'character varying(255)' or 'integer[]', for casting to
+
+    Cached like unique_keys(). Don't modify the result; it's shared."""
+    expire_table_metadata(con.engine)
+    cache_key = (con.engine, table)
+    if cache_key not in _COLUMN_TYPES_CACHE:
+        results: List[List] = sql_query(con, """
+            SELECT a.attname::text, format_type(a.atttypid, a.atttypmod)
+            FROM pg_attribute a
+            WHERE a.attrelid = to_regclass(:table) AND a.attnum > 0 AND NOT a.attisdropped;""", {'table': table},
+            return_with_keys=False)
+        _COLUMN_TYPES_CACHE[cache_key] = {row[0]: row[1] for row in results}
+    return _COLUMN_TYPES_CACHE[cache_key]
+
+
+def clear_table_metadata_cache(con: Connection = None):
+    """Forget cached table metadata, after DDL may have changed tables
+
+    :param con: Connection that ran the DDL. If given, the change is recorded in the `manage` table in the same
+     transaction, so that other processes forget theirs too."""
+    _UNIQUE_KEYS_CACHE.clear()
+    _COLUMN_TYPES_CACHE.clear()
+    _FIELD_DATA_TYPES_CACHE.clear()
+    if con is not None:
+        run_sql(con, 'DELETE FROM public.manage WHERE key = :key;', {'key': TABLE_METADATA_STATUS_VAR})
+        run_sql(con, 'INSERT INTO public.manage (key, value) VALUES (:key, :val);',
+                {'key': TABLE_METADATA_STATUS_VAR, 'val': current_datetime()})
+
+
+def expire_table_metadata(engine: Engine):
+    """Forget cached table metadata if any process has changed tables in the engine's database since it was cached
+
+    Reads TABLE_METADATA_STATUS_VAR, on a connection of its own, at most every TABLE_METADATA_CHECK_SECONDS."""
+    db = (engine.url.host, engine.url.database)
+    checked_at, last_change = _TABLE_METADATA_CHECKED.get(db, (0.0, None))
+    if time.time() - checked_at < TABLE_METADATA_CHECK_SECONDS:
+        return
+    with engine.connect() as con:
+        results: List = sql_query_single_col(
+            con, 'SELECT value FROM public.manage WHERE key = :key;', {'key': TABLE_METADATA_STATUS_VAR})
+    latest: Union[str, None] = results[0] if results else None
+    if db in _TABLE_METADATA_CHECKED and latest != last_change:
+        _UNIQUE_KEYS_CACHE.clear()
+        _COLUMN_TYPES_CACHE.clear()
+        _FIELD_DATA_TYPES_CACHE.clear()
+    _TABLE_METADATA_CHECKED[db] = (time.time(), latest)
+
+
+def conflict_target(con: Connection, table: str, key_fields: List[str]) -> Union[str, None]:
+    """`ON CONFLICT` target for these key fields, if a unique index of the table is on exactly them, else None"""
+    if set(key_fields) not in unique_keys(con, table):
+        return None
+    return '(' + ', '.join(f'"{x}"' for x in key_fields) + ')'
+
+
+def on_conflict_clause(target: str, key_fields: List[str], fields: List[str], update=False) -> str:
+    """`ON CONFLICT` clause that skips rows already in the table or, with `update`, updates them"""
+    updates = ', '.join(f'"{x}" = EXCLUDED."{x}"' for x in fields if x not in key_fields)
+    if update and updates:
+        return f'ON CONFLICT {target} DO UPDATE SET {updates}'
+    return f'ON CONFLICT {target} DO NOTHING'
+
+
+def last_row_per_key(rows: List[Dict], key_fields: List[str]) -> List[Dict]:
+    """Drop rows whose key is repeated later in the list, since one statement can't update the same row twice"""
+    return list({tuple(row.get(x) for x in key_fields): row for row in rows}.values())
+
+
+def insert_from_dict(
+    con: Connection, table: str, d: Union[Dict, List[Dict]], skip_if_already_exists=True,
+    update_if_already_exists=False
+):
+    """Insert row into table from a dictionary. See insert_from_dicts()."""
     if isinstance(d, list):
-        return insert_from_dicts(con, table, d, skip_if_already_exists)
-    if skip_if_already_exists:  # todo: simplify logic as in insert_from_dicts()
-        pk: str = pkey(table)
-        if pk:
-            already_in_db = []
-            if isinstance(pk, str):  # normal, single primary key
-                already_in_db: List[List] = get_obj_by_id(con, table, pk, d[pk])
-            elif isinstance(pk, list):  # composite key
-                already_in_db: List[RowMapping] = get_obj_by_composite_key(con, table, pk, d)
-            if already_in_db:
-                return
-    query = f"""
-    INSERT INTO {table} ({', '.join([f'"{x}"' for x in d.keys()])})
-    VALUES ({', '.join([':' + str(k) for k in d.keys()])})"""
+        return insert_from_dicts(con, table, d, skip_if_already_exists, update_if_already_exists)
+    fields = ', '.join([f'"{x}"' for x in d.keys()])
+    values = ', '.join([':' + str(k) for k in d.keys()])
+    pk_fields: List[str] = pkey_fields(table) if skip_if_already_exists or update_if_already_exists else []
+    pk_fields = pk_fields if all(x in d for x in pk_fields) else []
+    target: Union[str, None] = conflict_target(con, table, pk_fields) if pk_fields else None
+    if target:
+        on_conflict = on_conflict_clause(target, pk_fields, list(d.keys()), update_if_already_exists)
+        query = f'INSERT INTO {table} ({fields}) VALUES ({values}) {on_conflict}'
+    elif pk_fields and update_if_already_exists:
+        return insert_from_dicts(con, table, [d], skip_if_already_exists, update_if_already_exists)
+    elif pk_fields:
+        # INSERT ... SELECT (unlike a VALUES subquery) still gives untyped literals the column types of the table
+        matches_key = ' AND '.join(f't."{x}" = :{x}' for x in pk_fields)
+        query = f'INSERT INTO {table} ({fields}) SELECT {values} WHERE NOT EXISTS ' \
+                f'(SELECT 1 FROM {table} t WHERE {matches_key})'
+    else:
+        query = f'INSERT INTO {table} ({fields}) VALUES ({values})'
     run_sql(con, query, d)
 
 
+async def insert_from_dict_async(con: AsyncConnection, table: str, d: Dict):
+    """Insert row into table from a dictionary, on an async connection. Unlike insert_from_dict(), doesn't check for
+    rows that already exist."""
+    fields = ', '.join([f'"{x}"' for x in d.keys()])
+    values = ', '.join([':' + str(k) for k in d.keys()])
+    await run_sql_async(con, f'INSERT INTO {table} ({fields}) VALUES ({values})', d)
+
+
+class CopyTextWriter:
+    """File-like source for `COPY ... FROM STDIN` (text format) of dictionaries, encoding rows as they are read
+
+    Pass an instance as the file to psycopg2's `cursor.copy_expert()`. None is NULL, bools are t/f, lists and tuples
+    are arrays, dicts are JSON, and anything else is its str()."""
+
+    def __init__(self, rows: Iterable[Dict], fields: List[str]):
+        self._lines: Iterator[bytes] = (
+            ('\t'.join([_copy_text_value(row.get(field)) for field in fields]) + '\n').encode('utf-8') for row in rows)
+        self._buffer = bytearray()
+
+    def read(self, size: int = -1) -> bytes:
+        """Next `size` bytes of COPY data, or the rest if size is negative. Empty once all rows are read."""
+        for line in self._lines:
+            self._buffer += line
+            if 0 <= size <= len(self._buffer):
+                break
+        size = len(self._buffer) if size < 0 else size
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def _copy_text_value(value: Any) -> str:
+    """A value as COPY text format: NULL is \\N, and backslashes, tabs, and line breaks are escaped"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, dict):
+        value = json.dumps(value)
+    elif isinstance(value, (list, tuple)):
+        value = '{' + ','.join(_array_element(x) for x in value) + '}'
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _array_element(value: Any) -> str:
+    """An element of a Postgres array literal, double-quoted so that commas, braces and spaces are kept"""
+    if value is None:
+        return 'NULL'
+    value = ('t' if value else 'f') if isinstance(value, bool) else str(value)
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class BinaryCopyIntReader:
+    """File-like sink for `COPY ... TO STDOUT (FORMAT binary)` of non-null integer columns, parsed into NumPy arrays
+
+    Pass an instance as the file to psycopg2's `cursor.copy_expert()`. Incoming bytes are buffered and parsed in large
+    blocks with a NumPy structured dtype, so there is no per-row Python object creation. Column widths (int2/int4/int8)
+    are taken from the first row. Arrays are preallocated to `expected_rows` and grown by doubling if needed.
+
+    :param progress: Called with the number of rows parsed so far, roughly every `progress_every` rows."""
+
+    def __init__(
+        self, n_cols: int, expected_rows: int = 0, progress: Callable[[int], None] = None,
+        progress_every: int = 1_000_000, block_size: int = 8 * 1024 * 1024
+    ):
+        self.n_cols = n_cols
+        self.progress = progress
+        self.progress_every = progress_every
+        self.block_size = block_size
+        self.n_rows = 0
+        self._buf = bytearray()
+        self._header_done = False
+        self._row_dtype: Union[np.dtype, None] = None
+        self._widths: List[int] = []
+        self._columns: List[np.ndarray] = []
+        self._capacity = max(int(expected_rows), 0)
+        self._next_progress = progress_every
+
+    def write(self, data: bytes) -> int:
+        """Called by the driver for each chunk of COPY output"""
+        self._buf += data
+        if len(self._buf) >= self.block_size:
+            self._parse()
+        return len(data)
+
+    def _parse(self):
+        """Parse as many complete rows as are in the buffer"""
+        buf = self._buf
+        if not self._header_done:
+            if len(buf) < len(PG_BINARY_COPY_SIGNATURE) + 8:
+                return
+            if bytes(buf[:len(PG_BINARY_COPY_SIGNATURE)]) != PG_BINARY_COPY_SIGNATURE:
+                raise ValueError('Not PostgreSQL binary COPY output.')
+            ext_len = struct.unpack_from('>i', buf, len(PG_BINARY_COPY_SIGNATURE) + 4)[0]
+            header_len = len(PG_BINARY_COPY_SIGNATURE) + 8 + ext_len
+            if len(buf) < header_len:
+                return
+            del buf[:header_len]
+            self._header_done = True
+        if self._row_dtype is None:
+            if not self._init_row_dtype():
+                return
+        row_size = self._row_dtype.itemsize
+        n = len(buf) // row_size
+        if not n:
+            return
+        rows = np.frombuffer(buf, dtype=self._row_dtype, count=n)  # a view; must be released before `del buf[...]`
+        # A trailer (-1 field count) can only be at the very end; anything else that doesn't match is malformed
+        bad = (rows['n'] != self.n_cols)
+        for i, width in enumerate(self._widths):
+            bad |= rows[f'len{i}'] != width
+        if bad.any():
+            raise ValueError(
+                f'Unexpected row in binary COPY output (row {self.n_rows + int(np.argmax(bad))}). Only non-null integer '
+                f'columns of a fixed width are supported.')
+        self._ensure_capacity(self.n_rows + n)
+        for i, col in enumerate(self._columns):
+            col[self.n_rows:self.n_rows + n] = rows[f'val{i}']
+        del rows
+        del buf[:n * row_size]
+        self.n_rows += n
+        if self.progress and self.n_rows >= self._next_progress:
+            self.progress(self.n_rows)
+            self._next_progress = (self.n_rows // self.progress_every + 1) * self.progress_every
+
+    def _init_row_dtype(self) -> bool:
+        """Work out column widths from the first row"""
+        buf = self._buf
+        if len(buf) < 2:
+            return False
+        n_fields = struct.unpack_from('>h', buf, 0)[0]
+        if n_fields == -1:  # no rows at all
+            self._widths = [8] * self.n_cols
+        elif n_fields != self.n_cols:
+            raise ValueError(f'Expected {self.n_cols} columns in binary COPY output, got {n_fields}.')
+        else:
+            pos = 2
+            widths = []
+            for _ in range(self.n_cols):
+                if len(buf) < pos + 4:
+                    return False
+                width = struct.unpack_from('>i', buf, pos)[0]
+                if width not in (2, 4, 8):
+                    raise ValueError(f'Only non-null int2/int4/int8 columns are supported, got a field of {width} bytes.')
+                widths.append(width)
+                pos += 4 + width
+            self._widths = widths
+        fields = [('n', '>i2')]
+        for i, width in enumerate(self._widths):
+            fields += [(f'len{i}', '>i4'), (f'val{i}', f'>i{width}')]
+        self._row_dtype = np.dtype(fields)
+        self._columns = [np.empty(self._capacity, dtype=np.int64) for _ in range(self.n_cols)]
+        return True
+
+    def _ensure_capacity(self, n: int):
+        """Grow column arrays to hold at least n rows"""
+        if n <= self._capacity:
+            return
+        self._capacity = max(n, self._capacity * 2)
+        self._columns = [np.resize(col, self._capacity) for col in self._columns]
+
+    def result(self) -> List[np.ndarray]:
+        """Finish parsing, and return one int64 array per column"""
+        self._parse()
+        if not self._header_done:
+            raise ValueError('Binary COPY output ended before its header.')
+        if bytes(self._buf) not in (b'', b'\xff\xff'):
+            raise ValueError(f'Binary COPY output ended with {len(self._buf)} unparsed bytes.')
+        self._buf = bytearray()
+        if self._row_dtype is None:
+            return [np.empty(0, dtype=np.int64) for _ in range(self.n_cols)]
+        return [col[:self.n_rows] for col in self._columns]
+
+
+def copy_int_columns(
+    con: Connection, query: str, n_cols: int, expected_rows: int = 0, progress: Callable[[int], None] = None
+) -> List[np.ndarray]:
+    """Stream the integer columns of a table or query into NumPy arrays using binary COPY
+
+    Much faster than going through SQLAlchemy rows for millions of rows: no per-row Python objects are created.
+    :param query: A table name, or a SELECT wrapped in parentheses."""
+    reader = BinaryCopyIntReader(n_cols, expected_rows, progress)
+    cursor = con.connection.cursor()
+    try:
+        cursor.copy_expert(f'COPY {query} TO STDOUT (FORMAT binary)', reader)
+    finally:
+        cursor.close()
+    return reader.result()
+
+
+def estimated_row_count(con: Connection, table: str) -> int:
+    """Row count estimate from the planner's statistics. Instant, unlike COUNT(*), but can be off or -1 if unknown."""
+    results: List[List] = sql_query(
+        con, 'SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table);', {'table': table},
+        return_with_keys=False)
+    return int(results[0][0]) if results and results[0][0] is not None else -1
+
+
 def sql_count(con: Connection, table: str) -> int:
     """Return the number of rows in a table. A simple count of rows, not ignoring NULLs or duplicates."""
     query = f'SELECT COUNT(*) FROM {table};'
@@ -864,13 +1396,18 @@ def load_csv(
 
 
 def get_field_data_types(table: str, schema=SCHEMA) -> Dict[str, str]:
-    """Get data types for each field in the table"""
-    with get_db_connection(schema='') as con:
-        field_data_types: List[Dict[str, str]] = [dict(x) for x in sql_query(con, f"""
-            SELECT column_name,  data_type FROM information_schema.columns 
-            WHERE table_schema = '{schema}' AND table_name = '{table}';""")]
-        field_data_types: Dict[str, str] = {x['column_name']: x['data_type'] for x in field_data_types}
-    return field_data_types
+    """Get data types for each field in the table
+
+    Cached per (schema, table) until tables change; see expire_table_metadata(). Don't modify the result; it's
+    shared."""
+    expire_table_metadata(get_db_engine(schema=''))
+    if (schema, table) not in _FIELD_DATA_TYPES_CACHE:
+        with get_db_connection(schema='') as con:
+            field_data_types: List[Dict[str, str]] = [dict(x) for x in sql_query(con, f"""
+                SELECT column_name,  data_type FROM information_schema.columns 
+                WHERE table_schema = '{schema}' AND table_name = '{table}';""")]
+        _FIELD_DATA_TYPES_CACHE[(schema, table)] = {x['column_name']: x['data_type'] for x in field_data_types}
+    return _FIELD_DATA_TYPES_CACHE[(schema, table)]
 
 
 def list_tables(con: Connection = None, schema: str = None, filter_temp_refresh_tables=False) -> List[str]:
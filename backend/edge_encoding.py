@@ -0,0 +1,141 @@
+"""Compact binary encoding of graph edges, for clients that ask for it with `Accept: application/vnd.termhub.edges`
+
+JSON edges are `[source, target]` pairs of full concept ids, around 20 bytes per edge before gzip. Here edges are sorted
+and grouped by source, and every number is a delta from the previous one, written as an unsigned LEB128 varint (7 bits
+per byte, high bit set on all but the last byte). Sorted concept ids are close together, so most deltas take 1-3 bytes.
+
+Edge block layout, all varints:
+  n_sources, n_edges
+  n_sources source deltas: distinct sources, ascending, each minus the previous (the first minus 0)
+  n_sources out-degrees: how many edges each source has
+  n_edges target deltas: within each source, targets ascending, each minus the previous (the first minus 0)
+
+A response is `MAGIC`, then for /concept-graph, a varint length and that many bytes of UTF-8 JSON with everything in
+the response but the edges, then the edge block.
+"""
+import json
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+EDGES_MEDIA_TYPE = 'application/vnd.termhub.edges'
+MAGIC = b'THE\x01'  # format version 1
+
+
+class EdgeEncodingError(ValueError):
+    """Data is not a valid edge encoding"""
+
+
+def encode_varints(values: np.ndarray) -> np.ndarray:
+    """Unsigned LEB128 encoding of non-negative integers, vectorized: one pass per byte of the longest varint"""
+    values = np.asarray(values, dtype=np.uint64)
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        n_bytes += values >= np.uint64(1 << (7 * k))
+    ends = np.cumsum(n_bytes)
+    starts = ends - n_bytes
+    out = np.empty(int(ends[-1]) if len(values) else 0, dtype=np.uint8)
+    for k in range(int(n_bytes.max()) if len(values) else 0):
+        has_byte = n_bytes > k
+        septet = (values[has_byte] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        more = (n_bytes[has_byte] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[has_byte] + k] = septet | more
+    return out
+
+
+def decode_varints(data: np.ndarray) -> np.ndarray:
+    """Inverse of encode_varints()"""
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.empty(0, dtype=np.uint64)
+    is_last = data < 0x80
+    if not is_last[-1]:
+        raise EdgeEncodingError('Truncated varint')
+    ends = np.flatnonzero(is_last) + 1
+    starts = np.r_[0, ends[:-1]]
+    position = np.arange(len(data)) - np.repeat(starts, ends - starts)
+    if position.max() > 9:
+        raise EdgeEncodingError('Varint too long')
+    septets = (data & 0x7f).astype(np.uint64) << (np.uint64(7) * position.astype(np.uint64))
+    return np.add.reduceat(septets, starts)
+
+
+def encode_edges(sources: np.ndarray, targets: np.ndarray) -> bytes:
+    """Edge block for parallel arrays of non-negative source and target ids"""
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    if (len(sources) and sources.min() < 0) or (len(targets) and targets.min() < 0):
+        raise ValueError('Edge ids must be non-negative')
+    order = np.lexsort((targets, sources))
+    sources, targets = sources[order], targets[order]
+    distinct, counts = np.unique(sources, return_counts=True)
+    group_start = np.r_[True, sources[1:] != sources[:-1]] if len(sources) else np.empty(0, dtype=bool)
+    target_deltas = np.diff(targets, prepend=0)
+    target_deltas[group_start] = targets[group_start]
+    return encode_varints(np.concatenate([
+        [len(distinct), len(sources)], np.diff(distinct, prepend=0), counts, target_deltas])).tobytes()
+
+
+def decode_edges(data: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    """Inverse of encode_edges(): (sources, targets), sorted by source, then target"""
+    values = decode_varints(np.frombuffer(data, dtype=np.uint8)).astype(np.int64)
+    if len(values) < 2:
+        raise EdgeEncodingError('Missing edge block header')
+    n_sources, n_edges = int(values[0]), int(values[1])
+    if len(values) != 2 + 2 * n_sources + n_edges:
+        raise EdgeEncodingError(f'Expected {2 + 2 * n_sources + n_edges} varints, got {len(values)}')
+    distinct = np.cumsum(values[2:2 + n_sources])
+    counts = values[2 + n_sources:2 + 2 * n_sources]
+    target_deltas = values[2 + 2 * n_sources:]
+    if counts.sum() != n_edges:
+        raise EdgeEncodingError('Out-degrees do not add up to the number of edges')
+    # Cumulative sum within each source's group of targets
+    group_starts = np.cumsum(counts) - counts
+    running = np.cumsum(target_deltas)
+    offset = np.repeat(running[group_starts] - target_deltas[group_starts], counts)
+    return np.repeat(distinct, counts), running - offset
+
+
+def encode_response(sources: np.ndarray, targets: np.ndarray, rest: Optional[Dict[str, Any]] = None) -> bytes:
+    """A full binary response: edges, and optionally the other (JSON-able; sets are allowed) fields of a response"""
+    parts = [MAGIC]
+    if rest is not None:
+        rest_json = json.dumps(rest, default=sorted).encode('utf-8')
+        parts += [encode_varints(np.array([len(rest_json)])).tobytes(), rest_json]
+    parts.append(encode_edges(sources, targets))
+    return b''.join(parts)
+
+
+def decode_response(data: bytes, has_rest=True) -> Tuple[np.ndarray, np.ndarray, Optional[Dict[str, Any]]]:
+    """Inverse of encode_response(): (sources, targets, rest)"""
+    if not data.startswith(MAGIC):
+        raise EdgeEncodingError('Not an edge encoding, or an unsupported version')
+    data = data[len(MAGIC):]
+    rest = None
+    if has_rest:
+        buf = np.frombuffer(data, dtype=np.uint8)
+        length_end = int(np.argmax(buf < 0x80)) + 1
+        length = int(decode_varints(buf[:length_end])[0])
+        rest = json.loads(data[length_end:length_end + length].decode('utf-8'))
+        data = data[length_end + length:]
+    sources, targets = decode_edges(data)
+    return sources, targets, rest
+
+
+def accepts_binary_edges(accept: Optional[str]) -> bool:
+    """Does an Accept header ask for EDGES_MEDIA_TYPE at least as much as anything else?"""
+    quality: Dict[str, float] = {}
+    for media_range in (accept or '').split(','):
+        media_type, *params = [x.strip() for x in media_range.split(';')]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if media_type:
+            quality[media_type.lower()] = q
+    edges_q = quality.get(EDGES_MEDIA_TYPE, 0.0)
+    return edges_q > 0 and all(edges_q >= q for q in quality.values())
@@ -0,0 +1,191 @@
+"""Precompressed /wholegraph payloads, built once per graph version and served as static files
+
+Every edge of the hierarchy is a big response that only changes on a vocab refresh, so rather than serializing and
+gzipping it on every request, each representation (JSON, or the binary edge encoding) is written to disk already
+compressed, with gzip and, if the `zstandard` package is installed, zstd. Requests get the file as is, with a strong
+ETag for the graph version, representation and encoding, so browsers revalidate with `If-None-Match` and get a 304,
+and interrupted downloads can resume with a Range request.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+
+from backend.csr_graph import CsrGraph
+from backend.edge_encoding import EDGES_MEDIA_TYPE, encode_response
+
+try:
+    import zstandard
+except ImportError:  # optional; gzip only
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock around building artifacts
+    fcntl = None
+
+REPRESENTATIONS: Dict[str, str] = {'json': 'application/json', 'edges': EDGES_MEDIA_TYPE}  # name: media type
+ENCODINGS: Dict[str, str] = {'zstd': '.zst', 'gzip': '.gz'}  # content-coding: file extension, in order of preference
+READ_CHUNK_BYTES = 1 << 20
+
+
+def available_encodings() -> List[str]:
+    """Content-codings that artifacts are built in"""
+    return [encoding for encoding in ENCODINGS if encoding != 'zstd' or zstandard is not None]
+
+
+def artifact_version(g: CsrGraph) -> str:
+    """Identifies the edges of `g`: the vocab refresh it was built from, or else when it was built"""
+    return str(g.meta.get('vocab_last_refreshed') or g.meta.get('created') or 'unversioned')
+
+
+def artifact_path(directory: str, version: str, representation: str, encoding: str) -> str:
+    """Where the artifact for a version, representation and encoding goes"""
+    return os.path.join(directory, f'wholegraph-{_version_hash(version)}.{representation}{ENCODINGS[encoding]}')
+
+
+def artifact_etag(version: str, representation: str, encoding: str) -> str:
+    """Strong ETag: different for every version, representation and encoding, since each is a different byte string"""
+    return f'"{_version_hash(version)}-{representation}-{encoding}"'
+
+
+def build_wholegraph_artifacts(g: CsrGraph, directory: str, remove_other_versions=True) -> List[str]:
+    """Write every representation and encoding of the whole graph for `g`'s version, unless they're already there
+
+    Files are written to a temporary name and renamed, so readers never see a partial file. Only one process builds at
+    a time; others wait and then find the files already there.
+    :param remove_other_versions: Delete artifacts of other versions. Workers still on an older graph fall back to
+     serializing it themselves until they swap in the new one.
+    :returns: Paths of the artifacts for this version"""
+    os.makedirs(directory, exist_ok=True)
+    version = artifact_version(g)
+    paths = {
+        (representation, encoding): artifact_path(directory, version, representation, encoding)
+        for representation in REPRESENTATIONS for encoding in available_encodings()}
+    with open(os.path.join(directory, 'wholegraph.lock'), 'w') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            missing = {key: path for key, path in paths.items() if not os.path.isfile(path)}
+            if missing:
+                sources, targets = g.edge_arrays()
+                bodies = {
+                    'json': json.dumps(
+                        list(zip(sources.tolist(), targets.tolist())), separators=(',', ':')).encode('utf-8'),
+                    'edges': encode_response(sources, targets)}
+                for (representation, encoding), path in missing.items():
+                    _write_atomic(path, _compress(bodies[representation], encoding))
+            current = set(paths.values())
+            for name in os.listdir(directory) if remove_other_versions else []:
+                path = os.path.join(directory, name)
+                if name.startswith('wholegraph-') and path not in current:
+                    os.remove(path)
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return list(paths.values())
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Most preferred content-coding of ours that the client accepts, or None"""
+    accepted = set()
+    for coding in (accept_encoding or '').split(','):
+        name, *params = [x.strip().lower() for x in coding.split(';')]
+        if not any(re.fullmatch(r'q=0(\.0*)?', p.replace(' ', '')) for p in params):
+            accepted.add(name)
+    for encoding in available_encodings():
+        if encoding in accepted or '*' in accepted:
+            return encoding
+    return None
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header matches `etag`, by weak comparison as the spec requires: `W/` prefixes are
+    ignored, and `*` matches anything"""
+    for tag in (if_none_match or '').split(','):
+        tag = tag.strip()
+        if tag == '*' or (tag[2:] if tag.startswith('W/') else tag) == etag:
+            return True
+    return False
+
+
+def parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """First and last byte of a single `bytes=` range, or None to send the whole file
+
+    Multiple ranges aren't supported; the whole file is sent instead, which the spec allows.
+    :raises HTTPException: 416 if the range is outside the file."""
+    match = re.fullmatch(r'\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*', range_header or '')
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:  # suffix range: the last N bytes
+        first, last = max(size - int(last), 0), size - 1
+    else:
+        first, last = int(first), min(int(last), size - 1) if last else size - 1
+    if first >= size or first > last:
+        raise HTTPException(status_code=416, headers={'Content-Range': f'bytes */{size}'})
+    return first, last
+
+
+def artifact_response(
+    request: Request, directory: str, version: str, representation: str, encoding: str
+) -> Response:
+    """Send an artifact, handling If-None-Match (304) and Range (206)
+
+    :raises FileNotFoundError: if the artifact hasn't been built"""
+    path = artifact_path(directory, version, representation, encoding)
+    etag = artifact_etag(version, representation, encoding)
+    headers = {
+        'ETag': etag, 'Content-Encoding': encoding, 'Accept-Ranges': 'bytes', 'Vary': 'Accept, Accept-Encoding',
+        'Cache-Control': 'no-cache'}  # may be stored, but revalidated, since the next vocab refresh changes it
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+    size = os.path.getsize(path)
+    byte_range = parse_range(request.headers.get('range'), size)
+    if_range = request.headers.get('if-range')
+    if byte_range is None or (if_range and if_range.strip() != etag):  # If-Range: resume only the same version
+        return StreamingResponse(
+            _read_file(path, 0, size - 1), media_type=REPRESENTATIONS[representation],
+            headers={**headers, 'Content-Length': str(size)})
+    first, last = byte_range
+    return StreamingResponse(
+        _read_file(path, first, last), status_code=206, media_type=REPRESENTATIONS[representation],
+        headers={**headers, 'Content-Length': str(last - first + 1), 'Content-Range': f'bytes {first}-{last}/{size}'})
+
+
+def _read_file(path: str, first: int, last: int) -> Iterator[bytes]:
+    """Bytes `first` through `last` of a file, in chunks"""
+    with open(path, 'rb') as f:
+        f.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = f.read(min(READ_CHUNK_BYTES, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    """Compress at a high level, since it's done once per version and then served many times"""
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=19).compress(body)
+    return gzip.compress(body, compresslevel=9, mtime=0)
+
+
+def _write_atomic(path: str, data: bytes):
+    """Write to a temporary file beside `path`, then rename it into place"""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _version_hash(version: str) -> str:
+    """Short, filename- and header-safe id for a version"""
+    return hashlib.sha256(version.encode('utf-8')).hexdigest()[:16]
@@ -0,0 +1,137 @@
+"""Weakly connected components of the concept hierarchy: which concepts are connected at all, ignoring edge direction
+
+Two concepts in different components have no path between them in either direction, and no common ancestor, so
+traversals between them (gap filling, shortest paths, lowest common ancestors) can be skipped outright.
+
+Components are labeled with vectorized min-label propagation: every node starts as its own label, each round hooks the
+larger label of every edge's endpoints onto the smaller one, and pointer jumping then flattens the label trees. Rounds
+repeat until no edge joins two labels, which takes a few rounds even for the full hierarchy, since pointer jumping
+halves path lengths every pass. Computed with the other indexes when the graph is built, and saved in the snapshot.
+
+Strongly connected components, i.e., cycles and the concepts on them, are labeled the same way but with direction: see
+strong_component_labels(). They aren't stored; rollups use them to condense cycles before counting descendants.
+"""
+from typing import Dict, List, Union
+
+import numpy as np
+
+from backend.csr_graph import CsrGraph, Ids, _to_id_array
+
+COMPONENT_DTYPE = np.int32
+
+
+def weak_component_labels(g: CsrGraph) -> np.ndarray:
+    """Component of each node, numbered 0, 1, ... in order of each component's lowest node index"""
+    n = len(g)
+    labels = np.arange(n, dtype=np.int64)
+    sources = np.repeat(np.arange(n, dtype=np.int64), np.diff(g.fwd_offsets))
+    targets = g.fwd_targets.astype(np.int64)
+    while True:
+        source_labels, target_labels = labels[sources], labels[targets]
+        differ = source_labels != target_labels
+        if not differ.any():
+            break
+        # Edges that still join two labels are the only ones that can change anything in later rounds
+        sources, targets = sources[differ], targets[differ]
+        low = np.minimum(source_labels[differ], target_labels[differ])
+        high = np.maximum(source_labels[differ], target_labels[differ])
+        np.minimum.at(labels, high, low)
+        while True:  # pointer jumping, until every node points at a root (a node that is its own label)
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+    # Roots are the lowest node of each component, so numbering roots in order numbers components by lowest node
+    is_root = labels == np.arange(n)
+    number = np.cumsum(is_root) - 1
+    return number[labels].astype(COMPONENT_DTYPE)
+
+
+def strong_component_labels(g: CsrGraph) -> np.ndarray:
+    """Strongly connected component of each node, numbered 0, 1, ... in order of each component's lowest node index
+
+    Nodes with no edges left in, or none left out, can't be on a cycle, so they're trimmed first. The rest are colored
+    by forward min-label propagation: each takes the lowest index that reaches it. A node whose color is its own index
+    is the lowest of its component, and the other members are the nodes of that color that reach it, found by searching
+    backwards over edges within the color. Those components are removed and the rest recolored, until none are left."""
+    n = len(g)
+    labels = np.arange(n, dtype=np.int64)
+    sources = np.repeat(np.arange(n, dtype=np.int64), np.diff(g.fwd_offsets))
+    targets = g.fwd_targets.astype(np.int64)
+    is_loop = sources == targets  # a self loop doesn't join anything
+    sources, targets = sources[~is_loop], targets[~is_loop]
+    while len(sources):
+        live = (np.bincount(sources, minlength=n) > 0) & (np.bincount(targets, minlength=n) > 0)
+        keep = live[sources] & live[targets]
+        if not keep.all():  # trim, and again, since that may leave more nodes without edges in or out
+            sources, targets = sources[keep], targets[keep]
+            continue
+        color = np.arange(n, dtype=np.int64)
+        while True:
+            before = color[targets]
+            np.minimum.at(color, targets, color[sources])
+            if np.array_equal(color[targets], before):
+                break
+        in_component = live & (color == np.arange(n))
+        within = color[sources] == color[targets]
+        up, down = sources[within], targets[within]
+        while True:
+            grows = in_component[down] & ~in_component[up]
+            if not grows.any():
+                break
+            in_component[up[grows]] = True
+        labels[in_component] = color[in_component]
+        keep = ~in_component[sources] & ~in_component[targets]
+        sources, targets = sources[keep], targets[keep]
+    # As in weak_component_labels(), each component's label is its lowest node
+    is_root = labels == np.arange(n)
+    number = np.cumsum(is_root) - 1
+    return number[labels].astype(COMPONENT_DTYPE)
+
+
+class ConnectedComponents:
+    """Weakly connected component id of every node of a CsrGraph, aligned to its node indexes"""
+    ARRAY_NAMES = ('component',)
+    ARRAY_PREFIX = 'comp_'
+
+    def __init__(self, component: np.ndarray):
+        self.component = component
+
+    @classmethod
+    def build(cls, g: CsrGraph) -> 'ConnectedComponents':
+        """Label every node of `g`"""
+        return cls(weak_component_labels(g))
+
+    def __len__(self) -> int:
+        """Number of components"""
+        return int(self.component.max()) + 1 if len(self.component) else 0
+
+    def of(self, g: CsrGraph, concept_ids: Ids) -> np.ndarray:
+        """Component of each concept. -1 for ids not in the graph."""
+        ids = _to_id_array(concept_ids)
+        component = np.full(len(ids), -1, dtype=COMPONENT_DTYPE)
+        idxs, found = g.index_of(ids)
+        component[found] = self.component[idxs]
+        return component
+
+    def spanned(self, g: CsrGraph, concept_ids: Ids) -> Dict[int, List[int]]:
+        """Concepts grouped by component, leaving out ids not in the graph"""
+        ids = np.unique(_to_id_array(concept_ids))
+        component = self.of(g, ids)
+        groups: Dict[int, List[int]] = {}
+        for concept_id, c in zip(ids.tolist(), component.tolist()):
+            if c >= 0:
+                groups.setdefault(c, []).append(concept_id)
+        return groups
+
+    # Serialization ----------------------------------------------------------------------------------------------------
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Component arrays by their name in the snapshot"""
+        return {self.ARRAY_PREFIX + name: getattr(self, name) for name in self.ARRAY_NAMES}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> Union['ConnectedComponents', None]:
+        """Inverse of arrays(). None if the arrays aren't there, e.g. in a snapshot from before components existed."""
+        if not all(cls.ARRAY_PREFIX + name in arrays for name in cls.ARRAY_NAMES):
+            return None
+        return cls(*[arrays[cls.ARRAY_PREFIX + name] for name in cls.ARRAY_NAMES])
@@ -0,0 +1,292 @@
+"""Reachability index for the concept hierarchy: answers "is A a descendant of B?" without walking the graph
+
+Built from a `CsrGraph` in a handful of vectorized passes, one per level of the hierarchy, and stored in the graph
+snapshot alongside the CSR arrays. Labels per node:
+  - `level`: length of the longest path from a root. Edges always go to a higher level, so `level[a] <= level[b]` means
+    a cannot be a descendant of b.
+  - `pre`, `size`: pre-order number and subtree size in a spanning tree of the DAG. If `pre[a]` is in
+    `[pre[b], pre[b] + size[b])`, a is a descendant of b.
+  - `lo`, `hi`: lowest and highest `pre` of any descendant in the full DAG. If `pre[a]` is outside `[lo[b], hi[b]]`, a
+    is not a descendant of b.
+  - `depth`: length of the shortest path from a root, like the `concept_depth` table in ddl-16. Not used by the checks;
+    it orders the results of lowest_common_ancestors().
+
+Most pairs are settled by those three O(1) checks. The rest, where a is inside b's DAG range but not its tree interval,
+are settled by a search up from a that is pruned with the same labels, so it rarely goes far.
+
+Nodes on or below a cycle can't be ordered by level. They get `level = -1` and a `[lo, hi]` range that covers
+everything, so the checks stay correct for them, just slower.
+"""
+from typing import Dict, Iterable, List, Set, Tuple, Union
+
+import numpy as np
+
+from backend.csr_graph import CsrGraph, INDEX_DTYPE, bfs, gather_neighbors
+
+LABEL_DTYPE = np.int32
+Pairs = Union[np.ndarray, Iterable[Tuple[int, int]]]
+
+
+def topological_levels(g: CsrGraph) -> np.ndarray:
+    """Longest-path distance of each node from a root. -1 for nodes on or below a cycle."""
+    n = len(g)
+    level = np.full(n, -1, dtype=LABEL_DTYPE)
+    remaining = np.diff(g.rev_offsets)  # parents not yet leveled
+    frontier = np.flatnonzero(remaining == 0).astype(INDEX_DTYPE)
+    depth = 0
+    while len(frontier):
+        level[frontier] = depth
+        _, targets = gather_neighbors(g.fwd_offsets, g.fwd_targets, frontier)
+        remaining = remaining - np.bincount(targets, minlength=n)
+        touched = np.unique(targets)
+        frontier = touched[remaining[touched] == 0]
+        depth += 1
+    return level
+
+
+def ancestor_pairs(g: CsrGraph, level: np.ndarray, nodes: np.ndarray):
+    """Every distinct (descendant, strict ancestor) pair for `nodes`, which must all have a level, as two arrays"""
+    n = len(g)
+    pending: Dict[int, List[np.ndarray]] = {}  # level -> arrays of (descendant * n + ancestor) keys
+
+    def push(descendants: np.ndarray, ancestors: np.ndarray):
+        """Queue pairs under their ancestor's level"""
+        keys = descendants.astype(np.int64) * n + ancestors
+        ancestor_level = level[ancestors]
+        order = np.argsort(ancestor_level, kind='stable')
+        keys, ancestor_level = keys[order], ancestor_level[order]
+        bounds = np.flatnonzero(np.r_[True, ancestor_level[1:] != ancestor_level[:-1], True])
+        for i, j in zip(bounds[:-1], bounds[1:]):
+            pending.setdefault(int(ancestor_level[i]), []).append(keys[i:j])
+
+    def push_parents(descendants: np.ndarray, nodes: np.ndarray):
+        """Queue (descendant, parent) pairs for each (descendant, node) pair"""
+        _, parents = g._gather(nodes, reverse=True)
+        if len(parents):
+            push(np.repeat(descendants, g._degrees(nodes, reverse=True)), parents)
+
+    found: List[np.ndarray] = []
+    push_parents(nodes, nodes)
+    while pending:
+        keys = np.sort(np.concatenate(pending.pop(max(pending))))
+        keys = keys[np.r_[True, keys[1:] != keys[:-1]]]  # unique. Faster than np.unique(), which may hash.
+        found.append(keys)
+        push_parents(keys // n, (keys % n).astype(INDEX_DTYPE))
+    keys = np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+    return keys // n, keys % n
+
+
+class ReachabilityIndex:
+    """Interval labels over a CsrGraph. Use `CsrGraph.reachability` rather than constructing this directly."""
+    ARRAY_NAMES = ('level', 'pre', 'size', 'lo', 'hi', 'depth')
+    ARRAY_PREFIX = 'reach_'
+
+    def __init__(
+        self, level: np.ndarray, pre: np.ndarray, size: np.ndarray, lo: np.ndarray, hi: np.ndarray, depth: np.ndarray
+    ):
+        self.level = level
+        self.pre = pre
+        self.size = size
+        self.lo = lo
+        self.hi = hi
+        self.depth = depth
+
+    @classmethod
+    def build(cls, g: CsrGraph) -> 'ReachabilityIndex':
+        """Compute labels for every node of `g`"""
+        n = len(g)
+        level = topological_levels(g)
+        max_level = int(level.max()) if n else -1
+        by_level: List[np.ndarray] = []
+        if n:
+            order = np.argsort(level, kind='stable')
+            bounds = np.searchsorted(level[order], np.arange(max_level + 2))
+            by_level = [order[bounds[i]:bounds[i + 1]].astype(INDEX_DTYPE) for i in range(max_level + 1)]
+
+        # Spanning tree: each leveled node's parent is one of its parents one level up, which always exists
+        tree_parent = np.full(n, -1, dtype=INDEX_DTYPE)
+        for nodes in by_level[1:]:
+            children, parents = gather_neighbors(g.rev_offsets, g.rev_sources, nodes)
+            is_tree_edge = level[parents] == level[children] - 1
+            children, parents = children[is_tree_edge], parents[is_tree_edge]
+            _, first = np.unique(children, return_index=True)
+            tree_parent[children[first]] = parents[first]
+
+        # Subtree sizes, bottom up
+        size = np.ones(n, dtype=LABEL_DTYPE)
+        for nodes in reversed(by_level[1:]):
+            np.add.at(size, tree_parent[nodes], size[nodes])
+
+        # Pre-order numbers, top down: a node comes right after its parent and its earlier siblings' subtrees
+        pre = np.zeros(n, dtype=LABEL_DTYPE)
+        n_leveled = 0
+        for depth, nodes in enumerate(by_level):
+            if depth == 0:
+                pre[nodes] = np.cumsum(size[nodes]) - size[nodes]
+            else:
+                nodes = nodes[np.argsort(tree_parent[nodes], kind='stable')]
+                parents = tree_parent[nodes]
+                sibling_offset = np.cumsum(size[nodes]) - size[nodes]
+                group_start = np.flatnonzero(np.r_[True, parents[1:] != parents[:-1]])
+                sibling_offset -= np.repeat(sibling_offset[group_start], np.diff(np.r_[group_start, len(nodes)]))
+                pre[nodes] = pre[parents] + 1 + sibling_offset
+            n_leveled += len(nodes)
+        unleveled = np.flatnonzero(level < 0)
+        pre[unleveled] = n_leveled + np.arange(len(unleveled), dtype=LABEL_DTYPE)
+
+        # Range of pre-order numbers under each node in the full DAG, bottom up
+        lo = pre.copy()
+        hi = pre.copy()
+        lo[unleveled] = 0
+        hi[unleveled] = max(n - 1, 0)
+        for nodes in reversed(by_level):
+            sources, targets = gather_neighbors(g.fwd_offsets, g.fwd_targets, nodes)
+            np.minimum.at(lo, sources, lo[targets])
+            np.maximum.at(hi, sources, hi[targets])
+        return cls(level, pre, size, lo, hi, shortest_depths(g))
+
+    # Queries ----------------------------------------------------------------------------------------------------------
+    def is_descendant(self, g: CsrGraph, descendants: np.ndarray, ancestors: np.ndarray) -> np.ndarray:
+        """For parallel arrays of node indexes: is each `descendants[i]` a strict descendant of `ancestors[i]`?"""
+        a, b = descendants, ancestors
+        result = self._in_tree(a, b) & (a != b)
+        undecided = ~result & self._maybe_reachable(a, b) & (a != b)
+        pending = np.flatnonzero(undecided)
+        if len(pending):
+            result[pending] = self._search(g, a[pending], b[pending])
+        return result
+
+    def _in_tree(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        """Is a in b's spanning tree interval? If so, a is b or a descendant of b."""
+        return (self.pre[b] <= self.pre[a]) & (self.pre[a] < self.pre[b] + self.size[b])
+
+    def _maybe_reachable(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        """False where the labels prove a is not b or a descendant of b"""
+        level_ok = (self.level[a] > self.level[b]) | (self.level[a] < 0) | (self.level[b] < 0) | (a == b)
+        return level_ok & (self.lo[b] <= self.pre[a]) & (self.pre[a] <= self.hi[b])
+
+    def _search(self, g: CsrGraph, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        """Batched search up from each a, for its b. Ancestors of a that b provably can't reach are pruned.
+
+        (pair, node) steps are queued by the node's level and taken highest level first. Every path up to a node
+        arrives before its level is taken, so one sort of that level's steps removes every duplicate, and the cost
+        grows linearly with the batch. Nodes on or below a cycle have no level: they're taken first, as long as any are
+        queued, and deduplicated against the ones seen before."""
+        n = len(g)
+        unleveled = np.iinfo(np.int64).max  # queue position of nodes without a level: ahead of all the rest
+        found = np.zeros(len(a), dtype=bool)
+        pending: Dict[int, List[np.ndarray]] = {}  # level -> arrays of (pair * n + node) keys
+        seen_unleveled = np.empty(0, dtype=np.int64)
+
+        def push(pair: np.ndarray, node: np.ndarray):
+            """Queue steps under their node's level"""
+            keys = pair.astype(np.int64) * n + node
+            node_level = self.level[node].astype(np.int64)
+            node_level[node_level < 0] = unleveled
+            order = np.argsort(node_level, kind='stable')
+            keys, node_level = keys[order], node_level[order]
+            bounds = np.flatnonzero(np.r_[True, node_level[1:] != node_level[:-1], True])
+            for i, j in zip(bounds[:-1], bounds[1:]):
+                pending.setdefault(int(node_level[i]), []).append(keys[i:j])
+
+        push(np.arange(len(a)), a)
+        while pending:
+            level = max(pending)
+            keys = np.sort(np.concatenate(pending.pop(level)))
+            keys = keys[np.r_[True, keys[1:] != keys[:-1]]]  # unique
+            if level == unleveled:  # can come around again, through a cycle
+                keys = keys[~np.isin(keys, seen_unleveled, assume_unique=True)]
+                seen_unleveled = np.union1d(seen_unleveled, keys)
+            pair, node = keys // n, (keys % n).astype(INDEX_DTYPE)
+            not_found = ~found[pair]
+            pair, node = pair[not_found], node[not_found]
+            pair = np.repeat(pair, g._degrees(node, reverse=True))
+            _, node = g._gather(node, reverse=True)
+            target = b[pair]
+            hit = self._in_tree(node, target)
+            found[pair[hit]] = True
+            keep = ~hit & ~found[pair] & self._maybe_reachable(node, target)
+            if keep.any():
+                push(pair[keep], node[keep])
+        return found
+
+    def ancestors_within(self, g: CsrGraph, idxs: np.ndarray) -> Dict[int, np.ndarray]:
+        """For each node index in `idxs`, the indexes in `idxs` that are its strict ancestors
+
+        Walks the ancestor closure of `idxs` once, top down by level, so each node's answer is built from its parents'.
+        """
+        members = np.unique(idxs)
+        in_set = np.zeros(len(g), dtype=bool)
+        in_set[members] = True
+        closure = np.union1d(members, g._bfs(members, reverse=True)[0])
+        closure = closure[np.argsort(self.level[closure], kind='stable')]
+        leveled = closure[self.level[closure] >= 0]
+        found: Dict[int, Set[int]] = {}
+        parents: List[int] = g._gather(leveled, reverse=True)[1].tolist()
+        bounds: List[int] = np.r_[0, np.cumsum(g._degrees(leveled, reverse=True))].tolist()
+        empty: Set[int] = set()
+        for i, v in enumerate(leveled.tolist()):
+            acc: Set[int] = set()
+            for p in parents[bounds[i]:bounds[i + 1]]:
+                acc |= found.get(p, empty)
+                if in_set[p]:
+                    acc.add(p)
+            found[v] = acc
+        result = {v: np.array(sorted(found[v]), dtype=INDEX_DTYPE) for v in members.tolist() if self.level[v] >= 0}
+        # Nodes below a cycle: no usable order, so search for each one
+        for v in members[self.level[members] < 0].tolist():
+            ancestors = g._bfs(np.array([v]), reverse=True)[0]
+            result[v] = np.sort(ancestors[in_set[ancestors]])
+        return result
+
+    def lowest_common_ancestors(self, g: CsrGraph, idxs: np.ndarray) -> np.ndarray:
+        """Node indexes that are ancestors of, or are, every one of `idxs`, and that have no descendant that also is
+
+        In a DAG there can be more than one. They're returned deepest first. The common ancestors are the nodes that
+        all members reach: every distinct (member, ancestor) pair is generated at once, per ancestor_pairs(), and
+        counted per ancestor, so nothing is the size of the whole graph. Since everything between two common ancestors
+        is also one, the lowest are the common ancestors with no child among them."""
+        members = np.unique(idxs)
+        if not len(members):
+            return np.empty(0, dtype=INDEX_DTYPE)
+        leveled = members[self.level[members] >= 0]
+        reached = [members, ancestor_pairs(g, self.level, leveled)[1]]
+        # Members on or below a cycle have no level order to walk in, so each one gets its own search
+        for v in members[self.level[members] < 0].tolist():
+            reached.append(g._bfs(np.array([v]), reverse=True)[0])
+        nodes, n_members = np.unique(np.concatenate(reached), return_counts=True)
+        candidates = nodes[n_members == len(members)].astype(INDEX_DTYPE)
+        if not len(candidates):
+            return candidates
+        sources, targets = g._gather(candidates)
+        lowest = np.setdiff1d(candidates, sources[np.isin(targets, candidates)])
+        return lowest[np.argsort(-self.depth[lowest], kind='stable')]
+
+    # Serialization ----------------------------------------------------------------------------------------------------
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Label arrays by their name in the snapshot"""
+        return {self.ARRAY_PREFIX + name: getattr(self, name) for name in self.ARRAY_NAMES}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> Union['ReachabilityIndex', None]:
+        """Inverse of arrays(). None if the arrays aren't there, e.g. in a snapshot from before this index existed."""
+        if not all(cls.ARRAY_PREFIX + name in arrays for name in cls.ARRAY_NAMES):
+            return None
+        return cls(*[arrays[cls.ARRAY_PREFIX + name] for name in cls.ARRAY_NAMES])
+
+
+def shortest_depths(g: CsrGraph) -> np.ndarray:
+    """Distance of each node from its nearest root. -1 for nodes that no root reaches, i.e., on a cycle of roots."""
+    depth = np.full(len(g), -1, dtype=LABEL_DTYPE)
+    roots = np.flatnonzero(np.diff(g.rev_offsets) == 0).astype(INDEX_DTYPE)
+    depth[roots] = 0
+    idxs, depths, _ = bfs(g.fwd_offsets, g.fwd_targets, roots)
+    depth[idxs] = depths
+    return depth
+
+
+def pairs_to_arrays(pairs: Pairs) -> Tuple[np.ndarray, np.ndarray]:
+    """(descendant, ancestor) pairs as two parallel id arrays"""
+    arr = pairs if isinstance(pairs, np.ndarray) else np.array(list(pairs), dtype=np.int64)
+    arr = arr.reshape(-1, 2)
+    return arr[:, 0], arr[:, 1]
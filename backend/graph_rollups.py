@@ -0,0 +1,108 @@
+"""Per-concept rollups over the concept hierarchy: how many distinct descendants each concept has, and the total_cnt of
+the concept plus all of them
+
+The UI orders siblings by these (see "Ordering of nodes" in docs/graph.md). Counting them is counting the ancestor
+closure, which in a DAG can't be done by summing over children: a concept reachable through two children would be
+counted twice. So instead, for a chunk of concepts at a time, all (concept, ancestor) pairs are generated by walking up
+the hierarchy in order of `ReachabilityIndex.level`, highest first. Every path to an ancestor arrives before the
+ancestor's level is processed, so duplicates are removed with one `np.unique` per level, and each distinct pair is
+counted exactly once. See graph_reachability.ancestor_pairs().
+
+Cycles have no level order, so strongly connected components are condensed first. Members of a component are all
+descendants of each other, so the walk runs over the acyclic graph of components, weighted by their sizes and summed
+counts, and each member gets its component's result.
+
+Computed when concept attributes are loaded, because total_cnt comes from them, and saved in the graph snapshot.
+"""
+from typing import Dict, Union
+
+import numpy as np
+
+from backend.csr_graph import CsrGraph, INDEX_DTYPE, Ids, build_csr
+from backend.graph_components import strong_component_labels
+from backend.graph_reachability import ancestor_pairs, topological_levels
+
+COUNT_DTYPE = np.int64
+CHUNK_SIZE = 1 << 16  # concepts whose ancestors are walked at once. Memory is about 16 bytes * CHUNK_SIZE * ancestors.
+
+
+class DescendantRollups:
+    """Distinct descendant count and rolled-up total_cnt for every node of a CsrGraph, aligned to its node indexes"""
+    ARRAY_NAMES = ('descendant_count', 'total_cnt')
+    ARRAY_PREFIX = 'rollup_'
+
+    def __init__(self, descendant_count: np.ndarray, total_cnt: np.ndarray):
+        self.descendant_count = descendant_count
+        self.total_cnt = total_cnt
+
+    @classmethod
+    def build(cls, g: CsrGraph, total_cnt: np.ndarray = None) -> 'DescendantRollups':
+        """Compute rollups for every node of `g`
+
+        :param total_cnt: Count for each node index of `g`. Defaults to the graph's concept attributes, with 0 for
+         concepts they don't have."""
+        n = len(g)
+        if total_cnt is None:
+            total_cnt = np.zeros(n, dtype=COUNT_DTYPE)
+            if g.attributes is not None:
+                idxs, found = g.attributes.index_of(g.node_ids)
+                total_cnt[found] = g.attributes.total_cnt[idxs]
+        weights = total_cnt.astype(np.float64)
+        level = g.reachability.level
+        component = np.arange(n, dtype=INDEX_DTYPE)
+        dag, size, dag_weights = g, np.ones(n, dtype=COUNT_DTYPE), weights
+        if (level < 0).any():  # on or below a cycle
+            component = strong_component_labels(g)
+            dag = _condense(g, component)
+            size = np.bincount(component, minlength=len(dag)).astype(COUNT_DTYPE)
+            dag_weights = np.bincount(component, weights=weights, minlength=len(dag))
+            level = topological_levels(dag)
+        dag_count, dag_rollup = _rollup_dag(dag, level, size, dag_weights)
+        # Other members of a node's own component are descendants too. Its rollup already includes them.
+        descendant_count = dag_count[component] + size[component] - 1
+        return cls(descendant_count, np.rint(dag_rollup[component]).astype(COUNT_DTYPE))
+
+    def lookup(self, g: CsrGraph, concept_ids: Ids) -> Dict[str, Dict[int, int]]:
+        """Rollups for the concepts in `g`, by concept id"""
+        idxs, _ = g.index_of(concept_ids)
+        ids = g.node_ids[idxs].tolist()
+        return {
+            'descendant_count': dict(zip(ids, self.descendant_count[idxs].tolist())),
+            'total_cnt': dict(zip(ids, self.total_cnt[idxs].tolist())),
+        }
+
+    # Serialization ----------------------------------------------------------------------------------------------------
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Rollup arrays by their name in the snapshot"""
+        return {self.ARRAY_PREFIX + name: getattr(self, name) for name in self.ARRAY_NAMES}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> Union['DescendantRollups', None]:
+        """Inverse of arrays(). None if the arrays aren't there, e.g. in a snapshot from before rollups existed."""
+        if not all(cls.ARRAY_PREFIX + name in arrays for name in cls.ARRAY_NAMES):
+            return None
+        return cls(*[arrays[cls.ARRAY_PREFIX + name] for name in cls.ARRAY_NAMES])
+
+
+def _rollup_dag(g: CsrGraph, level: np.ndarray, size: np.ndarray, weights: np.ndarray):
+    """Descendant count and rollup of every node of an acyclic `g`, each of whose nodes stands for `size` concepts"""
+    n = len(g)
+    descendant_count = np.zeros(n, dtype=COUNT_DTYPE)
+    rollup = weights.copy()
+    nodes = np.arange(n, dtype=INDEX_DTYPE)
+    for start in range(0, n, CHUNK_SIZE):
+        descendants, ancestors = ancestor_pairs(g, level, nodes[start:start + CHUNK_SIZE])
+        descendant_count += np.bincount(ancestors, weights=size[descendants], minlength=n).astype(COUNT_DTYPE)
+        rollup += np.bincount(ancestors, weights=weights[descendants], minlength=n)
+    return descendant_count, rollup
+
+
+def _condense(g: CsrGraph, component: np.ndarray) -> CsrGraph:
+    """Graph with a node per component of `g`, numbered as in `component`, and an edge wherever `g` has one between
+    two different components"""
+    n = int(component.max()) + 1 if len(component) else 0
+    sources = component[np.repeat(np.arange(len(g)), np.diff(g.fwd_offsets))].astype(np.int64)
+    targets = component[g.fwd_targets].astype(np.int64)
+    keys = np.unique(sources[sources != targets] * n + targets[sources != targets])
+    sources, targets = np.divmod(keys, n)
+    return CsrGraph(np.arange(n, dtype=np.int64), *build_csr(sources, targets, n), *build_csr(targets, sources, n))
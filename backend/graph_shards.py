@@ -0,0 +1,314 @@
+"""The relationship graph split into one shard per vocabulary, loaded on demand
+
+Most requests only traverse a few vocabularies (SNOMED, RxNorm, ICD10CM...), but in the full snapshot concepts of every
+vocabulary are interleaved by concept id, so a traversal of one vocabulary touches pages all over the edge arrays, and
+over time every worker ends up with the whole hierarchy mapped in. Here each vocabulary's edges are written to their own
+snapshot file, and the edges between vocabularies (e.g. a SNOMED concept under an ICD10CM one) to one more, the cross
+shard. A ShardedGraph maps a shard only when a traversal first reaches one of its concepts, and unmaps the least
+recently used shards when the mapped total goes over a memory budget. Shards of hot vocabularies can be pinned, so they
+are mapped at startup and never evicted. The cross shard, which every traversal needs, is always pinned.
+
+A ShardedGraph never maps the full snapshot. Everything but the edges (node ids and degrees, the reachability and
+component indexes, attributes, rollups and mappings) is copied into the manifest, `<version>.shards`, along with which
+shard each node is in.
+
+Shard layout: `nodes` is the sorted (full graph) node indexes of the shard's concepts, and the CSR arrays are over
+positions in `nodes`, with neighbors as full graph node indexes, so traversal never has to translate between shards.
+
+Files are named after the graph version (its `created` time), and the previous version is kept, so workers still on the
+old graph can finish loading its shards.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from backend.concept_attributes import _decode
+from backend.csr_graph import INDEX_DTYPE, CsrGraph, build_csr, gather_neighbors
+from backend.graph_snapshot import read_snapshot, write_snapshot
+
+SHARD_DTYPE = np.int16  # vocabulary code (see ConceptAttributes) of each node's shard. 0: no vocabulary.
+CROSS_SHARD = -1
+VERSIONS_KEPT = 2
+
+
+class GraphShard:
+    """Edges out of and into one set of nodes, as CSR arrays over positions in `nodes`"""
+    ARRAY_NAMES = ('nodes', 'fwd_offsets', 'fwd_targets', 'rev_offsets', 'rev_sources')
+
+    def __init__(
+        self, nodes: np.ndarray, fwd_offsets: np.ndarray, fwd_targets: np.ndarray, rev_offsets: np.ndarray,
+        rev_sources: np.ndarray
+    ):
+        self.nodes = nodes
+        self.fwd_offsets = fwd_offsets
+        self.fwd_targets = fwd_targets
+        self.rev_offsets = rev_offsets
+        self.rev_sources = rev_sources
+
+    @classmethod
+    def from_edges(cls, sources: np.ndarray, targets: np.ndarray, nodes: np.ndarray = None) -> 'GraphShard':
+        """Shard for edges between full graph node indexes
+
+        :param nodes: Nodes to index, which must include every source and target. Defaults to just those."""
+        nodes = np.unique(np.concatenate([sources, targets])) if nodes is None else nodes
+        nodes = nodes.astype(INDEX_DTYPE, copy=False)
+        local_sources = np.searchsorted(nodes, sources)
+        local_targets = np.searchsorted(nodes, targets)
+        fwd_offsets, fwd_targets = build_csr(local_sources, targets, len(nodes))
+        rev_offsets, rev_sources = build_csr(local_targets, sources, len(nodes))
+        return cls(nodes, fwd_offsets, fwd_targets, rev_offsets, rev_sources)
+
+    def gather(self, at: np.ndarray, idxs: np.ndarray, reverse=False) -> Tuple[np.ndarray, np.ndarray]:
+        """Edges out of (or, if `reverse`, into) those of full graph node indexes `idxs` that are in this shard
+
+        :param at: Position of each of `idxs` in the caller's request
+        :returns (positions, neighbors): For each edge, the position in `at` of the node it belongs to, and the full
+         graph node index at its other end"""
+        if not len(self.nodes) or not len(idxs):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=INDEX_DTYPE)
+        pos = np.minimum(np.searchsorted(self.nodes, idxs), len(self.nodes) - 1)
+        here = self.nodes[pos] == idxs
+        pos = pos[here]
+        offsets, neighbors = (self.rev_offsets, self.rev_sources) if reverse else (self.fwd_offsets, self.fwd_targets)
+        _, targets = gather_neighbors(offsets, neighbors, pos)
+        return np.repeat(at[here], offsets[pos + 1] - offsets[pos]), targets
+
+    def nbytes(self) -> int:
+        """Size of the shard's arrays"""
+        return sum(a.nbytes for a in self.arrays().values())
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """Shard arrays by name"""
+        return {name: getattr(self, name) for name in self.ARRAY_NAMES}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> 'GraphShard':
+        """Inverse of arrays()"""
+        return cls(*[arrays[name] for name in cls.ARRAY_NAMES])
+
+
+def node_shards(g: CsrGraph) -> np.ndarray:
+    """Shard of each node of `g`: its vocabulary code, or 0 if it has none or `g` has no concept attributes"""
+    shards = np.zeros(len(g), dtype=SHARD_DTYPE)
+    if g.attributes is not None:
+        idxs, found = g.attributes.index_of(g.node_ids)
+        shards[found] = g.attributes.vocabulary[idxs]
+    return shards
+
+
+def shard_version(g: CsrGraph) -> str:
+    """Short, filename-safe id for the version of `g` that shards are written for"""
+    version = str(g.meta.get('created') or 'unversioned')
+    return hashlib.sha256(version.encode('utf-8')).hexdigest()[:16]
+
+
+def shard_path(directory: str, version: str, shard: int) -> str:
+    """File for one shard of a version"""
+    name = 'cross' if shard == CROSS_SHARD else f'vocab-{shard}'
+    return os.path.join(directory, f'{version}.{name}.csr')
+
+
+def manifest_path(directory: str, version: str) -> str:
+    """File with everything but the edges, the node -> shard array, and the manifest of a version"""
+    return os.path.join(directory, f'{version}.shards')
+
+
+def write_graph_shards(g: CsrGraph, directory: str) -> str:
+    """Split `g` into a shard per vocabulary plus the cross shard, unless that's already been done for its version
+
+    Builds `g`'s indexes first, if need be, since a ShardedGraph can't: that needs the full CSR arrays. Not safe to run
+    from more than one process at a time; callers hold the graph snapshot lock.
+    :returns: The version, for ShardedGraph()"""
+    version = shard_version(g)
+    path = manifest_path(directory, version)
+    if os.path.isfile(path):
+        return version
+    os.makedirs(directory, exist_ok=True)
+    g.build_indexes()
+    shard_of = node_shards(g)
+    sources = np.repeat(np.arange(len(g), dtype=INDEX_DTYPE), np.diff(g.fwd_offsets))
+    targets = g.fwd_targets
+    edge_shard = shard_of[sources]
+    cross = edge_shard != shard_of[targets]
+    # Group nodes, and edges within a shard, by shard, in one sort each rather than one pass per shard
+    node_order = np.argsort(shard_of, kind='stable')
+    node_bounds = np.searchsorted(shard_of[node_order], np.arange(shard_of.max() + 2 if len(g) else 1))
+    inside = np.flatnonzero(~cross)
+    inside = inside[np.argsort(edge_shard[inside], kind='stable')]
+    edge_bounds = np.searchsorted(edge_shard[inside], np.arange(len(node_bounds)))
+    manifest: List[Dict[str, Any]] = []
+    for shard in np.unique(shard_of).tolist() + [CROSS_SHARD]:
+        if shard == CROSS_SHARD:
+            data = GraphShard.from_edges(sources[cross], targets[cross])
+        else:
+            edges = inside[edge_bounds[shard]:edge_bounds[shard + 1]]
+            data = GraphShard.from_edges(
+                sources[edges], targets[edges], np.sort(node_order[node_bounds[shard]:node_bounds[shard + 1]]))
+        write_snapshot(shard_path(directory, version, shard), data.arrays())
+        manifest.append({
+            'shard': shard,
+            'vocabulary': None if shard == CROSS_SHARD or g.attributes is None else
+            _decode(g.attributes.vocabularies, shard),
+            'nodes': len(data.nodes), 'edges': len(data.fwd_targets), 'nbytes': data.nbytes()})
+    arrays = {name: a for name, a in g.arrays().items() if name not in CsrGraph.CSR_ARRAY_NAMES}
+    arrays.update({
+        'node_shard': shard_of, 'out_degree': np.diff(g.fwd_offsets).astype(INDEX_DTYPE),
+        'in_degree': np.diff(g.rev_offsets).astype(INDEX_DTYPE)})
+    # Written last: its presence means the version is complete
+    write_snapshot(path, arrays, {'graph_meta': g.meta, 'version': version, 'shards': manifest})
+    _remove_old_versions(directory)
+    return version
+
+
+def _remove_old_versions(directory: str):
+    """Delete the files of all but the VERSIONS_KEPT newest versions"""
+    manifests = sorted(
+        (name for name in os.listdir(directory) if name.endswith('.shards')),
+        key=lambda name: os.path.getmtime(os.path.join(directory, name)), reverse=True)
+    kept = {name.split('.')[0] for name in manifests[:VERSIONS_KEPT]}
+    for name in os.listdir(directory):
+        if name.split('.')[0] not in kept and (name.endswith('.csr') or name.endswith('.shards')):
+            os.remove(os.path.join(directory, name))
+
+
+def _no_full_array(name: str) -> property:
+    """A CsrGraph array that a ShardedGraph doesn't have"""
+    def get(self):
+        raise AttributeError(
+            f'ShardedGraph has no whole-graph {name}. Use the CsrGraph the shards were written from for that.')
+    return property(get)
+
+
+class ShardedGraph(CsrGraph):
+    """CsrGraph whose edges are read from per-vocabulary shards, mapped on first use and evicted under a memory budget
+
+    Opens the manifest and the shards of a version that write_graph_shards() wrote, never the full snapshot. Traversals
+    and queries read edges through _gather() and _degrees(), and the indexes come from the manifest, so they work
+    unchanged. Building indexes or saving a snapshot needs the full CSR arrays, which aren't here. Whole-graph edge
+    lists (`edge_arrays()`, for /wholegraph) are put together from the shards, one at a time.
+    :param budget_bytes: Evict least recently used shards once the shards mapped add up to more than this. Pinned
+     shards count against the budget but are never evicted, and neither is the shard in use, so the mapped shards only
+     go over if those alone do. None for no limit.
+    :param pinned_vocabularies: Vocabulary ids whose shards are mapped right away and never evicted."""
+    fwd_offsets = _no_full_array('fwd_offsets')
+    fwd_targets = _no_full_array('fwd_targets')
+    rev_offsets = _no_full_array('rev_offsets')
+    rev_sources = _no_full_array('rev_sources')
+
+    def __init__(
+        self, directory: str, version: str, budget_bytes: Optional[int] = None, pinned_vocabularies: Iterable[str] = ()
+    ):
+        # Deliberately not calling super().__init__(): there are no whole-graph CSR arrays to set
+        arrays, manifest = read_snapshot(manifest_path(directory, version))
+        self.node_ids = arrays['node_ids']
+        self.meta: Dict[str, Any] = manifest['graph_meta']
+        self._set_extras(arrays)
+        self.node_shard: np.ndarray = arrays['node_shard']
+        self._out_degree: np.ndarray = arrays['out_degree']
+        self._in_degree: np.ndarray = arrays['in_degree']
+        self._manifest_nbytes = sum(a.nbytes for a in arrays.values())
+        self.directory = directory
+        self.version = version
+        self.manifest: Dict[int, Dict[str, Any]] = {s['shard']: s for s in manifest['shards']}
+        self.budget_bytes = budget_bytes
+        pinned = {s['shard'] for s in self.manifest.values() if s['vocabulary'] in set(pinned_vocabularies)}
+        self.pinned = pinned | {CROSS_SHARD}
+        self._shards: 'OrderedDict[int, GraphShard]' = OrderedDict()  # least recently used first
+        self._mapped_bytes = 0
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+        for shard in sorted(self.pinned):
+            self._shard(shard)
+
+    def _gather(self, idxs: np.ndarray, reverse=False) -> Tuple[np.ndarray, np.ndarray]:
+        """Edges of `idxs` from each of their vocabularies' shards, and the cross shard, put back in the order of a
+        CsrGraph's"""
+        idxs = np.asarray(idxs, dtype=INDEX_DTYPE)
+        at = np.arange(len(idxs))
+        shard_of = self.node_shard[idxs]
+        parts = [self._shard(CROSS_SHARD).gather(at, idxs, reverse)]
+        for shard in np.unique(shard_of).tolist():
+            in_shard = shard_of == shard
+            parts.append(self._shard(shard).gather(at[in_shard], idxs[in_shard], reverse))
+        positions = np.concatenate([p[0] for p in parts])
+        neighbors = np.concatenate([p[1] for p in parts])
+        order = np.lexsort((neighbors, positions))
+        return idxs[positions[order]], neighbors[order]
+
+    def _degrees(self, idxs: np.ndarray, reverse=False) -> np.ndarray:
+        """Number of children (or, if `reverse`, parents) of each of node indexes `idxs`, from the manifest"""
+        return (self._in_degree if reverse else self._out_degree)[idxs]
+
+    def edge_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+        """All edges as parallel arrays of source and target concept ids, ordered by source. Read one shard at a time,
+        through the shard cache, so the budget holds."""
+        sources: List[np.ndarray] = []
+        targets: List[np.ndarray] = []
+        for shard in self.manifest:
+            data = self._shard(shard)
+            sources.append(data.nodes[np.repeat(np.arange(len(data.nodes)), np.diff(data.fwd_offsets))])
+            targets.append(np.array(data.fwd_targets))  # a copy, so the shard can be unmapped
+            del data
+        source_idxs, target_idxs = np.concatenate(sources), np.concatenate(targets)
+        order = np.lexsort((target_idxs, source_idxs))
+        return self.node_ids[source_idxs[order]], self.node_ids[target_idxs[order]]
+
+    def number_of_edges(self) -> int:
+        """Number of edges"""
+        return sum(s['edges'] for s in self.manifest.values())
+
+    def build_indexes(self):
+        """Nothing to do: the indexes come with the manifest"""
+
+    def nbytes(self) -> int:
+        """Memory mapped for the manifest and the shards mapped right now"""
+        return self._manifest_nbytes + self._mapped_bytes
+
+    # Shard cache ------------------------------------------------------------------------------------------------------
+    def _shard(self, shard: int) -> GraphShard:
+        """A shard, mapping it first if it isn't already, and evicting others if that goes over budget"""
+        with self._lock:
+            data = self._shards.get(shard)
+            if data is not None:
+                self._shards.move_to_end(shard)
+                return data
+            arrays, _ = read_snapshot(shard_path(self.directory, self.version, shard))
+            data = GraphShard.from_arrays(arrays)
+            self._shards[shard] = data
+            self._mapped_bytes += data.nbytes()
+            self.loads += 1
+            self._evict()
+            return data
+
+    def _evict(self):
+        """Unmap least recently used unpinned shards until under budget. The shard just used is never evicted. Shards
+        still referenced by a traversal in progress are unmapped when it lets go of them."""
+        if self.budget_bytes is None:
+            return
+        for shard in list(self._shards)[:-1]:
+            if self._mapped_bytes <= self.budget_bytes:
+                break
+            if shard not in self.pinned:
+                self._mapped_bytes -= self._shards.pop(shard).nbytes()
+                self.evictions += 1
+
+    def mapped_bytes(self) -> int:
+        """Size of the shards currently mapped"""
+        return self._mapped_bytes
+
+    def stats(self) -> Dict[str, Any]:
+        """Shard cache state, for monitoring"""
+        with self._lock:
+            return {
+                'shards': len(self.manifest), 'mapped': sorted(self._shards), 'pinned': sorted(self.pinned),
+                'mapped_bytes': self._mapped_bytes, 'manifest_bytes': self._manifest_nbytes,
+                'budget_bytes': self.budget_bytes, 'loads': self.loads, 'evictions': self.evictions}
+
+    def __repr__(self):
+        return f'ShardedGraph(nodes={self.number_of_nodes()}, edges={self.number_of_edges()}, ' \
+               f'shards={len(self.manifest)})'
@@ -0,0 +1,129 @@
+"""On-disk snapshot format for the relationship graph
+
+A snapshot is a single file: a small fixed preamble, a JSON header, and then the raw bytes of a set of named NumPy
+arrays. Readers `mmap` the file and wrap the array regions without copying, so every worker process on a host shares
+the same pages in the OS page cache, and opening a snapshot takes about as long as reading the header.
+
+Layout (all integers little-endian):
+  - 8 bytes: magic, `SNAPSHOT_MAGIC`
+  - 4 bytes: uint32 format version
+  - 8 bytes: uint64 length of the JSON header
+  - JSON header: `{"meta": {...}, "arrays": {name: {"dtype": str, "shape": [...], "offset": int}}}`. Offsets are
+    relative to the start of the data section.
+  - data section, starting at the first `ALIGNMENT` boundary after the header. Each array starts on an `ALIGNMENT`
+    boundary.
+
+Writes go to a temporary file in the same directory which is then renamed over the target, so readers only ever see a
+complete snapshot.
+"""
+import json
+import mmap
+import os
+import struct
+import tempfile
+from typing import Any, Dict, Tuple
+
+import numpy as np
+
+from backend.csr_graph import CsrGraph
+
+SNAPSHOT_MAGIC = b'THGRAPH\n'
+SNAPSHOT_FORMAT_VERSION = 1
+ALIGNMENT = 64
+_PREAMBLE = struct.Struct('<8sIQ')
+
+
+class SnapshotFormatError(ValueError):
+    """Snapshot file is not in a format this version of the code can read"""
+    pass
+
+
+def _aligned(n: int) -> int:
+    """Round n up to the next ALIGNMENT boundary"""
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_snapshot(path: str, arrays: Dict[str, np.ndarray], meta: Dict[str, Any] = None):
+    """Write arrays and metadata to a snapshot file, atomically replacing any existing file at `path`"""
+    arrays = {k: np.ascontiguousarray(v) for k, v in arrays.items()}
+    array_headers: Dict[str, Dict[str, Any]] = {}
+    offset = 0
+    for name, arr in arrays.items():
+        array_headers[name] = {'dtype': arr.dtype.newbyteorder('<').str, 'shape': list(arr.shape), 'offset': offset}
+        offset = _aligned(offset + arr.nbytes)
+    header = json.dumps({'meta': meta or {}, 'arrays': array_headers}).encode('utf-8')
+    data_start = _aligned(_PREAMBLE.size + len(header))
+
+    dirname = os.path.dirname(os.path.abspath(path))
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, len(header)))
+            f.write(header)
+            for name, arr in arrays.items():
+                f.seek(data_start + array_headers[name]['offset'])
+                f.write(arr.astype(array_headers[name]['dtype'], copy=False).tobytes())
+            f.truncate(data_start + offset)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_snapshot_meta(path: str) -> Dict[str, Any]:
+    """Read just the metadata of a snapshot, without mapping its arrays"""
+    with open(path, 'rb') as f:
+        header, _ = _read_header(f.read(_PREAMBLE.size), f, path)
+    return header['meta']
+
+
+def read_snapshot(path: str) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+    """Memory-map a snapshot file
+
+    :returns (arrays, meta): The arrays are read-only views into the mapped file; no data is copied."""
+    with open(path, 'rb') as f:
+        header, data_start = _read_header(f.read(_PREAMBLE.size), f, path)
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)  # stays valid after the file is closed
+    arrays: Dict[str, np.ndarray] = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        shape = tuple(spec['shape'])
+        count = int(np.prod(shape)) if shape else 1
+        start = data_start + spec['offset']
+        if start + count * dtype.itemsize > len(mapped):
+            raise SnapshotFormatError(f'Snapshot {path} is truncated: array {name} runs past the end of the file.')
+        arrays[name] = np.frombuffer(mapped, dtype=dtype, count=count, offset=start).reshape(shape)
+    return arrays, header['meta']
+
+
+def _read_header(preamble: bytes, f, path: str) -> Tuple[Dict[str, Any], int]:
+    """Parse and validate the preamble and JSON header"""
+    if len(preamble) < _PREAMBLE.size:
+        raise SnapshotFormatError(f'Snapshot {path} is too short to be a graph snapshot.')
+    magic, version, header_len = _PREAMBLE.unpack(preamble)
+    if magic != SNAPSHOT_MAGIC:
+        raise SnapshotFormatError(f'{path} is not a graph snapshot.')
+    if version > SNAPSHOT_FORMAT_VERSION:
+        raise SnapshotFormatError(
+            f'Snapshot {path} has format version {version}, but only versions up to {SNAPSHOT_FORMAT_VERSION} are '
+            f'supported.')
+    header = json.loads(f.read(header_len).decode('utf-8'))
+    return header, _aligned(_PREAMBLE.size + header_len)
+
+
+def save_graph_snapshot(g: CsrGraph, path: str, meta: Dict[str, Any] = None):
+    """Write a graph to a snapshot file"""
+    meta = {**g.meta, **(meta or {}), 'n_nodes': g.number_of_nodes(), 'n_edges': g.number_of_edges()}
+    write_snapshot(path, g.arrays(), meta)
+    g.meta = meta
+
+
+def load_graph_snapshot(path: str) -> CsrGraph:
+    """Open a graph snapshot file. The graph's arrays are backed by the shared, memory-mapped file."""
+    arrays, meta = read_snapshot(path)
+    return CsrGraph.from_arrays(arrays, meta)
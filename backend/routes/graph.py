@@ -1,28 +1,67 @@
 """Graph related functions and routes"""
-import os, warnings
+import builtins, json, os, threading, time, warnings
 import dateutil.parser as dp
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Iterable, List, Set, Tuple, Union, Dict, Optional
+from typing import Any, Callable, Iterable, Iterator, List, Literal, Set, Tuple, Union, Dict, Optional
 
 import pickle
-import networkx as nx
-from fastapi import APIRouter, Query, Request
+import numpy as np
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from networkx import DiGraph
+from psycopg2 import sql
 from sqlalchemy import Row, RowMapping
 from sqlalchemy.sql import text
 
-from backend.routes.db import get_cset_members_items
-from backend.db.queries import get_concepts
-from backend.db.utils import check_db_status_var, get_db_connection, SCHEMA
+from backend.concept_attributes import ConceptAttributes
+from backend.concept_expansion import FLAGS, ConceptMappings, expand_expressions
+from backend.csr_graph import CsrGraph, NODE_ID_DTYPE
+from backend.edge_encoding import EDGES_MEDIA_TYPE, accepts_binary_edges, encode_response
+from backend.graph_artifacts import artifact_response, artifact_version, build_wholegraph_artifacts, choose_encoding
+from backend.graph_rollups import DescendantRollups
+from backend.graph_shards import ShardedGraph, write_graph_shards
+from backend.graph_snapshot import SnapshotFormatError, load_graph_snapshot, read_snapshot_meta, save_graph_snapshot
+from backend.tree_layout import IndentedTree
+from backend.routes.db import get_cset_members_items_async
+from backend.db.queries import get_concepts_async
+from backend.db.utils import check_db_status_var, check_db_status_var_async, copy_int_columns, current_datetime, \
+    estimated_row_count, get_async_db_connection, get_db_connection, sql_query, sql_query_async, SCHEMA
 from backend.api_logger import Api_logger
-from backend.utils import get_timer, commify
+from backend.utils import get_timer, commify, throttle, LruCache
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock around rebuilding the snapshot
+    fcntl = None
 
 VERBOSE = False
 PROJECT_DIR = Path(os.path.dirname(__file__)).parent.parent
 VOCABS_PATH = os.path.join(PROJECT_DIR, 'termhub-vocab')
-GRAPH_PATH = os.path.join(VOCABS_PATH, 'relationship_graph.pickle')
-GRAPH_UNDIRECTED_PATH = os.path.join(VOCABS_PATH, 'relationship_graph_undirected.pickle')
+GRAPH_SNAPSHOT_PATH = os.path.join(VOCABS_PATH, 'relationship_graph.csr')
+GRAPH_PATH = os.path.join(VOCABS_PATH, 'relationship_graph.pickle')  # legacy; superseded by GRAPH_SNAPSHOT_PATH
+WHOLEGRAPH_ARTIFACTS_DIR = os.path.join(VOCABS_PATH, 'wholegraph')
+GRAPH_SHARDS_DIR = os.path.join(VOCABS_PATH, 'relationship_graph_shards')
+# Sharded graph (see backend.graph_shards): traversals map per-vocabulary shards on demand, within a memory budget
+GRAPH_SHARDED = os.getenv('TERMHUB_GRAPH_SHARDED', '').lower() in ('1', 'true', 'yes')
+GRAPH_SHARD_BUDGET_MB = int(os.getenv('TERMHUB_GRAPH_SHARD_BUDGET_MB', '1024'))
+GRAPH_PINNED_SHARDS = [
+    v.strip() for v in os.getenv('TERMHUB_GRAPH_PINNED_SHARDS', 'SNOMED,RxNorm,ICD10CM').split(',') if v.strip()]
+GRAPH_REFRESH_CHECK_SECONDS = 5 * 60  # how often get_rel_graph() checks for a vocab refresh / newer snapshot
+GRAPH_NOT_READY_RETRY_AFTER_SECONDS = 15
+CONCEPT_GRAPH_CACHE_MAX_ENTRIES = 256
+# Bound on the total number of edges + concept ids held by cached /concept-graph responses, per worker
+CONCEPT_GRAPH_CACHE_MAX_ITEMS = 500_000
+CONCEPT_GRAPH_CACHE_CHECK_SECONDS = 30  # how often to check whether a DB refresh has invalidated the cache
+GAP_FILL_MAX_DEPTH = 4  # longest path between two selected concepts, in edges, that gap filling looks for
+GAP_FILL_SECONDS = 2.0
+GAP_FILL_MAX_SECONDS = 20.0
+NDJSON_CHUNK_SIZE = 5_000  # concept ids or edges per line of a format=ndjson /concept-graph response
+TREE_LAYOUT_BUDGETS = [2_000, 4_000, 6_000]  # default node budgets that /indented-tree precomputes collapse points for
+TREE_LAYOUT_MAX_ROWS = 200_000
+TREE_LAYOUT_CACHE_MAX_ENTRIES = 128
+TREE_LAYOUT_CACHE_MAX_ROWS = 2_000_000
 
 router = APIRouter(
     responses={404: {"description": "Not found"}},
@@ -33,86 +72,510 @@ router = APIRouter(
 async def concept_graph_get(
     request: Request, codeset_ids: Optional[List[int]] = Query(None), cids: Optional[List[int]] = Query(None),
     hide_vocabs = ['RxNorm Extension'], hide_nonstandard_concepts=False, verbose = VERBOSE,
+    max_depth: int = Query(1, ge=0), max_nodes: Optional[int] = Query(None, ge=1),
+    super_node_threshold: Optional[int] = Query(None, ge=1), gap_fill: bool = False,
+    gap_fill_max_depth: int = Query(GAP_FILL_MAX_DEPTH, ge=2),
+    gap_fill_seconds: float = Query(GAP_FILL_SECONDS, gt=0, le=GAP_FILL_MAX_SECONDS),
+    response_format: Literal['json', 'ndjson'] = Query('json', alias='format'), http_response: Response = None,
 ) -> Dict[str, Any]:
     """Return concept graph"""
     cids = cids if cids else []
-    return await concept_graph_post(request, codeset_ids, cids, hide_vocabs, hide_nonstandard_concepts, verbose)
+    return await concept_graph_post(
+        request, codeset_ids, cids, hide_vocabs, hide_nonstandard_concepts, verbose, max_depth, max_nodes,
+        super_node_threshold, gap_fill, gap_fill_max_depth, gap_fill_seconds, response_format, http_response)
 
 
 @router.post("/concept-graph")
 async def concept_graph_post(
     request: Request, codeset_ids: List[int], cids: Union[List[int], None] = [],
     hide_vocabs = ['RxNorm Extension'], hide_nonstandard_concepts=False, verbose = VERBOSE,
+    max_depth: int = Query(1, ge=0), max_nodes: Optional[int] = Query(None, ge=1),
+    super_node_threshold: Optional[int] = Query(None, ge=1), gap_fill: bool = False,
+    gap_fill_max_depth: int = Query(GAP_FILL_MAX_DEPTH, ge=2),
+    gap_fill_seconds: float = Query(GAP_FILL_SECONDS, gt=0, le=GAP_FILL_MAX_SECONDS),
+    response_format: Literal['json', 'ndjson'] = Query('json', alias='format'), http_response: Response = None,
 ) -> Dict:
-    """Return concept graph via HTTP POST"""
+    """Return concept graph via HTTP POST
+
+    :param max_depth: How many levels of descendants of the concept set members to include. 0 for all of them.
+    :param max_nodes: Optional cap on the number of descendants added. If it is hit, `descendants_truncated` is true
+     in the response.
+    :param super_node_threshold: If set, condense nodes with more children than this. See condense_super_nodes(). The
+     hidden children can be fetched with /expand-super-node.
+    :param gap_fill: Instead of adding descendants, add only the concepts that connect the selected ones: those on a
+     path of at most `gap_fill_max_depth` edges from one selected concept down to another. If the search takes more
+     than `gap_fill_seconds`, what was found so far is returned and `descendants_truncated` is true.
+    :param response_format: `format=ndjson` streams the response as newline-delimited JSON instead, in chunks of nodes
+     and edges read straight from the subgraph, so that big graphs don't have to be held or serialized as one document.
+     Streamed responses aren't cached. See concept_graph_ndjson().
+     Otherwise, with `Accept: application/vnd.termhub.edges`, edges are sent in the compact binary encoding described in
+     backend/edge_encoding.py, and the rest of the response as JSON inside it."""
     rpt = Api_logger()
     try:
-        await rpt.start_rpt(request, params={'codeset_ids': codeset_ids, 'cids': cids})
+        await rpt.start_rpt(request, params={
+            'codeset_ids': codeset_ids, 'cids': cids, 'max_depth': max_depth, 'max_nodes': max_nodes,
+            'super_node_threshold': super_node_threshold, 'gap_fill': gap_fill})
+
+        if response_format == 'ndjson':  # streamed from the subgraph itself: no response is built or cached
+            rel_graph: CsrGraph = get_rel_graph()
+            sg, concept_ids, hidden_by_vocab, nonstandard_concepts_hidden, descendants_truncated = await concept_graph(
+                codeset_ids, cids, hide_vocabs if isinstance(hide_vocabs, list) else [], hide_nonstandard_concepts,
+                verbose, all_descendants=not gap_fill, max_depth=max_depth, max_nodes=max_nodes, rel_graph=rel_graph,
+                gap_fill_max_depth=gap_fill_max_depth, gap_fill_seconds=gap_fill_seconds)
+            await rpt.finish(rows=len(sg))
+            return StreamingResponse(
+                concept_graph_ndjson(
+                    rel_graph, sg, concept_ids, hidden_by_vocab, nonstandard_concepts_hidden, descendants_truncated,
+                    super_node_threshold, set(cids or [])),
+                media_type='application/x-ndjson')
+        response: Dict[str, Any] = await cached_concept_graph(
+            codeset_ids, cids, hide_vocabs, hide_nonstandard_concepts, verbose, max_depth, max_nodes,
+            gap_fill, gap_fill_max_depth, gap_fill_seconds)
+        if super_node_threshold:
+            response = await run_in_threadpool(condense_response, response, super_node_threshold, set(cids or []))
+
+        await rpt.finish(rows=len(response['concept_ids']) - len(response['missing_from_graph']))
+        if accepts_binary_edges(request.headers.get('accept')):
+            edges = np.array(response['edges'], dtype=NODE_ID_DTYPE).reshape(-1, 2)
+            rest = {k: v for k, v in response.items() if k != 'edges'}
+            return Response(encode_response(edges[:, 0], edges[:, 1], rest), media_type=EDGES_MEDIA_TYPE,
+                            headers={'Vary': 'Accept'})
+        if http_response is not None:
+            http_response.headers['Vary'] = 'Accept'
+        return response
+    except Exception as e:
+        await rpt.log_error(e)
+        raise e
 
-        hide_vocabs = hide_vocabs if isinstance(hide_vocabs, list) else []
-        sg: DiGraph
-        hidden_by_voc: Dict[str, Set[int]]
-        nonstandard_concepts_hidden: Set[int]
 
-        sg, concept_ids, hidden_dict, nonstandard_concepts_hidden = await concept_graph(
-            codeset_ids, cids, hide_vocabs, hide_nonstandard_concepts, verbose)
-        missing_from_graph = set(concept_ids) - set(sg.nodes)
+def concept_graph_ndjson(
+    rel_graph: CsrGraph, sg: CsrGraph, concept_ids: Set[int], hidden_by_vocab: Dict[str, Set[int]],
+    nonstandard_concepts_hidden: Set[int], descendants_truncated: bool, super_node_threshold: Optional[int] = None,
+    keep: Set[int] = None, chunk_size: int = NDJSON_CHUNK_SIZE
+) -> Iterator[str]:
+    """A /concept-graph response as newline-delimited JSON, one chunk at a time
 
-        await rpt.finish(rows=len(sg))
+    Edges are read chunk by chunk from the CSR arrays of the subgraph `sg` that concept_graph() found, and rollups are
+    looked up per chunk of nodes, so no response is built in memory. With `super_node_threshold`, super nodes are
+    condensed as by condense_response().
+
+    Lines, each an object with a 'type':
+      - 'header': descendants_truncated, and how many concept ids and edges follow
+      - 'nodes': up to `chunk_size` concept_ids, with their rollups
+      - 'edges': up to `chunk_size` edges
+      - 'missing_from_graph', 'nonstandard_concepts_hidden', and 'hidden_by_vocab' (with a 'vocab'): concept_ids
+      - 'super_nodes': if super nodes were condensed
+      - 'end': the response is complete. If this line is missing, the stream was cut off."""
+    condensed: np.ndarray = condensed_nodes(sg, super_node_threshold, keep) if super_node_threshold \
+        else np.zeros(len(sg), dtype=bool)
+    ids = np.sort(np.fromiter(concept_ids, dtype=NODE_ID_DTYPE, count=len(concept_ids)))
+    idxs, found = sg.index_of(ids)
+    shown = ~found
+    shown[found] = ~condensed[idxs]
+    ids, missing_from_graph = ids[shown], ids[~found]
+    # A condensed node has one parent, so one edge is dropped with it
+    n_edges = len(sg.fwd_targets) - int(condensed.sum())
+    yield json.dumps({
+        'type': 'header', 'descendants_truncated': descendants_truncated,
+        'n_concept_ids': len(ids), 'n_edges': n_edges}) + '\n'
+    for i in range(0, len(ids), chunk_size):
+        chunk: List[int] = ids[i:i + chunk_size].tolist()
+        chunk_rollups = rel_graph.rollups.lookup(rel_graph, chunk) if rel_graph.rollups is not None else {}
+        yield json.dumps({'type': 'nodes', 'concept_ids': chunk, 'rollups': chunk_rollups}) + '\n'
+    for i in range(0, len(sg.fwd_targets), chunk_size):
+        targets = sg.fwd_targets[i:i + chunk_size]
+        sources = np.searchsorted(sg.fwd_offsets, np.arange(i, i + len(targets)), side='right') - 1
+        kept = ~condensed[targets]
+        edges = np.stack([sg.node_ids[sources[kept]], sg.node_ids[targets[kept]]], axis=1)
+        if len(edges):
+            yield json.dumps({'type': 'edges', 'edges': edges.tolist()}) + '\n'
+    id_sets = [('missing_from_graph', {}, missing_from_graph.tolist()),
+               ('nonstandard_concepts_hidden', {}, nonstandard_concepts_hidden)] + \
+        [('hidden_by_vocab', {'vocab': vocab}, hidden) for vocab, hidden in hidden_by_vocab.items()]
+    for line_type, extra, hidden in id_sets:
+        hidden = sorted(hidden)
+        for i in range(0, len(hidden), chunk_size):
+            yield json.dumps({'type': line_type, **extra, 'concept_ids': hidden[i:i + chunk_size]}) + '\n'
+    if condensed.any():
+        parents = sg.rev_sources[sg.rev_offsets[np.flatnonzero(condensed)]]
+        super_node_idxs, n_condensed = np.unique(parents, return_counts=True)
+        n_children = np.diff(sg.fwd_offsets)[super_node_idxs]
+        super_nodes = {node: {'children': children, 'condensed': n} for node, children, n in zip(
+            sg.node_ids[super_node_idxs].tolist(), n_children.tolist(), n_condensed.tolist())}
+        yield json.dumps({'type': 'super_nodes', 'super_nodes': super_nodes}) + '\n'
+    yield json.dumps({'type': 'end'}) + '\n'
+
+
+@router.get("/expand-super-node")
+async def expand_super_node_route(
+    request: Request, super_node: int, codeset_ids: Optional[List[int]] = Query(None),
+    cids: Optional[List[int]] = Query(None), hide_vocabs = ['RxNorm Extension'], hide_nonstandard_concepts=False,
+    max_depth: int = Query(1, ge=0), max_nodes: Optional[int] = Query(None, ge=1), gap_fill: bool = False,
+    gap_fill_max_depth: int = Query(GAP_FILL_MAX_DEPTH, ge=2),
+    gap_fill_seconds: float = Query(GAP_FILL_SECONDS, gt=0, le=GAP_FILL_MAX_SECONDS),
+) -> Dict[str, Any]:
+    """Children of a super node that /concept-graph condensed. Takes the same params as the /concept-graph request."""
+    rpt = Api_logger()
+    try:
+        await rpt.start_rpt(request, params={'super_node': super_node, 'codeset_ids': codeset_ids, 'cids': cids})
+        response: Dict[str, Any] = await cached_concept_graph(
+            codeset_ids, cids or [], hide_vocabs, hide_nonstandard_concepts, VERBOSE, max_depth, max_nodes, gap_fill,
+            gap_fill_max_depth, gap_fill_seconds)
+        rel_graph: CsrGraph = get_rel_graph()
+        edges: List[Tuple[int, int]] = expand_super_node(rel_graph, super_node, response['concept_ids'])
+        children: List[int] = [target for _, target in edges]
+        await rpt.finish(rows=len(edges))
         return {
-            'edges': list(sg.edges),
-            'concept_ids': concept_ids,
-            'missing_from_graph': missing_from_graph,
-            'hidden_by_vocab': hidden_dict,
-            'nonstandard_concepts_hidden': nonstandard_concepts_hidden}
+            'super_node': super_node, 'edges': edges, 'concept_ids': children,
+            'rollups': {name: {c: values[c] for c in children if c in values}
+                        for name, values in response['rollups'].items()}}
+    except Exception as e:
+        await rpt.log_error(e)
+        raise e
+
+
+def connect_roots(g: CsrGraph, member_ids: List[int]) -> Dict[str, Any]:
+    """Response body for /connect-roots: CPU-bound, so routes run it in the threadpool"""
+    roots, common_ancestors, edges = g.connect_roots(member_ids)
+    path_ids: Set[int] = {c for edge in edges for c in edge}
+    depth_ids = sorted(set(roots) | set(common_ancestors) | path_ids)
+    return {
+        'roots': roots,
+        'n_components': len(g.components_spanned(roots)),
+        'common_ancestors': common_ancestors,
+        'edges': edges,
+        'concept_ids': sorted(path_ids - set(member_ids)),
+        'depths': dict(zip(depth_ids, g.depth_of(depth_ids).tolist())),
+    }
+
+
+@router.get("/connect-roots")
+async def connect_roots_route(
+    request: Request, codeset_ids: Optional[List[int]] = Query(None), cids: Optional[List[int]] = Query(None),
+) -> Dict[str, Any]:
+    """Where the disjoint fragments of a concept set meet
+
+    Finds the roots of the fragments (members with no ancestor among the members), their lowest common ancestors, and
+    edges on a shortest path from the deepest common ancestor down to each root. Depths are distances from the nearest
+    root of the whole hierarchy."""
+    rpt = Api_logger()
+    try:
+        await rpt.start_rpt(request, params={'codeset_ids': codeset_ids, 'cids': cids})
+        rel_graph: CsrGraph = get_rel_graph()
+        member_ids: List[int] = await get_cset_members_items_async(codeset_ids=codeset_ids, column='concept_id') \
+            if codeset_ids else []
+        member_ids.extend(cids or [])
+        response = await run_in_threadpool(connect_roots, rel_graph, member_ids)
+        await rpt.finish(rows=len(response['edges']))
+        return response
+    except Exception as e:
+        await rpt.log_error(e)
+        raise e
+
+
+@router.get("/components")
+async def components_route(
+    request: Request, codeset_ids: Optional[List[int]] = Query(None), cids: Optional[List[int]] = Query(None),
+) -> Dict[str, Any]:
+    """Which weakly connected components of the hierarchy a selection spans
+
+    Concepts in different components have no path between them in either direction, so e.g. gap filling or connecting
+    roots can only ever join concepts within one component."""
+    rpt = Api_logger()
+    try:
+        await rpt.start_rpt(request, params={'codeset_ids': codeset_ids, 'cids': cids})
+        rel_graph: CsrGraph = get_rel_graph()
+        concept_ids: List[int] = await get_cset_members_items_async(codeset_ids=codeset_ids, column='concept_id') \
+            if codeset_ids else []
+        concept_ids.extend(cids or [])
+        groups: Dict[int, List[int]] = await run_in_threadpool(rel_graph.components_spanned, concept_ids)
+        response = {
+            'components': [{'component': c, 'concept_ids': ids} for c, ids in sorted(groups.items())],
+            'missing_from_graph': sorted(set(concept_ids) - {c for ids in groups.values() for c in ids}),
+        }
+        await rpt.finish(rows=len(groups))
+        return response
+    except Exception as e:
+        await rpt.log_error(e)
+        raise e
+
+
+@router.get("/expand-codesets")
+async def expand_codesets_route(request: Request, codeset_ids: List[int] = Query(...)) -> Dict[int, List[int]]:
+    """Members of concept sets, expanded here from their expression items rather than fetched from the Enclave"""
+    rpt = Api_logger()
+    try:
+        await rpt.start_rpt(request, params={'codeset_ids': codeset_ids})
+        members: Dict[int, List[int]] = await expand_codesets(codeset_ids)
+        await rpt.finish(rows=sum(len(ids) for ids in members.values()))
+        return members
+    except Exception as e:
+        await rpt.log_error(e)
+        raise e
+
+
+@router.get("/check-expansion")
+async def check_expansion_route(request: Request, codeset_ids: List[int] = Query(...)) -> List[Dict[str, Any]]:
+    """Cross-check local expansions against the members fetched from the Enclave (concept_set_members)"""
+    rpt = Api_logger()
+    try:
+        await rpt.start_rpt(request, params={'codeset_ids': codeset_ids})
+        local: Dict[int, List[int]] = await expand_codesets(codeset_ids)
+        async with get_async_db_connection() as con:
+            rows = await sql_query_async(
+                con, 'SELECT codeset_id, concept_id FROM concept_set_members WHERE codeset_id = ANY(:codeset_ids);',
+                {'codeset_ids': codeset_ids}, return_with_keys=False)
+        enclave: Dict[int, Set[int]] = {}
+        for codeset_id, concept_id in rows:
+            enclave.setdefault(codeset_id, set()).add(concept_id)
+        report = []
+        for codeset_id in sorted(set(codeset_ids)):
+            local_ids, enclave_ids = set(local.get(codeset_id, [])), enclave.get(codeset_id, set())
+            report.append({
+                'codeset_id': codeset_id, 'local': len(local_ids), 'enclave': len(enclave_ids),
+                'match': local_ids == enclave_ids, 'missing_locally': sorted(enclave_ids - local_ids),
+                'extra_locally': sorted(local_ids - enclave_ids)})
+        await rpt.finish(rows=len(report))
+        return report
     except Exception as e:
         await rpt.log_error(e)
         raise e
 
 
+async def expand_codesets(codeset_ids: List[int], g: CsrGraph = None) -> Dict[int, List[int]]:
+    """Members of concept sets, from their concept_set_version_item flags and the relationship graph
+
+    Concept sets with no expression items get an empty list. See backend.concept_expansion. The expansion runs in the
+    threadpool, so that big concept sets don't hold up the event loop."""
+    g = g or get_rel_graph()
+    async with get_async_db_connection() as con:
+        items: List[Dict[str, Any]] = await sql_query_async(con, f"""
+            SELECT DISTINCT codeset_id, concept_id, {', '.join(f'"{flag}"' for flag in FLAGS)}
+            FROM concept_set_version_item
+            WHERE codeset_id = ANY(:codeset_ids);""", {'codeset_ids': codeset_ids})
+    members: Dict[int, List[int]] = await run_in_threadpool(expand_expressions, g, items)
+    return {**{codeset_id: [] for codeset_id in codeset_ids}, **members}
+
+
+@router.get("/indented-tree")
+async def indented_tree_route(
+    request: Request, codeset_ids: Optional[List[int]] = Query(None), cids: Optional[List[int]] = Query(None),
+    hide_vocabs = ['RxNorm Extension'], hide_nonstandard_concepts=False,
+    max_depth: int = Query(1, ge=0), max_nodes: Optional[int] = Query(None, ge=1), gap_fill: bool = False,
+    gap_fill_max_depth: int = Query(GAP_FILL_MAX_DEPTH, ge=2),
+    gap_fill_seconds: float = Query(GAP_FILL_SECONDS, gt=0, le=GAP_FILL_MAX_SECONDS),
+    budgets: List[int] = Query(TREE_LAYOUT_BUDGETS),
+    order: Literal['descendant_count', 'total_cnt', 'concept_id'] = 'descendant_count',
+) -> Dict[str, Any]:
+    """The /concept-graph hierarchy laid out as an indented tree, with collapse points for each node budget
+
+    Takes the same params as /concept-graph. See backend/tree_layout.py for the layout.
+    :param budgets: Node budgets to precompute collapse points for, e.g. 2000 for at most 2000 visible rows.
+    :param order: Sort siblings by number of distinct descendants or by total_cnt of them and their descendants,
+     biggest first, or just by concept id."""
+    rpt = Api_logger()
+    try:
+        await rpt.start_rpt(request, params={
+            'codeset_ids': codeset_ids, 'cids': cids, 'max_depth': max_depth, 'max_nodes': max_nodes,
+            'gap_fill': gap_fill, 'budgets': budgets, 'order': order})
+        response = await cached_tree_layout(
+            codeset_ids, cids or [], hide_vocabs, hide_nonstandard_concepts, max_depth, max_nodes, gap_fill,
+            gap_fill_max_depth, gap_fill_seconds, budgets, order)
+        await rpt.finish(rows=len(response['rows']))
+        return response
+    except Exception as e:
+        await rpt.log_error(e)
+        raise e
+
+
+async def cached_tree_layout(
+    codeset_ids: Union[List[int], None], cids: Union[List[int], None], hide_vocabs, hide_nonstandard_concepts,
+    max_depth: int, max_nodes: Optional[int], gap_fill: bool, gap_fill_max_depth: int, gap_fill_seconds: float,
+    budgets: List[int], order: str
+) -> Dict[str, Any]:
+    """/indented-tree response, from TREE_LAYOUT_CACHE if possible. Don't modify it; it may be shared."""
+    hide_vocabs = hide_vocabs if isinstance(hide_vocabs, list) else []
+    budgets = sorted({b for b in budgets if b > 0})
+    cache_key: Tuple = (
+        concept_graph_cache_key(
+            codeset_ids, cids, hide_vocabs, hide_nonstandard_concepts, max_depth, max_nodes, gap_fill,
+            gap_fill_max_depth), tuple(budgets), order)
+    cache_generation: Tuple = await concept_graph_cache_generation(get_rel_graph())
+    response: Optional[Dict[str, Any]] = TREE_LAYOUT_CACHE.get(cache_key, cache_generation)
+    if response is None:
+        graph: Dict[str, Any] = await cached_concept_graph(
+            codeset_ids, cids, hide_vocabs, hide_nonstandard_concepts, VERBOSE, max_depth, max_nodes, gap_fill,
+            gap_fill_max_depth, gap_fill_seconds)
+        sort_key: Dict[int, int] = graph['rollups'].get(order, {}) if order != 'concept_id' else {}
+        tree: IndentedTree = await run_in_threadpool(
+            IndentedTree.build, graph['edges'], graph['concept_ids'], sort_key, TREE_LAYOUT_MAX_ROWS)
+        response = {
+            **tree.to_json(budgets),
+            'missing_from_graph': graph['missing_from_graph'],
+            'hidden_by_vocab': graph['hidden_by_vocab'],
+            'nonstandard_concepts_hidden': graph['nonstandard_concepts_hidden'],
+            'descendants_truncated': graph['descendants_truncated'],
+        }
+        if not (gap_fill and graph['descendants_truncated']):  # as for /concept-graph
+            TREE_LAYOUT_CACHE.put(cache_key, response, cache_generation)
+    return response
+
+
+async def cached_concept_graph(
+    codeset_ids: Union[List[int], None], cids: Union[List[int], None], hide_vocabs, hide_nonstandard_concepts,
+    verbose: bool, max_depth: int, max_nodes: Optional[int], gap_fill=False,
+    gap_fill_max_depth: int = GAP_FILL_MAX_DEPTH, gap_fill_seconds: float = GAP_FILL_SECONDS
+) -> Dict[str, Any]:
+    """Full /concept-graph response, from CONCEPT_GRAPH_CACHE if possible. Don't modify it; it may be shared."""
+    hide_vocabs = hide_vocabs if isinstance(hide_vocabs, list) else []
+    rel_graph: CsrGraph = get_rel_graph()
+    cache_key: Tuple = concept_graph_cache_key(
+        codeset_ids, cids, hide_vocabs, hide_nonstandard_concepts, max_depth, max_nodes, gap_fill, gap_fill_max_depth)
+    cache_generation: Tuple = await concept_graph_cache_generation(rel_graph)
+    response: Optional[Dict[str, Any]] = CONCEPT_GRAPH_CACHE.get(cache_key, cache_generation)
+
+    if response is None:
+        sg: CsrGraph
+        hidden_by_voc: Dict[str, Set[int]]
+        nonstandard_concepts_hidden: Set[int]
+
+        sg, concept_ids, hidden_dict, nonstandard_concepts_hidden, descendants_truncated = await concept_graph(
+            codeset_ids, cids, hide_vocabs, hide_nonstandard_concepts, verbose, all_descendants=not gap_fill,
+            max_depth=max_depth, max_nodes=max_nodes, rel_graph=rel_graph, gap_fill_max_depth=gap_fill_max_depth,
+            gap_fill_seconds=gap_fill_seconds)
+        response = await run_in_threadpool(
+            concept_graph_response, rel_graph, sg, concept_ids, hidden_dict, nonstandard_concepts_hidden,
+            descendants_truncated)
+        if not (gap_fill and descendants_truncated):  # don't cache results cut short by the time budget
+            CONCEPT_GRAPH_CACHE.put(cache_key, response, cache_generation)
+    return response
+
+
+def concept_graph_response(
+    rel_graph: CsrGraph, sg: CsrGraph, concept_ids: Set[int], hidden_by_vocab: Dict[str, Set[int]],
+    nonstandard_concepts_hidden: Set[int], descendants_truncated: bool
+) -> Dict[str, Any]:
+    """/concept-graph response for the subgraph that concept_graph() found. CPU-bound, so run it in the threadpool."""
+    return {
+        'edges': sg.edges,
+        'concept_ids': concept_ids,
+        'missing_from_graph': set(concept_ids) - set(sg.nodes),
+        'hidden_by_vocab': hidden_by_vocab,
+        'nonstandard_concepts_hidden': nonstandard_concepts_hidden,
+        'descendants_truncated': descendants_truncated,
+        # For ordering siblings: distinct descendants, and total_cnt of the concept and its descendants
+        'rollups': rel_graph.rollups.lookup(rel_graph, list(concept_ids)) if rel_graph.rollups is not None else {}}
+
+
+@router.get("/concept-graph-cache-stats")
+def concept_graph_cache_stats() -> Dict[str, Any]:
+    """Hit/miss counters and size of this worker's /concept-graph cache"""
+    return CONCEPT_GRAPH_CACHE.stats()
+
+
+def concept_graph_cache_key(
+    codeset_ids: Union[List[int], None], cids: Union[List[int], None], hide_vocabs: List[str],
+    hide_nonstandard_concepts, max_depth: Optional[int], max_nodes: Optional[int], gap_fill=False,
+    gap_fill_max_depth: int = GAP_FILL_MAX_DEPTH
+) -> Tuple:
+    """Normalize /concept-graph params, so that requests that must get the same response get the same cache key"""
+    # In gap filling mode, max_depth and max_nodes aren't used, and vice versa
+    expansion = ('gap_fill', gap_fill_max_depth) if gap_fill else ('descendants', max_depth or None, max_nodes)
+    return (
+        tuple(sorted(set(codeset_ids or []))), tuple(sorted(set(cids or []))), tuple(sorted(set(hide_vocabs))),
+        bool(hide_nonstandard_concepts), expansion)
+
+
+async def concept_graph_cache_generation(g: CsrGraph) -> Tuple:
+    """What cached /concept-graph responses depend on: the last DB refresh, the last vocab refresh, and the graph
+
+    The refresh timestamps are re-read at most every CONCEPT_GRAPH_CACHE_CHECK_SECONDS, so after a refresh, stale
+    responses can be served for up to that long."""
+    if time.time() - _refresh_timestamps['checked'] > CONCEPT_GRAPH_CACHE_CHECK_SECONDS:
+        _refresh_timestamps['value'] = (
+            await check_db_status_var_async('last_refresh_success'),
+            await check_db_status_var_async('last_refreshed_vocab_tables'))
+        _refresh_timestamps['checked'] = time.time()
+    return *_refresh_timestamps['value'], g.meta.get('created')
+
+
+def _concept_graph_response_size(response: Dict[str, Any]) -> int:
+    """Cost of a cached /concept-graph response, for CONCEPT_GRAPH_CACHE_MAX_ITEMS"""
+    return len(response['edges']) + len(response['concept_ids'])
+
+
 async def concept_graph(
     codeset_ids: Union[List[int], None], cids: Union[List[int], None] = [], hide_vocabs = [],
-    hide_nonstandard_concepts=False, verbose = VERBOSE, all_descendants = True
- ) -> Tuple[DiGraph, Set[int], Set[int], Dict[str, Set[int]], Set[int]]:
+    hide_nonstandard_concepts=False, verbose = VERBOSE, all_descendants = True, max_depth: Optional[int] = 1,
+    max_nodes: Optional[int] = None, rel_graph: CsrGraph = None, gap_fill_max_depth: int = GAP_FILL_MAX_DEPTH,
+    gap_fill_seconds: float = GAP_FILL_SECONDS,
+ ) -> Tuple[CsrGraph, Set[int], Dict[str, Set[int]], Set[int], bool]:
     """Return concept graph
 
         concepts/concept_ids will include all definition and expansion concepts for codeset_ids
-            plus any cids that are passed in
+            plus any cids that are passed in, plus their descendants down to max_depth levels (0 or None: all levels)
+            or, if not all_descendants, just the concepts that fill gaps between them (see get_missing_in_between_nodes)
     :returns
-      hidden_by_voc: Map of vocab to set of concept ids"""
+      hidden_by_voc: Map of vocab to set of concept ids
+      descendants_truncated: True if max_nodes or gap_fill_seconds cut the search short"""
     timer = get_timer('')
     verbose and timer('concept_graph()')
+    # Hold on to one graph for the whole request, in case a refreshed one gets swapped in meanwhile
+    rel_graph: CsrGraph = rel_graph if rel_graph is not None else get_rel_graph()
 
-    # Get concepts & metadata
-    concepts_unfiltered: List[RowMapping] = get_cset_members_items(
-        codeset_ids=codeset_ids, columns=['concept_id', 'vocabulary_id', 'standard_concept'])
-    concepts: List[Dict[str, Any]]
+    # Concept attributes for filtering come from the graph's in-memory column store when it has one
+    attributes: Optional[ConceptAttributes] = rel_graph.attributes
     hidden_by_voc: Dict[str, Set[int]]
     nonstandard_concepts_hidden: Set
 
-    if cids:
-        more_concepts = get_concepts(cids)
-        concepts_unfiltered.extend(more_concepts)
+    # Get concepts & metadata
+    if attributes is not None:
+        member_ids: List[int] = await get_cset_members_items_async(codeset_ids=codeset_ids, column='concept_id')
+        if cids:  # like get_concepts(cids), only keep ones in concepts_with_counts
+            member_ids.extend(np.asarray(cids)[attributes.index_of(cids)[1]].tolist())
+        # - filter: by vocab & non-standard
+        kept, hidden_by_voc, nonstandard_concepts_hidden = attributes.filter(
+            member_ids, hide_vocabs, hide_nonstandard_concepts)
+        concept_ids: Set[int] = set(kept.tolist())
+    else:
+        concepts_unfiltered: List[RowMapping] = await get_cset_members_items_async(
+            codeset_ids=codeset_ids, columns=['concept_id', 'vocabulary_id', 'standard_concept'])
+        concepts: List[Dict[str, Any]]
+
+        if cids:
+            more_concepts = await get_concepts_async(cids)
+            concepts_unfiltered.extend(more_concepts)
 
-    # - filter: by vocab & non-standard
-    concepts, hidden_by_voc, nonstandard_concepts_hidden = filter_concepts(
-        concepts_unfiltered, hide_vocabs, hide_nonstandard_concepts)
-    concept_ids: Set[int] = set([c['concept_id'] for c in concepts])
+        # - filter: by vocab & non-standard
+        concepts, hidden_by_voc, nonstandard_concepts_hidden = filter_concepts(
+            concepts_unfiltered, hide_vocabs, hide_nonstandard_concepts)
+        concept_ids: Set[int] = set([c['concept_id'] for c in concepts])
     # concept_ids.update(cids)  # future
 
     # 2024-10-22. What if we get all descendants, not just missing in between?
     # 2024-11-18. It's been working ok. Now getting rid of all missing-in-between stuff.
     #               Return to commit fdb472ee1bf14156e87c324f2d7297ea2df3601d to get it back.
-    more_concept_ids: Set[int] = get_all_descendants(REL_GRAPH, concept_ids)
+    # Missing in-between is back as an opt-in, now a bounded search on the CSR graph.
+    more_concept_ids: Set[int]
+    descendants_truncated: bool
+    if all_descendants:
+        more_concept_ids, descendants_truncated = await run_in_threadpool(
+            get_all_descendants, rel_graph, concept_ids, max_depth, max_nodes)
+    else:
+        more_concept_ids, descendants_truncated = await run_in_threadpool(
+            get_missing_in_between_nodes, rel_graph, concept_ids, gap_fill_max_depth, gap_fill_seconds)
 
     # merge and filter
-    more_concepts: List[RowMapping] = get_concepts(more_concept_ids)
-    concepts_m: List[Dict]
     hidden_by_voc_m: Dict[str, Set[int]]
     nonstandard_concepts_hidden_m: Set
     # - filter more_concepts: by vocab & non-standard
-    concepts_m, hidden_by_voc_m, nonstandard_concepts_hidden_m = filter_concepts(
-        more_concepts, hide_vocabs, hide_nonstandard_concepts)
+    if attributes is not None:
+        _, hidden_by_voc_m, nonstandard_concepts_hidden_m = attributes.filter(
+            list(more_concept_ids), hide_vocabs, hide_nonstandard_concepts)
+    else:
+        more_concepts: List[RowMapping] = await get_concepts_async(more_concept_ids)
+        _, hidden_by_voc_m, nonstandard_concepts_hidden_m = filter_concepts(
+            more_concepts, hide_vocabs, hide_nonstandard_concepts)
 
     # Merge: more_concepts into concept_ids
     concept_ids.update(more_concept_ids)
@@ -121,24 +584,43 @@ async def concept_graph(
     nonstandard_concepts_hidden = nonstandard_concepts_hidden.union(nonstandard_concepts_hidden_m)
 
     # Get subgraph
-    sg: DiGraph = REL_GRAPH.subgraph(concept_ids)
+    sg: CsrGraph = await run_in_threadpool(rel_graph.subgraph, concept_ids)
 
     # Return
     verbose and timer('done')
-    return sg, concept_ids, hidden_by_voc, nonstandard_concepts_hidden
+    return sg, concept_ids, hidden_by_voc, nonstandard_concepts_hidden, descendants_truncated
+
+
+def get_missing_in_between_nodes(
+    g: CsrGraph, subgraph_nodes: Union[List[int], Set[int]], max_depth: int = None, seconds: float = None
+) -> Tuple[Set[int], bool]:
+    """Gap filling: get nodes that connect the subgraph nodes, i.e., on a path from one of them down to another
 
+    See "Gap filling" in docs/graph.md.
+    :param max_depth: Longest path to look for, in edges. Paths through a lot of missing nodes are unlikely to be
+     useful to show, and allowing them makes the search much bigger.
+    :param seconds: Time budget. If it runs out, the nodes found so far are returned.
+    :returns (missing_in_between, truncated): truncated is True if the time budget ran out."""
+    max_depth = max_depth or GAP_FILL_MAX_DEPTH
+    deadline = time.monotonic() + (seconds or GAP_FILL_SECONDS)
+    between, complete = g.nodes_between(list(subgraph_nodes), max_depth, deadline)
+    return set(between.tolist()), not complete
 
-def get_all_descendants(g: nx.DiGraph, subgraph_nodes: Union[List[int], Set[int]]) -> Set[int]:
+
+def get_all_descendants(
+    g: CsrGraph, subgraph_nodes: Union[List[int], Set[int]], max_depth: Optional[int] = 1, max_nodes: int = None
+) -> Tuple[Set[int], bool]:
     """Get all descendants of a set of nodes
 
     Using this instead of get_missing_in_between_nodes. this way the front end has the entire descendant tree for all
     concepts being looked at.
+
+    :param max_depth: Levels to descend. 1 (the default) is just direct children. 0 or None for no limit.
+    :param max_nodes: Optional cap on the number of descendants returned.
+    :returns (descendants, truncated): truncated is True if max_nodes was hit before the search finished.
     """
-    descendants: Set[int] = set()
-    for node in subgraph_nodes:
-        if g.has_node(node):
-            descendants.update(g.successors(node))
-    return descendants
+    descendants, _, complete = g.traverse(subgraph_nodes, max_depth or None, max_nodes)
+    return set(descendants.tolist()), not complete
 
 
 # TODO: @Siggie: move below to frontend
@@ -166,6 +648,7 @@ def filter_concepts(
 ) -> Tuple[List[Dict], Dict[str, Set[int]], Set[int]]:
     """Get lists of concepts for graph
 
+    Fallback for when the graph has no concept attributes loaded; see ConceptAttributes.filter().
     :param: concepts: List of concept ids as keys, and metadata as values.
     :returns
       hidden_by_voc: Map of vocab to set of concept ids"""
@@ -194,55 +677,102 @@ print_stack = lambda s: ' | '.join([f"{n} => {','.join([str(x) for x in p])}" fo
 
 
 @router.get("/wholegraph")
-def wholegraph():
-    """Get subgraph edges for the whole graph"""
-    return list(REL_GRAPH.edges)
+def wholegraph(request: Request = None, http_response: Response = None):
+    """Get subgraph edges for the whole graph
 
+    With `Accept: application/vnd.termhub.edges`, in the compact binary encoding described in backend/edge_encoding.py
 
-def condense_super_nodes(sg, threshhold=10):  # todo
-    """Condense super nodes"""
-    super_nodes = [node for node, degree in sg.out_degree() if degree > threshhold]
-    # for node in super_nodes:
-    # sg.discard(node) -- n
-    return NotImplementedError(super_nodes)
+    Normally served from files precompressed when the graph was loaded (see backend/graph_artifacts.py), with an ETag
+    for If-None-Match and Range requests. Clients that accept neither gzip nor zstd get it serialized on the fly."""
+    g: CsrGraph = get_rel_graph()
+    binary: bool = request is not None and accepts_binary_edges(request.headers.get('accept'))
+    encoding: Optional[str] = choose_encoding(request.headers.get('accept-encoding')) if request is not None else None
+    if encoding:
+        try:
+            return artifact_response(
+                request, WHOLEGRAPH_ARTIFACTS_DIR, artifact_version(g), 'edges' if binary else 'json', encoding)
+        except FileNotFoundError:  # not built yet, or this worker is still on a graph whose artifacts were replaced
+            pass
+    if binary:
+        return Response(encode_response(*g.edge_arrays()), media_type=EDGES_MEDIA_TYPE, headers={'Vary': 'Accept'})
+    if http_response is not None:
+        http_response.headers['Vary'] = 'Accept'
+    return list(g.edges)
 
 
-# noinspection PyPep8Naming
-def expand_super_node(G, subgraph_nodes, super_node):  # todo
-    """Expand super node"""
-    # sg = G.subgraph(subgraph_nodes)
-    return NotImplementedError(G, subgraph_nodes, super_node)
+def condense_super_nodes(
+    edges: List[Tuple[int, int]], threshold: int = 10, keep: Set[int] = None
+) -> Tuple[List[Tuple[int, int]], Dict[int, Dict[str, int]], Set[int]]:
+    """Condense super nodes: nodes with more than `threshold` children
+
+    A super node's children that are leaves with no other parent are dropped, along with their edges, and the super node
+    gets a placeholder entry with counts instead. Children that have children of their own or other parents stay, so
+    nothing else in the graph gets disconnected.
+
+    :param keep: Concepts to never drop, e.g. ones the user asked for explicitly.
+    :returns (edges, super_nodes, condensed): The remaining edges; for each super node, how many children it has and
+     how many were dropped; and the dropped concept ids."""
+    if not edges:
+        return edges, {}, set()
+    edge_arr = np.array(edges, dtype=NODE_ID_DTYPE).reshape(-1, 2)
+    sources, targets = edge_arr[:, 0], edge_arr[:, 1]
+    nodes, out_degree = np.unique(sources, return_counts=True)
+    big = nodes[out_degree > threshold]
+    if not len(big):
+        return edges, {}, set()
+    children, in_degree = np.unique(targets, return_counts=True)
+    is_leaf = ~np.isin(targets, nodes)
+    only_parent = in_degree[np.searchsorted(children, targets)] == 1
+    drop = np.isin(sources, big) & is_leaf & only_parent
+    if keep:
+        drop &= ~np.isin(targets, np.fromiter(keep, dtype=NODE_ID_DTYPE, count=len(keep)))
+    if not drop.any():
+        return edges, {}, set()
+
+    dropped_by_node = dict(zip(*[x.tolist() for x in np.unique(sources[drop], return_counts=True)]))
+    children_by_node = dict(zip(nodes.tolist(), out_degree.tolist()))
+    super_nodes = {
+        node: {'children': children_by_node[node], 'condensed': n_dropped}
+        for node, n_dropped in dropped_by_node.items()}
+    kept = edge_arr[~drop]
+    return list(zip(kept[:, 0].tolist(), kept[:, 1].tolist())), super_nodes, set(targets[drop].tolist())
+
+
+def condensed_nodes(sg: CsrGraph, threshold: int, keep: Set[int] = None) -> np.ndarray:
+    """Which nodes of a subgraph condense_super_nodes() would drop, as a boolean mask over its node indexes: leaves
+    whose only parent has more than `threshold` children, unless they are in `keep`"""
+    out_degree, in_degree = np.diff(sg.fwd_offsets), np.diff(sg.rev_offsets)
+    condensed = (out_degree == 0) & (in_degree == 1)
+    idxs = np.flatnonzero(condensed)
+    condensed[idxs[out_degree[sg.rev_sources[sg.rev_offsets[idxs]]] <= threshold]] = False
+    if keep:
+        condensed[sg.index_of(list(keep))[0]] = False
+    return condensed
+
+
+def condense_response(response: Dict[str, Any], threshold: int, keep: Set[int] = None) -> Dict[str, Any]:
+    """A /concept-graph response with its super nodes condensed, per condense_super_nodes(). Everything about the
+    condensed concepts is left out, rollups included, so the payload doesn't grow with them."""
+    edges, super_nodes, condensed = condense_super_nodes(response['edges'], threshold, keep)
+    if not condensed:
+        return response
+    return {
+        **response, 'edges': edges, 'concept_ids': response['concept_ids'] - condensed,
+        'missing_from_graph': response['missing_from_graph'] - condensed,
+        'rollups': {name: {c: n for c, n in values.items() if c not in condensed}
+                    for name, values in response['rollups'].items()},
+        'super_nodes': super_nodes}
+
+
+def expand_super_node(g: CsrGraph, super_node: int, concept_ids: Set[int]) -> List[Tuple[int, int]]:
+    """Expand super node: edges from `super_node` to its children among `concept_ids`, the concepts of the response
+    that condense_super_nodes() condensed, to restore what it dropped"""
+    return [(super_node, child) for child in g.successors(super_node) if child in concept_ids]
 
 
 def from_pydot_layout(g):  # Todo
     """From PyDot layout"""
     return NotImplementedError(g)
-# def find_nearest_common_ancestor(G, nodes):
-#     all_ancestors = [set(nx.ancestors(G, node)) for node in nodes]
-#     common_ancestors = set.intersection(*all_ancestors)
-#
-#     # Find the lowest common ancestor
-#     lowest_common_ancestor = None
-#     for ancestor in common_ancestors:
-#         if all(ancestor in ancestors or ancestor == node for node, ancestors in zip(nodes, all_ancestors)):
-#             if lowest_common_ancestor is None or not ancestor in nx.ancestors(G, lowest_common_ancestor):
-#                 lowest_common_ancestor = ancestor
-#
-#     return lowest_common_ancestor
-#
-#
-# def connect_roots(G, target_nodes):
-#     # Find the nearest common ancestor
-#     nca = find_nearest_common_ancestor(G, target_nodes)
-#
-#     # Create a subgraph including the paths from the nearest common ancestor to the target nodes
-#     edges_to_include = set()
-#     for node in target_nodes:
-#         path = nx.shortest_path(G, nca, node)
-#         edges_to_include.update([tuple(l) for l in zip(path, path[1:])])
-#
-#     SG = G.edge_subgraph(edges_to_include).copy()
-#     return SG
 
 
 def generate_graph_edges() -> Iterable[Row]:
@@ -260,51 +790,126 @@ def generate_graph_edges() -> Iterable[Row]:
             yield row
 
 
+def load_graph_edges(progress: Callable[[int], None] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Stream all graph edges straight into arrays of source and target ids, using binary COPY
+
+    Replaces iterating generate_graph_edges(), whose per-row Python overhead dominated rebuild time.
+    :param progress: Called with the number of rows loaded so far, every million rows."""
+    table = f'{SCHEMA}.concept_graph'
+    with get_db_connection() as con:
+        expected_rows: int = estimated_row_count(con, table)
+        # Headroom, since the planner's estimate can be a little low; arrays are trimmed at the end anyway
+        sources, targets = copy_int_columns(
+            con, f'(SELECT source_id, target_id FROM {table})', 2, int(max(expected_rows, 0) * 1.05), progress)
+    return sources, targets
+
+
+def load_concept_attributes() -> ConceptAttributes:
+    """Load the attributes graph requests filter on, for every concept, into a column store
+
+    Text columns are dictionary-encoded in the query itself, so everything streams back through binary COPY as integers.
+    """
+    table = f'{SCHEMA}.concepts_with_counts'
+    with get_db_connection() as con:
+        dictionaries: Dict[str, List[str]] = dict(sql_query(con, f"""
+            SELECT array_agg(DISTINCT vocabulary_id::text ORDER BY vocabulary_id::text) FILTER (
+                    WHERE vocabulary_id IS NOT NULL) AS vocabularies,
+                array_agg(DISTINCT domain_id::text ORDER BY domain_id::text) FILTER (
+                    WHERE domain_id IS NOT NULL) AS domains,
+                array_agg(DISTINCT concept_class_id::text ORDER BY concept_class_id::text) FILTER (
+                    WHERE concept_class_id IS NOT NULL) AS concept_classes
+            FROM {table};""")[0])
+        dictionaries = {k: v or [] for k, v in dictionaries.items()}
+        query = sql.SQL("""(
+            SELECT concept_id::bigint,
+                COALESCE(array_position({}::text[], vocabulary_id::text), 0)::int,
+                COALESCE(array_position({}::text[], domain_id::text), 0)::int,
+                COALESCE(array_position({}::text[], concept_class_id::text), 0)::int,
+                COALESCE(ascii(standard_concept), 0)::int,
+                COALESCE(total_cnt, 0)::bigint
+            FROM {})""").format(
+            sql.Literal(dictionaries['vocabularies']), sql.Literal(dictionaries['domains']),
+            sql.Literal(dictionaries['concept_classes']), sql.SQL(table))
+        # noinspection PyUnresolvedReferences false_positive
+        query = query.as_string(con.connection.connection)
+        columns: List[np.ndarray] = copy_int_columns(con, query, 6, max(estimated_row_count(con, table), 0))
+    return ConceptAttributes.from_columns(
+        *columns, dictionaries['vocabularies'], dictionaries['domains'], dictionaries['concept_classes'])
+
+
+def load_concept_mappings() -> ConceptMappings:
+    """Load every "Maps to" relationship, for expanding includeMapped expression items. See backend.concept_expansion."""
+    table = f'{SCHEMA}.concept_relationship'
+    with get_db_connection() as con:
+        sources, targets = copy_int_columns(
+            con, f"""(SELECT concept_id_1::bigint, concept_id_2::bigint FROM {table}
+                WHERE relationship_id = 'Maps to' AND concept_id_1 != concept_id_2)""", 2)
+    return ConceptMappings.from_pairs(sources, targets)
+
+
+def set_concept_attributes(g: CsrGraph):
+    """Load concept attributes into `g`, noting the counts refresh they are from, and compute rollups from them"""
+    # Recorded before loading, as for vocab_last_refreshed
+    g.meta['counts_last_refreshed'] = check_db_status_var('last_refreshed_counts_tables')
+    g.attributes = load_concept_attributes()
+    g.rollups = DescendantRollups.build(g)
+
+
+def are_concept_attributes_current(g: CsrGraph) -> bool:
+    """Does `g` have concept attributes and rollups, with total_cnt from the latest counts refresh?"""
+    if g.attributes is None or g.rollups is None:
+        return False
+    counts_last_refreshed: Optional[str] = check_db_status_var('last_refreshed_counts_tables')
+    built_from: Optional[str] = g.meta.get('counts_last_refreshed')
+    return not counts_last_refreshed or bool(built_from) and dp.parse(built_from) >= dp.parse(counts_last_refreshed)
+
+
 # todo: control verbosity?
-def create_rel_graphs(save_to_pickle: bool) -> DiGraph:
-    """Create relationship graphs"""
+def create_rel_graphs(save_snapshot: bool, snapshot_path: str = GRAPH_SNAPSHOT_PATH) -> CsrGraph:
+    """Create relationship graphs
+
+    :param save_snapshot: Write the graph to `snapshot_path` so that other workers and later restarts can mmap it."""
     timer = get_timer('create_rel_graphs')
 
     timer('get edge records')
-    edge_generator = generate_graph_edges()
+    # Recorded before reading edges, so that a vocab refresh that lands mid-build makes this snapshot look outdated
+    vocab_last_refreshed: str = check_db_status_var('last_refreshed_vocab_tables')
+    sources, targets = load_graph_edges(progress=lambda n: timer(f'{commify(n)} rows loaded'))
 
+    timer('building CSR arrays')
     # noinspection PyPep8Naming
-    G = nx.DiGraph()
-    if save_to_pickle:
-        msg = 'loading and pickling'
-        pickle_file = open(GRAPH_PATH, 'ab')
-    else:
-        msg = 'loading'
-        pickle_file = None
-
-    timer(msg)
-    rownum = 0
-    chunk_size = 10000
-    msg = msg.replace('ing', 'ed')
-    edges = []
-    chunks_loaded = 0
-    for source, target in edge_generator:
-        edges.append((source, target))
-        rownum += 1
-        if rownum >= chunk_size:
-            chunks_loaded += 1
-            G.add_edges_from(edges)
-            edges = []
-            if chunks_loaded % 100 == 0:
-                timer(f'{commify(chunks_loaded * chunk_size)} rows {msg}')
-            rownum = 0
-
-    if save_to_pickle:
-        timer('saving to pickle')
-        pickle.dump(G, pickle_file)  # , pickle.HIGHEST_PROTOCOL
+    G = CsrGraph.from_edges(sources, targets)
+    G.meta = {'vocab_last_refreshed': vocab_last_refreshed, 'created': current_datetime()}
+    timer('building indexes')
+    G.build_indexes()
+    timer('loading concept attributes')
+    set_concept_attributes(G)
+    timer('loading "Maps to" mappings')
+    G.mappings = load_concept_mappings()
+
+    if save_snapshot:
+        timer(f'saving snapshot to {snapshot_path}')
+        save_graph_snapshot(G, snapshot_path)
+        # Serve from the mmap'd file, like every other worker, rather than keeping a private in-heap copy
+        del G
+        G = load_graph_snapshot(snapshot_path)
 
     timer('done')
     return G # , Gu
 
 
-def is_graph_up_to_date(graph_path: str = GRAPH_PATH) -> bool:
-    """Determine if the networkx relationship_graph derived from OMOP vocab is current"""
+def is_graph_up_to_date(graph_path: str = GRAPH_SNAPSHOT_PATH) -> bool:
+    """Determine if the relationship_graph derived from OMOP vocab is current
+
+    Snapshots record the vocab refresh they were built from. For anything else, e.g. an old pickle, fall back to
+    comparing against the file's modification time."""
     voc_last_updated = dp.parse(check_db_status_var('last_refreshed_vocab_tables'))
+    try:
+        built_from: Optional[str] = read_snapshot_meta(graph_path).get('vocab_last_refreshed')
+        if built_from:
+            return dp.parse(built_from) >= voc_last_updated
+    except SnapshotFormatError:
+        pass
     graph_last_updated = datetime.fromtimestamp(os.path.getmtime(graph_path))
     if voc_last_updated.tzinfo and not graph_last_updated.tzinfo:  # if one has timezone, both need
         graph_last_updated = graph_last_updated.replace(tzinfo=voc_last_updated.tzinfo)
@@ -312,31 +917,180 @@ def is_graph_up_to_date(graph_path: str = GRAPH_PATH) -> bool:
 
 
 # noinspection PyPep8Naming for_G
-def load_relationship_graph(graph_path: str = GRAPH_PATH, update_if_outdated=True, save=True) -> DiGraph:
-    """Load relationship graph from disk"""
+def load_relationship_graph(graph_path: str = GRAPH_SNAPSHOT_PATH, update_if_outdated=True, save=True) -> CsrGraph:
+    """Load relationship graph from disk
+
+    The snapshot is memory-mapped, so all workers on a host share one copy. If there is no snapshot yet but there is an
+    up-to-date pickle from before snapshots existed, it is converted and saved as a snapshot. With TERMHUB_GRAPH_SHARDED
+    set, the graph is also split into per-vocabulary shards, and a ShardedGraph over them is returned instead, so that
+    only the shards in use are mapped, not the full snapshot."""
     timer = get_timer('./load_relationship_graph')
     timer(f'loading {graph_path}')
-    up_to_date = True if not update_if_outdated else is_graph_up_to_date(graph_path)
+    if not os.path.isfile(graph_path) and os.path.isfile(GRAPH_PATH) and \
+            (not update_if_outdated or is_graph_up_to_date(GRAPH_PATH)):
+        timer(f'converting {GRAPH_PATH} to snapshot')
+        with open(GRAPH_PATH, 'rb') as pickle_file:
+            G: Union[CsrGraph, DiGraph] = pickle.load(pickle_file)
+        G = CsrGraph.from_networkx(G) if isinstance(G, DiGraph) else G
+        G.meta = {'created': current_datetime()}
+        G.build_indexes()
+        save_graph_snapshot(G, graph_path)
+    up_to_date = True if not update_if_outdated else \
+        os.path.isfile(graph_path) and is_graph_up_to_date(graph_path)
     if os.path.isfile(graph_path) and up_to_date:
-        with open(graph_path, 'rb') as pickle_file:
-            G: DiGraph = pickle.load(pickle_file)
+        G: CsrGraph = load_graph_snapshot(graph_path)
+        reload_attributes = update_if_outdated and not are_concept_attributes_current(G)
+        reload_mappings = update_if_outdated and G.mappings is None  # snapshot from before mappings were saved with it
+        if reload_attributes:
+            # Counts refresh, or a snapshot from before attributes were saved with it: only the attributes (and rollups,
+            # which use total_cnt) need redoing
+            timer('reloading concept attributes')
+            set_concept_attributes(G)
+        if reload_mappings:
+            timer('loading "Maps to" mappings')
+            G.mappings = load_concept_mappings()
+        if reload_attributes or reload_mappings:
+            G.meta['created'] = current_datetime()
+            if save:
+                save_graph_snapshot(G, graph_path)
+                G = load_graph_snapshot(graph_path)
     else:
-        G: DiGraph = create_rel_graphs(save)
+        G: CsrGraph = create_rel_graphs(save, graph_path)
+    if GRAPH_SHARDED and save:
+        timer('sharding by vocabulary')
+        version: str = write_graph_shards(G, GRAPH_SHARDS_DIR)
+        del G  # let go of the full snapshot's mapping
+        G = ShardedGraph(GRAPH_SHARDS_DIR, version, GRAPH_SHARD_BUDGET_MB << 20, GRAPH_PINNED_SHARDS)
     timer('done')
     return G
 
 
-LOAD_FROM_PICKLE = False
-LOAD_RELGRAPH = True
+def get_rel_graph() -> CsrGraph:
+    """Get the current relationship graph
+
+    Callers should call this once and keep using the graph they got for the rest of the request. When a refreshed graph
+    is swapped in, requests already in flight finish on the old one, which is freed when they let go of it.
+
+    In the app, the graph is loaded in the background at startup (see start_loading_rel_graph()); until it is ready,
+    this raises a 503 with a Retry-After header. Anywhere else, e.g. scripts and tests, it is loaded on first use."""
+    if REL_GRAPH is None and not _rel_graph_status['background']:
+        if not refresh_rel_graph(wait=True) and REL_GRAPH is None:
+            raise RuntimeError(f'Could not load relationship graph: {_rel_graph_status["error"]}')
+    maybe_refresh_rel_graph()
+    graph: Optional[CsrGraph] = REL_GRAPH
+    if graph is None:
+        raise HTTPException(
+            status_code=503, headers={'Retry-After': str(GRAPH_NOT_READY_RETRY_AFTER_SECONDS)},
+            detail='The concept relationship graph is still loading. Please try again shortly.')
+    return graph
+
 
-if __name__ == '__main__':
-    pass
-else:
-    # if you don't want graph loaded, then somewhere up in the import tree, do this
-    #   import builtins
-    #   builtins.DONT_LOAD_GRAPH = True
-    import builtins
-    if hasattr(builtins, 'DONT_LOAD_GRAPH') and builtins.DONT_LOAD_GRAPH:
+def start_loading_rel_graph():
+    """Load the relationship graph in a background thread, so the app can start serving non-graph routes right away
+
+    If you don't want the graph loaded, somewhere up in the import tree, do this:
+      import builtins
+      builtins.DONT_LOAD_GRAPH = True"""
+    if getattr(builtins, 'DONT_LOAD_GRAPH', False):
         warnings.warn('not loading relationship graph')
-    else:
-        REL_GRAPH = load_relationship_graph()
+        return
+    _rel_graph_status['background'] = True
+    threading.Thread(target=refresh_rel_graph, name='load_rel_graph', daemon=True).start()
+
+
+def rel_graph_status() -> Dict[str, Any]:
+    """Is the relationship graph loaded, and if so, which one? For the /ready endpoint."""
+    graph: Optional[CsrGraph] = REL_GRAPH
+    return {
+        'ready': graph is not None,
+        'loading': _graph_refresh_lock.locked(),
+        'error': _rel_graph_status['error'],
+        'loaded_at': _rel_graph_status['loaded_at'],
+        'nodes': graph.number_of_nodes() if graph is not None else None,
+        'edges': graph.number_of_edges() if graph is not None else None,
+        'vocab_last_refreshed': graph.meta.get('vocab_last_refreshed') if graph is not None else None,
+        'shards': graph.stats() if isinstance(graph, ShardedGraph) else None,
+    }
+
+
+def swap_rel_graph(g: CsrGraph):
+    """Replace the relationship graph used by new requests. Rebinding a module global is atomic."""
+    global REL_GRAPH
+    REL_GRAPH = g
+    _rel_graph_status['loaded_at'] = current_datetime()
+    _rel_graph_status['error'] = None
+
+
+@throttle(GRAPH_REFRESH_CHECK_SECONDS)
+def maybe_refresh_rel_graph():
+    """Every so often, check for a newer graph in the background. Cheap to call on every request."""
+    if not _graph_refresh_lock.locked():
+        threading.Thread(target=refresh_rel_graph, name='refresh_rel_graph', daemon=True).start()
+
+
+def is_rel_graph_current(g: CsrGraph, graph_path: str = GRAPH_SNAPSHOT_PATH) -> bool:
+    """Is `g` built from the latest vocab and the same as the snapshot on disk?
+
+    A different snapshot on disk means another worker (or a manual `create_rel_graphs()`) already built a newer one."""
+    if os.path.isfile(graph_path) and read_snapshot_meta(graph_path).get('created') != g.meta.get('created'):
+        return False
+    built_from: Optional[str] = g.meta.get('vocab_last_refreshed')
+    if not built_from:  # e.g. converted from a legacy pickle
+        return os.path.isfile(graph_path) and is_graph_up_to_date(graph_path)
+    vocab_last_refreshed: Optional[str] = check_db_status_var('last_refreshed_vocab_tables')
+    if vocab_last_refreshed and dp.parse(built_from) < dp.parse(vocab_last_refreshed):
+        return False
+    return are_concept_attributes_current(g)
+
+
+def refresh_rel_graph(graph_path: str = GRAPH_SNAPSHOT_PATH, wait=False) -> bool:
+    """Load the relationship graph, or rebuild it if it is outdated, then swap it in
+
+    Only one refresh runs at a time per process. Across processes, a lock file makes sure only one worker rebuilds the
+    snapshot from the database; the others wait for it and then just mmap the new file.
+    :param wait: If another refresh is already running in this process, wait for it instead of returning right away.
+    :returns: True if a new graph was swapped in."""
+    if not _graph_refresh_lock.acquire(blocking=wait):
+        return False
+    try:
+        current: Optional[CsrGraph] = REL_GRAPH
+        if current is not None and is_rel_graph_current(current, graph_path):
+            return False
+        os.makedirs(os.path.dirname(graph_path), exist_ok=True)
+        with open(graph_path + '.lock', 'w') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                g: CsrGraph = load_relationship_graph(graph_path)
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        swap_rel_graph(g)
+        print(f'Swapped in relationship graph built from vocab refresh of {g.meta.get("vocab_last_refreshed")}: {g}')
+        if _rel_graph_status['background']:  # in the app, not scripts or tests
+            try:
+                build_wholegraph_artifacts(g, WHOLEGRAPH_ARTIFACTS_DIR)
+            except Exception as err:  # /wholegraph falls back to serializing on the fly
+                warnings.warn(f'Failed to build /wholegraph artifacts: {err}')
+        return True
+    except Exception as err:
+        # Keep serving the old graph, if any; we'll try again on the next check
+        _rel_graph_status['error'] = str(err)
+        warnings.warn(f'Failed to load relationship graph: {err}')
+        return False
+    finally:
+        _graph_refresh_lock.release()
+
+
+LOAD_FROM_PICKLE = False
+LOAD_RELGRAPH = True
+REL_GRAPH: Optional[CsrGraph] = None
+_graph_refresh_lock = threading.Lock()
+# background: True once the app has started loading the graph in the background, after which get_rel_graph() won't
+#  block to load it
+_rel_graph_status: Dict[str, Any] = {'background': False, 'error': None, 'loaded_at': None}
+CONCEPT_GRAPH_CACHE = LruCache(
+    CONCEPT_GRAPH_CACHE_MAX_ENTRIES, CONCEPT_GRAPH_CACHE_MAX_ITEMS, _concept_graph_response_size)
+TREE_LAYOUT_CACHE = LruCache(
+    TREE_LAYOUT_CACHE_MAX_ENTRIES, TREE_LAYOUT_CACHE_MAX_ROWS, lambda response: len(response['rows']))
+_refresh_timestamps: Dict[str, Any] = {'checked': 0.0, 'value': (None, None)}
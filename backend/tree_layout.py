@@ -0,0 +1,133 @@
+"""Indented tree layout of a concept graph, laid out on the server so the browser only has to render rows
+
+The tree is the depth-first order of the graph from its roots, siblings sorted by a key (by default, the number of
+distinct descendants, biggest first). In a DAG, a concept with several parents is a row under each of them, as in the
+hierarchy table in the UI. Each row has its depth and `subtree_rows`, the number of rows under it, so the rows hidden
+under a collapsed row are always the next `subtree_rows` rows.
+
+Rather than the client deciding what to collapse ("hide if over N"), the layout comes with collapse points for a few
+node budgets (e.g. 2k, 4k, 6k rows): the rows to show collapsed so that no more than that many rows are visible. Rows
+are expanded breadth-first: all roots are visible, and then, a level at a time, rows are expanded in tree order while
+their children still fit in the budget. Once a row's children don't fit, the rest of that level stays collapsed, but
+deeper levels under rows that were expanded can still use what is left of the budget.
+"""
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+ROW_COLUMNS = ('concept_id', 'depth', 'subtree_rows')
+
+
+class IndentedTree:
+    """Rows of an indented tree, as parallel arrays in depth-first order
+
+    :attr parent: Row index of each row's parent row, -1 for roots"""
+
+    def __init__(self, concept_id: np.ndarray, depth: np.ndarray, parent: np.ndarray, truncated=False):
+        self.concept_id = concept_id
+        self.depth = depth
+        self.parent = parent
+        self.truncated = truncated
+        n = len(concept_id)
+        self.n_children = np.bincount(parent[parent >= 0], minlength=n) if n else np.zeros(0, dtype=np.int64)
+        self.subtree_rows = _subtree_rows(parent)
+
+    @classmethod
+    def build(
+        cls, edges: Iterable[Tuple[int, int]], concept_ids: Iterable[int], sort_key: Dict[int, int] = None,
+        max_rows: Optional[int] = None
+    ) -> 'IndentedTree':
+        """Lay out a graph
+
+        :param concept_ids: Nodes. Ones in no edge are roots with no children.
+        :param sort_key: Siblings are sorted by this, biggest first, then by concept id. Missing keys count as 0.
+        :param max_rows: Stop after this many rows, and mark the tree truncated. Repeating shared subtrees under every
+         parent can multiply the number of rows in a heavily interlinked DAG."""
+        sort_key = sort_key or {}
+        children: Dict[int, List[int]] = {}
+        has_parent = set()
+        nodes = set(concept_ids)
+        for source, target in edges:
+            children.setdefault(source, []).append(target)
+            has_parent.add(target)
+            nodes.update((source, target))
+        for kids in children.values():
+            kids.sort(key=lambda c: (-sort_key.get(c, 0), c))
+        roots = sorted(nodes - has_parent, key=lambda c: (-sort_key.get(c, 0), c))
+
+        concept_id: List[int] = []
+        depth: List[int] = []
+        parent: List[int] = []
+        on_path: List[int] = []  # concept ids from the root down to the current row, so cycles aren't followed
+        stack: List[Tuple[int, int, int]] = [(root, 0, -1) for root in reversed(roots)]  # (concept, depth, parent row)
+        truncated = False
+        while stack:
+            node, d, parent_row = stack.pop()
+            if max_rows is not None and len(concept_id) >= max_rows:
+                truncated = True
+                break
+            del on_path[d:]
+            if node in on_path:
+                continue
+            on_path.append(node)
+            row = len(concept_id)
+            concept_id.append(node)
+            depth.append(d)
+            parent.append(parent_row)
+            stack.extend((child, d + 1, row) for child in reversed(children.get(node, [])))
+            if not stack:  # anything left is only reachable from a cycle: start from its lowest concept id
+                unreached = nodes - set(concept_id)
+                if unreached:
+                    stack.append((min(unreached), 0, -1))
+        return cls(
+            np.array(concept_id, dtype=np.int64), np.array(depth, dtype=np.int32), np.array(parent, dtype=np.int64),
+            truncated)
+
+    def __len__(self) -> int:
+        return len(self.concept_id)
+
+    def collapse_points(self, budget: int) -> Tuple[np.ndarray, int]:
+        """Rows to show collapsed so that at most `budget` rows are visible (or just the roots, if there are more)
+
+        :returns (collapsed, visible_rows): collapsed rows, in tree order, and how many rows are then visible"""
+        n = len(self)
+        if not n:
+            return np.zeros(0, dtype=np.int64), 0
+        visible = self.depth == 0
+        expanded = np.zeros(n, dtype=bool)
+        total = int(visible.sum())
+        for d in range(int(self.depth.max()) + 1):
+            candidates = np.flatnonzero(visible & (self.depth == d) & (self.n_children > 0))
+            running = total + np.cumsum(self.n_children[candidates])
+            fits = running <= budget  # a prefix, since the running total only grows
+            expanded[candidates[fits]] = True
+            if fits.any():
+                total = int(running[fits][-1])
+            visible |= (self.depth == d + 1) & expanded[np.maximum(self.parent, 0)] & (self.parent >= 0)
+        collapsed = np.flatnonzero(visible & (self.n_children > 0) & ~expanded)
+        return collapsed, total
+
+    def to_json(self, budgets: Iterable[int]) -> Dict[str, Any]:
+        """Rows, as lists of ROW_COLUMNS, and collapse points for each budget"""
+        buckets = []
+        for budget in sorted(set(budgets)):
+            collapsed, visible_rows = self.collapse_points(budget)
+            buckets.append({'budget': budget, 'collapsed': collapsed.tolist(), 'visible_rows': visible_rows})
+        return {
+            'columns': list(ROW_COLUMNS),
+            'rows': [list(row) for row in zip(
+                self.concept_id.tolist(), self.depth.tolist(), self.subtree_rows.tolist())],
+            'buckets': buckets,
+            'truncated': self.truncated,
+        }
+
+
+def _subtree_rows(parent: np.ndarray) -> np.ndarray:
+    """Number of rows under each row. In depth-first order a row's parent always comes before it, so adding each row's
+    count to its parent's, last row first, totals every subtree."""
+    parents: List[int] = parent.tolist()
+    subtree = [0] * len(parents)
+    for row in range(len(parents) - 1, -1, -1):
+        if parents[row] >= 0:
+            subtree[parents[row]] += subtree[row] + 1
+    return np.array(subtree, dtype=np.int64)
@@ -9,7 +9,8 @@ import operator
 import os
 import smtplib
 import traceback
-from typing import Dict, List, Any
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Any, Optional, Tuple
 from datetime import datetime
 import warnings
 
@@ -65,6 +66,88 @@ def throttle(wait = 1):
 def throttle_test(arg):
     print(f"throttle test called: {arg}")
 
+
+class LruCache:
+    """Thread-safe least-recently-used cache, bounded by number of entries and, optionally, total size
+
+    Entries belong to a `generation`, e.g. the time the data they were computed from was last refreshed. Passing a
+    different generation to get() or put() empties the cache, so nothing computed from older data is ever returned.
+
+    :param cost: Size of a value, in whatever unit `max_cost` is in. Values bigger than `max_cost` aren't cached."""
+
+    def __init__(self, max_entries: int = 128, max_cost: int = None, cost: Callable[[Any], int] = None):
+        self.max_entries = max_entries
+        self.max_cost = max_cost
+        self.cost = cost or (lambda value: 1)
+        self.generation: Any = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries: OrderedDict[Hashable, Tuple[Any, int]] = OrderedDict()
+        self._total_cost = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, generation: Any = None) -> Optional[Any]:
+        """Cached value, or None if there isn't one"""
+        with self._lock:
+            self._check_generation(generation)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, generation: Any = None):
+        """Cache a value, evicting least recently used entries as needed"""
+        cost = self.cost(value)
+        if self.max_cost is not None and cost > self.max_cost:
+            return
+        with self._lock:
+            self._check_generation(generation)
+            if key in self._entries:
+                self._total_cost -= self._entries.pop(key)[1]
+            self._entries[key] = (value, cost)
+            self._total_cost += cost
+            while len(self._entries) > self.max_entries or \
+                    (self.max_cost is not None and self._total_cost > self.max_cost):
+                _, (_, evicted_cost) = self._entries.popitem(last=False)
+                self._total_cost -= evicted_cost
+                self.evictions += 1
+
+    def clear(self):
+        """Drop all entries. Counters are kept."""
+        with self._lock:
+            self._entries.clear()
+            self._total_cost = 0
+
+    def _check_generation(self, generation: Any):
+        """Empty the cache if `generation` is not the one its entries are from. Call with the lock held."""
+        if generation != self.generation:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._total_cost = 0
+            self.generation = generation
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'cost': self._total_cost,
+                'max_cost': self.max_cost,
+            }
+
 # def powerset(iterable):
 #     """powerset([1,2,3]) --> () (1,) (2,) (3,) (1,2) (1,3) (2,3) (1,2,3)"""
 #     s = list(iterable)
@@ -4,18 +4,23 @@ How to run:
     python -m unittest discover
 """
 import os
+import struct
 import sys
 import unittest
 from pathlib import Path
 from typing import Dict, List
+from unittest.mock import patch
 
 from sqlalchemy.engine.base import Connection
 
 TEST_DIR = os.path.dirname(__file__)
 PROJECT_ROOT = Path(TEST_DIR).parent.parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
-from backend.db.utils import get_db_connection, get_idle_connections, insert_fetch_statuses, run_sql, \
-    select_failed_fetches, sql_query
+from backend.db.utils import BinaryCopyIntReader, COPY_MIN_ROWS, CopyTextWriter, PG_BINARY_COPY_SIGNATURE, \
+    TABLE_METADATA_STATUS_VAR, current_datetime, db_pool_stats, get_db_connection, get_db_engine, \
+    get_field_data_types, get_idle_connections, insert_fetch_statuses, insert_from_dicts, last_row_per_key, \
+    on_conflict_clause, pkey_fields, run_sql, select_failed_fetches, sql_query, unique_keys, update_db_status_var, \
+    update_from_dicts
 
 
 # todo: add datetime to setUp and tearDown: It might be possible, despite failsafes being in place to prevent refreshes
@@ -66,11 +71,171 @@ class TestBackendDbUtilsFetchAudit(FetchAuditTestRunner):
             n2 = sql_query(con, 'SELECT COUNT(*) FROM fetch_audit;')[0]['count']
             self.assertEqual(n2 - self.n1, len(self.mock_data))
 
+    def test_insert_existing_rows(self):
+        """Rows already in the table are skipped, or with update_if_already_exists, updated"""
+        rows = [{k: str(v) for k, v in row.items()} for row in self.mock_data]
+        with get_db_connection(schema='') as con:
+            insert_from_dicts(con, 'fetch_audit', rows)
+            n2 = sql_query(con, 'SELECT COUNT(*) FROM fetch_audit;')[0]['count']
+            self.assertEqual(n2 - self.n1, len(self.mock_data))
+            updated = [{**row, 'comment': 'Unit testing. Updated.'} for row in rows[:2]]
+            insert_from_dicts(con, 'fetch_audit', updated, update_if_already_exists=True)
+            n_updated = sql_query(
+                con, "SELECT COUNT(*) FROM fetch_audit WHERE comment = 'Unit testing. Updated.';")[0]['count']
+            self.assertEqual(n_updated, 2)
+
     def test_select_failed_fetches(self):
         """Test select_failed_fetches()"""
         results = select_failed_fetches()
         self.assertEqual(len(results), self.n1 + len(self.mock_data))
 
+    def test_update_from_dicts_bulk(self):
+        """A batch big enough to be updated through a COPY staging table"""
+        rows = [{'table': 'code_sets', 'primary_key': str(i), 'status_initially': 'fail-0-members',
+                 'comment': 'Unit testing. Bulk.'} for i in range(COPY_MIN_ROWS)]
+        with get_db_connection(schema='') as con:
+            try:
+                insert_from_dicts(con, 'fetch_audit', rows)
+                updated = [{**row, 'comment': 'Unit testing. Bulk updated.'} for row in rows]
+                update_from_dicts(con, 'fetch_audit', updated)
+                n_updated = sql_query(
+                    con, "SELECT COUNT(*) FROM fetch_audit WHERE comment = 'Unit testing. Bulk updated.';")[0]['count']
+                self.assertEqual(n_updated, COPY_MIN_ROWS)
+            finally:
+                run_sql(con, "DELETE FROM fetch_audit WHERE comment LIKE 'Unit testing. Bulk%';")
+
+
+class TestBinaryCopyIntReader(unittest.TestCase):
+    """Tests for parsing binary COPY output"""
+
+    @staticmethod
+    def _copy_output(rows: List[tuple], width: int) -> bytes:
+        """Build what `COPY ... TO STDOUT (FORMAT binary)` would send for integer columns of `width` bytes"""
+        fmt = {2: '>h', 4: '>i', 8: '>q'}[width]
+        out = PG_BINARY_COPY_SIGNATURE + struct.pack('>ii', 0, 0)
+        for row in rows:
+            out += struct.pack('>h', len(row))
+            for val in row:
+                out += struct.pack('>i', width) + struct.pack(fmt, val)
+        return out + struct.pack('>h', -1)
+
+    def test_parse(self):
+        """Rows split across arbitrary chunk boundaries, for int4 and int8 columns, with array growth"""
+        rows = [(i * 7919 % 100003, 2_000_000_000 - i) for i in range(2500)]
+        for width in (4, 8):
+            data = self._copy_output(rows, width)
+            progress = []
+            reader = BinaryCopyIntReader(2, expected_rows=10, progress=progress.append, progress_every=1000,
+                                         block_size=512)
+            for i in range(0, len(data), 37):
+                reader.write(data[i:i + 37])
+            sources, targets = reader.result()
+            self.assertEqual(list(zip(sources.tolist(), targets.tolist())), rows)
+            self.assertEqual(len(progress), 2)
+
+    def test_empty_and_malformed(self):
+        """No rows, and a NULL value"""
+        reader = BinaryCopyIntReader(2)
+        reader.write(self._copy_output([], 4))
+        self.assertEqual([len(x) for x in reader.result()], [0, 0])
+        data = self._copy_output([(1, 2), (3, 4)], 4)
+        # Turn the second row's first value into a NULL: length -1 and no data
+        second_row = len(PG_BINARY_COPY_SIGNATURE) + 8 + 18
+        data = data[:second_row + 2] + struct.pack('>i', -1) + data[second_row + 10:]
+        reader = BinaryCopyIntReader(2)
+        reader.write(data)
+        with self.assertRaises(ValueError):
+            reader.result()
+
+
+class TestCopyTextWriter(unittest.TestCase):
+    """Tests for encoding rows for `COPY ... FROM STDIN`"""
+
+    def test_encoding(self):
+        """NULLs, missing fields, escapes, and each kind of value"""
+        rows = [
+            {'a': 1, 'b': 'x\ty\\z\nw', 'c': True},
+            {'a': None, 'c': [1, None, 'q"r,s']},
+            {'a': 2.5, 'b': {'k': 'v'}, 'c': False}]
+        data = CopyTextWriter(rows, ['a', 'b', 'c']).read()
+        self.assertEqual(data.decode('utf-8').split('\n'), [
+            '1\tx\\ty\\\\z\\nw\tt',
+            '\\N\t\\N\t{"1",NULL,"q\\\\"r,s"}',
+            '2.5\t{"k": "v"}\tf',
+            ''])
+
+    def test_chunked_reads(self):
+        """Reading in chunks gives the same bytes as reading it all, and rows are only encoded as needed"""
+        rows = [{'id': i, 'name': f'concept {i}'} for i in range(1000)]
+        expected = CopyTextWriter(rows, ['id', 'name']).read()
+        encoded = []
+        writer = CopyTextWriter((encoded.append(row) or row for row in rows), ['id', 'name'])
+        chunks = [writer.read(100)]
+        self.assertLess(len(encoded), 20)
+        while chunks[-1]:
+            chunks.append(writer.read(100))
+        self.assertEqual(b''.join(chunks), expected)
+        self.assertTrue(all(len(chunk) == 100 for chunk in chunks[:-2]))
+
+
+class TestOnConflict(unittest.TestCase):
+    """Tests for building ON CONFLICT upserts"""
+
+    def test_clauses(self):
+        """Primary key fields, conflict clauses, and deduplicating rows before an update"""
+        self.assertEqual(pkey_fields('code_sets'), ['codeset_id'])
+        self.assertEqual(pkey_fields('concept_set_members'), ['codeset_id', 'concept_id'])
+        self.assertEqual(pkey_fields('concept_ancestor'), [])
+        self.assertEqual(pkey_fields('no_such_table'), [])
+        key, fields = ['codeset_id', 'concept_id'], ['codeset_id', 'concept_id', 'concept_name']
+        self.assertEqual(
+            on_conflict_clause('("codeset_id", "concept_id")', key, fields),
+            'ON CONFLICT ("codeset_id", "concept_id") DO NOTHING')
+        self.assertEqual(
+            on_conflict_clause('("codeset_id", "concept_id")', key, fields, update=True),
+            'ON CONFLICT ("codeset_id", "concept_id") DO UPDATE SET "concept_name" = EXCLUDED."concept_name"')
+        self.assertEqual(on_conflict_clause('("codeset_id", "concept_id")', key, key, update=True),
+                         'ON CONFLICT ("codeset_id", "concept_id") DO NOTHING')
+        rows = [{'codeset_id': 1, 'concept_id': 2, 'v': 'a'}, {'codeset_id': 1, 'concept_id': 3, 'v': 'b'},
+                {'codeset_id': 1, 'concept_id': 2, 'v': 'c'}]
+        self.assertEqual([row['v'] for row in last_row_per_key(rows, key)], ['c', 'b'])
+        with self.assertRaises(ValueError):  # nothing to match rows on
+            update_from_dicts(None, 'concept_ancestor', [{'ancestor_concept_id': 1, 'min_levels_of_separation': 0}])
+
+    def test_small_insert_without_unique_index(self):
+        """A small batch for a table with a key but no unique index on it is one INSERT ... WHERE NOT EXISTS"""
+        statements = []
+        rows = [{'codeset_id': 1, 'concept_id': 2}, {'codeset_id': 1, 'concept_id': 3}]
+        types = {'codeset_id': 'integer', 'concept_id': 'integer'}
+        with patch('backend.db.utils.conflict_target', return_value=None), \
+                patch('backend.db.utils.column_types', return_value=types), \
+                patch('backend.db.utils.run_sql', side_effect=lambda con, query, params=None: statements.append(query)):
+            insert_from_dicts(None, 'concept_set_members', rows)
+            self.assertEqual(len(statements), 1)
+            self.assertIn('CAST(:codeset_id1 AS integer)', statements[0])
+            self.assertIn('WHERE NOT EXISTS', statements[0])
+            insert_from_dicts(None, 'concept_set_members', rows, update_if_already_exists=True)
+            self.assertEqual(len(statements), 2)  # no fields to update, so still just the insert
+
+
+class TestTableMetadataCache(unittest.TestCase):
+    """Tests for caching table metadata across processes"""
+
+    def test_change_in_other_process(self):
+        """Cached metadata is re-read once the next check sees a change recorded by another process"""
+        with get_db_connection() as con:
+            keys, types = unique_keys(con, 'code_sets'), get_field_data_types('code_sets')
+            update_db_status_var(TABLE_METADATA_STATUS_VAR, current_datetime())
+            self.assertIs(unique_keys(con, 'code_sets'), keys)  # not checked again yet
+            self.assertIs(get_field_data_types('code_sets'), types)
+            with patch('backend.db.utils.TABLE_METADATA_CHECK_SECONDS', 0):
+                self.assertIsNot(unique_keys(con, 'code_sets'), keys)
+                self.assertEqual(unique_keys(con, 'code_sets'), keys)
+            update_db_status_var(TABLE_METADATA_STATUS_VAR, current_datetime())
+            with patch('backend.db.utils.TABLE_METADATA_CHECK_SECONDS', 0):
+                self.assertIsNot(get_field_data_types('code_sets'), types)
+                self.assertEqual(get_field_data_types('code_sets'), types)
+
 
 class TestIdleConnections(unittest.TestCase):
 
@@ -83,6 +248,39 @@ class TestIdleConnections(unittest.TestCase):
         msg = f'{len(idle_cnx)} exceeds the theshold of {threshold} for interval {interval}.'
         self.assertLessEqual(len(idle_cnx), threshold, msg=msg)
 
+
+class TestDbEnginePool(unittest.TestCase):
+    """Tests for the pooled engine registry"""
+
+    def test_pooled_connections(self):
+        """Connections for the same settings share an engine and are reused, without leaking session state"""
+        self.assertIs(get_db_engine(schema=''), get_db_engine(schema=''))
+        self.assertIsNot(get_db_engine(schema=''), get_db_engine(schema='', isolation_level='READ COMMITTED'))
+        with get_db_connection(schema='') as con:
+            pid = sql_query(con, 'SELECT pg_backend_pid() AS pid;')[0]['pid']
+            run_sql(con, 'CREATE TEMP TABLE pool_test AS SELECT 1 AS x;')
+            stats = next(s for s in db_pool_stats() if not s['async'] and s['schema'] == ''
+                         and s['isolation_level'] == 'AUTOCOMMIT')
+            self.assertGreaterEqual(stats['checked_out'], 1)
+        with get_db_connection(schema='') as con:
+            self.assertEqual(sql_query(con, 'SELECT pg_backend_pid() AS pid;')[0]['pid'], pid)
+            self.assertIsNone(sql_query(con, "SELECT to_regclass('pg_temp.pool_test') AS t;")[0]['t'])
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs os.fork()')
+    def test_forked_child(self):
+        """A forked child gets engines of its own, without closing the parent's pooled connections"""
+        engine = get_db_engine(schema='')
+        with get_db_connection(schema='') as con:
+            pid = sql_query(con, 'SELECT pg_backend_pid() AS pid;')[0]['pid']
+        child = os.fork()
+        if child == 0:
+            os._exit(0 if get_db_engine(schema='') is not engine else 1)
+        self.assertEqual(os.waitstatus_to_exitcode(os.waitpid(child, 0)[1]), 0)
+        self.assertIs(get_db_engine(schema=''), engine)
+        with get_db_connection(schema='') as con:
+            self.assertEqual(sql_query(con, 'SELECT pg_backend_pid() AS pid;')[0]['pid'], pid)
+
+
 # Uncomment this and run this file and run directly to run all tests
 # if __name__ == '__main__':
 #     unittest.main()
@@ -22,6 +22,7 @@ from io import StringIO
 from pathlib import Path
 from typing import Dict, List, Set, Tuple
 
+import numpy as np
 from networkx import DiGraph
 
 THIS_DIR = Path(os.path.dirname(__file__))
@@ -32,7 +33,10 @@ sys.path.insert(0, str(PROJECT_ROOT))
 #  but examining the diff, it's not obvious why. Pickle didn't change. Loading of pickle essentially unchanged. 
 import builtins
 builtins.DONT_LOAD_GRAPH = True
-from backend.routes.graph import concept_graph
+from backend.csr_graph import CsrGraph
+from backend.graph_rollups import DescendantRollups
+from backend.routes.graph import concept_graph, concept_graph_ndjson, condense_response, condense_super_nodes, \
+    expand_super_node
 # noinspection PyUnresolvedReferences rel_graph_exists_just_not_if_name_eq_main
 REL_GRAPH = DiGraph()
 
@@ -200,7 +204,7 @@ class TestGraph(AsyncTests):
             sg: DiGraph
             hidden_by_voc: Dict[str, Set[int]]
             nonstandard_concepts_hidden: Set[int]
-            sg, concept_ids, hidden_by_voc, nonstandard_concepts_hidden = await concept_graph(
+            sg, concept_ids, hidden_by_voc, nonstandard_concepts_hidden, _ = await concept_graph(
                 codeset_ids, hide_vocabs=hide_vocabs, hide_nonstandard_concepts=True, verbose=False)
                 # self.assertEqual(...)
             if test_name == 'single-small':  # TODO: make assertions. although these are actually passing. why?
@@ -275,6 +279,74 @@ class TestGraph(AsyncTests):
             print(f"test_get_missing_in_between_nodes(): passed with case: {missing_in_between_nodes}")
         """
 
+    def test_condense_super_nodes(self):
+        """Leaf children of nodes with many children are condensed, unless that would disconnect something"""
+        # 1 has 5 children: 10 and 11 are leaves only under 1, 12 is also under 2, 13 has a child, 14 is kept
+        edges = [(1, 10), (1, 11), (1, 12), (1, 13), (1, 14), (2, 12), (2, 3), (13, 15)]
+        condensed_edges, super_nodes, condensed = condense_super_nodes(edges, threshold=3, keep={14})
+        self.assertEqual(condensed, {10, 11})
+        self.assertEqual(super_nodes, {1: {'children': 5, 'condensed': 2}})
+        self.assertEqual(set(condensed_edges), set(edges) - {(1, 10), (1, 11)})
+        g = CsrGraph.from_edges([e[0] for e in edges] + [1], [e[1] for e in edges] + [16])
+        concept_ids = {1, 2, 3, 10, 11, 12, 13, 14, 15}  # 16 isn't in the response
+        self.assertEqual(
+            set(expand_super_node(g, 1, concept_ids)), {(1, 10), (1, 11), (1, 12), (1, 13), (1, 14)})
+        # Nothing over the threshold: unchanged
+        self.assertEqual(condense_super_nodes(edges, threshold=5), (edges, {}, set()))
+        # Condensed concepts are left out of the rest of the response too
+        response = {
+            'edges': edges, 'concept_ids': concept_ids | {99}, 'missing_from_graph': {99},
+            'rollups': {'descendant_count': {c: 0 for c in concept_ids}, 'total_cnt': {c: 1 for c in concept_ids}}}
+        condensed_response = condense_response(response, threshold=3, keep={14})
+        self.assertEqual(condensed_response['concept_ids'], concept_ids - {10, 11} | {99})
+        self.assertEqual(condensed_response['missing_from_graph'], {99})
+        for values in condensed_response['rollups'].values():
+            self.assertEqual(set(values), concept_ids - {10, 11})
+        self.assertEqual(condensed_response['super_nodes'], {1: {'children': 5, 'condensed': 2}})
+
+    def test_concept_graph_ndjson(self):
+        """The NDJSON stream of a subgraph reassembles into the same response as the cached path builds"""
+        rel_graph = CsrGraph.from_edges([1, 1, 2, 3, 4, 9], [2, 3, 4, 4, 5, 1])
+        rel_graph.rollups = DescendantRollups.build(rel_graph, np.arange(len(rel_graph)) + 10)
+        sg = rel_graph.subgraph([1, 2, 3, 4, 5])
+        concept_ids, hidden_by_vocab = {1, 2, 3, 4, 5, 6}, {'RxNorm Extension': {7, 8, 9}}
+        lines = [json.loads(line) for line in concept_graph_ndjson(
+            rel_graph, sg, concept_ids, hidden_by_vocab, {10}, False, chunk_size=2)]
+        self.assertEqual(lines[0], {'type': 'header', 'descendants_truncated': False, 'n_concept_ids': 6, 'n_edges': 5})
+        self.assertEqual(lines[-1], {'type': 'end'})
+        by_type: Dict[str, List] = {}
+        for line in lines:
+            by_type.setdefault(line['type'], []).append(line)
+        self.assertEqual(len(by_type['nodes']), 3)
+        self.assertEqual([c for line in by_type['nodes'] for c in line['concept_ids']], [1, 2, 3, 4, 5, 6])
+        self.assertEqual([tuple(e) for line in by_type['edges'] for e in line['edges']], sg.edges)
+        self.assertEqual(
+            {int(c): n for line in by_type['nodes'] for c, n in line['rollups']['descendant_count'].items()},
+            rel_graph.rollups.lookup(rel_graph, list(concept_ids))['descendant_count'])
+        self.assertEqual(
+            [(line['vocab'], line['concept_ids']) for line in by_type['hidden_by_vocab']],
+            [('RxNorm Extension', [7, 8]), ('RxNorm Extension', [9])])
+        self.assertEqual(by_type['missing_from_graph'][0]['concept_ids'], [6])
+        self.assertNotIn('super_nodes', by_type)
+
+        # Super nodes are condensed as in condense_response()
+        rel_graph = CsrGraph.from_edges([1, 1, 1, 1, 1, 2, 4], [2, 3, 4, 5, 6, 7, 3])
+        sg = rel_graph.subgraph(range(1, 8))
+        response = {
+            'edges': sg.edges, 'concept_ids': {*range(1, 8), 20}, 'missing_from_graph': {20},
+            'hidden_by_vocab': {}, 'nonstandard_concepts_hidden': set(), 'descendants_truncated': True, 'rollups': {}}
+        condensed = condense_response(response, 3, {6})
+        lines = [json.loads(line) for line in concept_graph_ndjson(
+            rel_graph, sg, response['concept_ids'], {}, set(), True, super_node_threshold=3, keep={6}, chunk_size=2)]
+        by_type = {}
+        for line in lines:
+            by_type.setdefault(line['type'], []).append(line)
+        self.assertEqual(lines[0]['n_edges'], len(condensed['edges']))
+        self.assertEqual([tuple(e) for line in by_type['edges'] for e in line['edges']], condensed['edges'])
+        self.assertEqual({c for line in by_type['nodes'] for c in line['concept_ids']}, condensed['concept_ids'])
+        self.assertEqual(
+            {int(c): v for c, v in by_type['super_nodes'][0]['super_nodes'].items()}, condensed['super_nodes'])
+
     # TODO: test is failing. fix
     #  - The cause of the err is that subgraph() is a different function now. it used to call connected_subgraph_from_nodes(), which no longer exists.
     #    Is this test still valid? Is there any func that takes a list of concept IDs and returns their parentage tuples?
@@ -1,4 +1,5 @@
 """Tests for backend web server and utilities"""
+import asyncio
 import os
 from typing import Dict, Union
 
@@ -16,7 +17,8 @@ TEST_DIR = THIS_TEST_DIR.parent
 PROJECT_ROOT = TEST_DIR.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 from backend.db.analysis import InvalidCompareSchemaError, counts_compare_schemas, counts_over_time
-from backend.routes.db import get_concepts, get_researchers, get_cset_members_items
+from backend.db.utils import dispose_async_db_engines
+from backend.routes.db import get_concepts, get_researchers, get_cset_members_items, get_cset_members_items_async
 
 
 TEST_DIR = os.path.dirname(__file__)
@@ -341,3 +343,19 @@ class TestBackend(unittest.TestCase):
             {'concept_id': 4091006, 'standard_concept': 'S', 'vocabulary_id': 'SNOMED'},
             {'concept_id': 4052321, 'standard_concept': 'S', 'vocabulary_id': 'SNOMED'}].sort(key=key)
         self.assertEquals(csmi, expected)
+
+    def test_get_cset_members_items_async(self):
+        """Test get_cset_members_items_async(): same rows as get_cset_members_items(), for each kind of selection"""
+        codeset_ids = [396155663, 643758668]
+        selections = [{}, {'columns': ['concept_id', 'vocabulary_id']}, {'column': 'concept_id'}]
+
+        async def run_all():
+            """All at once, on one event loop, which the async engine's pool is tied to"""
+            try:
+                return await asyncio.gather(*[get_cset_members_items_async(codeset_ids, **s) for s in selections])
+            finally:
+                await dispose_async_db_engines()
+
+        for kwargs, actual in zip(selections, asyncio.run(run_all())):
+            expected = get_cset_members_items(codeset_ids, **kwargs)
+            self.assertEqual(sorted(map(str, actual)), sorted(map(str, expected)))
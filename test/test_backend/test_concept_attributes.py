@@ -0,0 +1,72 @@
+"""Tests for the concept attribute column store
+
+How to run:
+    python -m unittest test.test_backend.test_concept_attributes
+"""
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.concept_attributes import ConceptAttributes
+from backend.csr_graph import CsrGraph
+from backend.graph_snapshot import load_graph_snapshot, save_graph_snapshot
+from backend.routes.graph import filter_concepts
+
+CONCEPTS = [
+    {'concept_id': 5, 'vocabulary_id': 'SNOMED', 'domain_id': 'Condition', 'concept_class_id': 'Disorder',
+     'standard_concept': 'S', 'total_cnt': 10},
+    {'concept_id': 1, 'vocabulary_id': 'ICD10CM', 'domain_id': 'Condition', 'concept_class_id': '3-char nonbill code',
+     'standard_concept': None, 'total_cnt': 0},
+    {'concept_id': 3, 'vocabulary_id': 'RxNorm Extension', 'domain_id': 'Drug', 'concept_class_id': 'Clinical Drug',
+     'standard_concept': 'S', 'total_cnt': 7},
+    {'concept_id': 4, 'vocabulary_id': 'RxNorm Extension', 'domain_id': 'Drug', 'concept_class_id': 'Clinical Drug',
+     'standard_concept': 'C', 'total_cnt': 2},
+    {'concept_id': 2, 'vocabulary_id': None, 'domain_id': None, 'concept_class_id': None, 'standard_concept': None,
+     'total_cnt': None},
+]
+
+
+class TestConceptAttributes(unittest.TestCase):
+    """Tests for ConceptAttributes"""
+
+    def setUp(self):
+        self.attributes = ConceptAttributes.from_records(CONCEPTS)
+
+    def test_records(self):
+        """Decoding should give back what went in, skipping unknown ids"""
+        expected = sorted([{**c, 'total_cnt': c['total_cnt'] or 0} for c in CONCEPTS], key=lambda c: c['concept_id'])
+        self.assertEqual(self.attributes.records([1, 2, 3, 999, 4, 5]), expected)
+
+    def test_filter(self):
+        """Should hide the same concepts as filter_concepts() does on rows from the database"""
+        for hide_vocabs in [[], ['RxNorm Extension'], ['RxNorm Extension', 'ICD10CM', 'not a vocab']]:
+            for hide_nonstandard_concepts in [False, True]:
+                kept_rows, hidden_by_voc, nonstandard_hidden = filter_concepts(
+                    CONCEPTS, hide_vocabs, hide_nonstandard_concepts)
+                kept, hidden_by_voc2, nonstandard_hidden2 = self.attributes.filter(
+                    [c['concept_id'] for c in CONCEPTS] + [999], hide_vocabs, hide_nonstandard_concepts)
+                self.assertEqual(set(kept.tolist()), {c['concept_id'] for c in kept_rows} | {999})
+                self.assertEqual(hidden_by_voc2, hidden_by_voc)
+                self.assertEqual(nonstandard_hidden2, nonstandard_hidden)
+
+    def test_saved_with_graph(self):
+        """Attributes are saved in, and mmapped from, the graph snapshot"""
+        g = CsrGraph.from_edges([5, 5], [3, 4])
+        g.attributes = self.attributes
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'graph.csr')
+            save_graph_snapshot(g, path)
+            g2 = load_graph_snapshot(path)
+            self.assertEqual(g2.attributes.records([1, 2, 3, 4, 5]), self.attributes.records([1, 2, 3, 4, 5]))
+            self.assertFalse(g2.attributes.vocabulary.flags.writeable)
+            del g2
+        self.assertIsNone(CsrGraph.from_arrays(CsrGraph.from_edges([1], [2]).arrays()).attributes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""Tests for in-process concept set expression expansion
+
+How to run:
+    python -m unittest test.test_backend.test_concept_expansion
+"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.concept_expansion import ConceptMappings, expand_expression, expand_expressions
+from backend.csr_graph import CsrGraph
+from backend.graph_snapshot import load_graph_snapshot, save_graph_snapshot
+
+#     1
+#    / \
+#   2   3
+#  / \   \
+# 4   5   6
+# Non-standard 101 and 102 map to 2 and 5; 103 maps to itself; 104 to 9, which isn't in the hierarchy
+EDGES = [(1, 2), (1, 3), (2, 4), (2, 5), (3, 6)]
+MAPS_TO = [(101, 2), (102, 5), (103, 103), (104, 9)]
+
+
+def item(concept_id: int, flags: str = '', codeset_id: int = None):
+    """Expression item. Flags: D includeDescendants, M includeMapped, X isExcluded, as in cset_members_items."""
+    return {
+        'codeset_id': codeset_id, 'concept_id': concept_id, 'includeDescendants': 'D' in flags,
+        'includeMapped': 'M' in flags, 'isExcluded': 'X' in flags}
+
+
+class TestConceptExpansion(unittest.TestCase):
+    """Tests for concept_expansion"""
+
+    def setUp(self):
+        self.graph = CsrGraph.from_edges([e[0] for e in EDGES], [e[1] for e in EDGES])
+        self.graph.mappings = ConceptMappings.from_pairs([m[0] for m in MAPS_TO], [m[1] for m in MAPS_TO])
+
+    def expand(self, *items):
+        """Expanded members, as a list"""
+        return expand_expression(self.graph, items).tolist()
+
+    def test_flags(self):
+        """Each flag, alone and combined"""
+        self.assertEqual(self.expand(item(2)), [2])
+        self.assertEqual(self.expand(item(2, 'D')), [2, 4, 5])
+        self.assertEqual(self.expand(item(2, 'M')), [2, 101])
+        self.assertEqual(self.expand(item(2, 'DM')), [2, 4, 5, 101, 102])
+        self.assertEqual(self.expand(item(9, 'DM')), [9, 104])  # not in the hierarchy, but mapped
+        self.assertEqual(self.expand(item(1, 'D'), item(2, 'DX')), [1, 3, 6])
+        self.assertEqual(self.expand(item(1, 'DM'), item(5, 'MX')), [1, 2, 3, 4, 6, 101])
+        self.assertEqual(self.expand(item(1, 'X')), [])
+        self.assertEqual(self.expand(), [])
+        self.assertEqual(
+            expand_expressions(self.graph, [item(3, 'D', 10), item(2, '', 11), item(5, 'M', 11)]),
+            {10: [3, 6], 11: [2, 5, 102]})
+        with self.assertRaises(ValueError):
+            expand_expression(CsrGraph.from_edges([1], [2]), [item(1, 'M')])
+
+    def test_mappings(self):
+        """Self-mappings are dropped, and mappings are saved with the graph snapshot"""
+        self.assertEqual(len(self.graph.mappings), 3)
+        self.assertEqual(self.graph.mappings.mapped_from([103, 2, 5, 999]).tolist(), [101, 102])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'graph.csr')
+            save_graph_snapshot(self.graph, path)
+            self.assertEqual(load_graph_snapshot(path).mappings.mapped_from([2]).tolist(), [101])
+        self.assertIsNone(CsrGraph.from_edges([1], [2]).mappings)
+
+    def test_large_set(self):
+        """A set with tens of thousands of members expands in well under a second"""
+        rng = np.random.default_rng(0)
+        n = 500_000
+        sources = rng.integers(0, n, 2 * n)
+        g = CsrGraph.from_edges(sources, sources + rng.integers(1, 100, 2 * n))
+        g.mappings = ConceptMappings.from_pairs(np.arange(n) + 10 * n, rng.integers(0, n, n))
+        items = [item(int(c), 'DM') for c in rng.integers(n - 20_000, n, 300)] + \
+            [item(int(c), 'X') for c in rng.integers(n - 20_000, n, 100)]
+        start = time.perf_counter()
+        members = expand_expression(g, items)
+        elapsed = time.perf_counter() - start
+        self.assertGreater(len(members), 30_000)
+        self.assertLess(elapsed, 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
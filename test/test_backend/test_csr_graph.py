@@ -0,0 +1,291 @@
+"""Tests for the array-backed concept graph
+
+How to run:
+    python -m unittest test.test_backend.test_csr_graph
+"""
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import networkx as nx
+import numpy as np
+from networkx import DiGraph, ancestors, descendants
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.csr_graph import CsrGraph
+from backend.graph_components import strong_component_labels
+from backend.graph_rollups import DescendantRollups
+from backend.graph_snapshot import SnapshotFormatError, load_graph_snapshot, read_snapshot, read_snapshot_meta, \
+    save_graph_snapshot, write_snapshot
+
+# Same shape as the gap filling diagram in test_graph.py, with the string nodes renumbered
+#  root=100, 2p1=101, 2p2=102, cloud=103
+EDGES = [
+    (2, 1), (100, 101), (101, 2), (100, 102), (102, 2), (100, 103), (4, 3), (5, 4), (7, 5), (8, 7), (103, 8), (2, 8),
+    (6, 5), (103, 6), (10, 9), (4, 10), (10, 12), (11, 10), (6, 11), (11, 13), (15, 14), (103, 15), (16, 21), (17, 16),
+    (6, 17), (18, 17), (15, 18), (20, 16), (103, 20), (22, 23), (19, 22), (20, 19),
+]
+
+
+class TestCsrGraph(unittest.TestCase):
+    """Tests for CsrGraph"""
+
+    def setUp(self):
+        self.nx_graph = DiGraph(EDGES)
+        self.graph = CsrGraph.from_edges([e[0] for e in EDGES], [e[1] for e in EDGES])
+
+    def test_matches_networkx(self):
+        """Nodes, edges, successors and predecessors should be the same as for the networkx graph"""
+        g, nxg = self.graph, self.nx_graph
+        self.assertEqual(set(g.nodes), set(nxg.nodes))
+        self.assertEqual(set(g.edges), set(nxg.edges))
+        self.assertEqual(g.number_of_edges(), nxg.number_of_edges())
+        for node in nxg.nodes:
+            self.assertEqual(set(g.successors(node)), set(nxg.successors(node)))
+            self.assertEqual(set(g.predecessors(node)), set(nxg.predecessors(node)))
+        self.assertEqual(dict(g.out_degree()), dict(nxg.out_degree()))
+        self.assertTrue(g.has_node(103))
+        self.assertFalse(g.has_node(999))
+        self.assertEqual(CsrGraph.from_networkx(nxg).arrays().keys(), g.arrays().keys())
+
+    def test_duplicate_edges(self):
+        """Duplicate edges are dropped, as networkx would"""
+        g = CsrGraph.from_edges([1, 1, 2], [2, 2, 3])
+        self.assertEqual(sorted(g.edges), [(1, 2), (2, 3)])
+
+    def test_subgraph(self):
+        """Induced subgraph should match networkx, ignoring ids not in the graph"""
+        nodes = [2, 1, 8, 7, 5, 4, 999]
+        sg = self.graph.subgraph(nodes)
+        expected = self.nx_graph.subgraph([n for n in nodes if n != 999])
+        self.assertEqual(set(sg.nodes), set(expected.nodes))
+        self.assertEqual(set(sg.edges), set(expected.edges))
+        self.assertEqual(len(sg), 6)
+        # Output types should be plain ints so FastAPI can serialize them
+        self.assertTrue(all(type(x) is int for edge in sg.edges for x in edge))
+
+    def test_children_of(self):
+        """Direct children of a set of nodes"""
+        self.assertEqual(set(self.graph.children_of([6, 20, 999]).tolist()), {5, 11, 17, 16, 19})
+        self.assertEqual(len(self.graph.children_of(np.array([1, 3]))), 0)
+
+    def test_descendants_of(self):
+        """Multi-source BFS, with and without depth and node limits"""
+        g, nxg = self.graph, self.nx_graph
+        sources = [103, 2, 999]
+        expected = set().union(*[descendants(nxg, n) for n in sources if n != 999]) - set(sources)
+        self.assertEqual(set(g.descendants_of(sources).tolist()), expected)
+        # Depth 1 is the same as children_of(), minus the sources themselves
+        self.assertEqual(set(g.descendants_of(sources, max_depth=1).tolist()), set(g.children_of(sources).tolist()))
+        # Depths are distances from the nearest source
+        ids, depths, complete = g.traverse([103], max_depth=2)
+        self.assertTrue(complete)
+        self.assertEqual(dict(zip(ids.tolist(), depths.tolist())), {8: 1, 6: 1, 15: 1, 20: 1, 7: 2, 5: 2, 11: 2, 17: 2,
+                                                                    14: 2, 18: 2, 16: 2, 19: 2})
+        ids, _, complete = g.traverse([103], max_nodes=5)
+        self.assertFalse(complete)
+        self.assertEqual(len(ids), 5)
+        self.assertTrue(set(ids.tolist()) <= expected)
+        self.assertEqual(set(g.ancestors_of([5]).tolist()), ancestors(nxg, 5))
+
+    def test_nodes_between(self):
+        """Gap filling finds the nodes on short paths between members, and stops at the deadline"""
+        g, nxg = self.graph, self.nx_graph
+        members = {2, 1, 8, 4, 3, 10, 9, 12, 11, 13, 15, 14, 18, 20, 16, 19, 999}
+        for max_depth in [2, 3, 4]:
+            expected = set()
+            for a in members & set(nxg.nodes):
+                for b in members & set(nxg.nodes):
+                    paths = nx.all_simple_paths(nxg, a, b, cutoff=max_depth) if a != b else []
+                    expected |= {n for path in paths for n in path} - members
+            between, complete = g.nodes_between(list(members), max_depth)
+            self.assertTrue(complete)
+            self.assertEqual(set(between.tolist()), expected)
+        self.assertEqual(set(g.nodes_between(list(members), 4)[0].tolist()), {5, 7, 17})
+        _, complete = g.nodes_between(list(members), 4, deadline=0)
+        self.assertFalse(complete)
+
+    def test_is_descendant(self):
+        """Reachability index should agree with networkx for every pair of nodes, including across and within cycles"""
+        rng = np.random.default_rng(0)
+        random_dag = np.sort(rng.integers(0, 150, (300, 2)), axis=1)
+        random_dag = random_dag[random_dag[:, 0] != random_dag[:, 1]].tolist()
+        for edges in [EDGES, EDGES + [(9, 6)], random_dag, random_dag + [(120, 3), (60, 40)]]:
+            nxg = DiGraph(edges)
+            g = CsrGraph.from_edges([e[0] for e in edges], [e[1] for e in edges])
+            pairs = [(a, b) for a in nxg.nodes for b in nxg.nodes] + [(999, 100), (8, 999)]
+            expected = [a in nxg and b in nxg and a in descendants(nxg, b) for a, b in pairs]
+            self.assertEqual(g.is_descendant(pairs).tolist(), expected)
+            self.assertEqual(g.is_descendant(np.array(pairs)).tolist(), expected)
+
+    def test_ancestors_within(self):
+        """Ancestors within a set, e.g. to find the roots of a concept set"""
+        members = [100, 2, 8, 5, 4, 3, 6, 14, 999]
+        result = self.graph.ancestors_within(members)
+        self.assertEqual(set(result.keys()), set(members) - {999})
+        for concept_id, found in result.items():
+            self.assertEqual(found, ancestors(self.nx_graph, concept_id) & set(members))
+        self.assertEqual([c for c, found in result.items() if not found], [100])
+
+    def test_depth_and_lowest_common_ancestors(self):
+        """Depth from the nearest root, and lowest common ancestors, checked against networkx"""
+        g, nxg = self.graph, self.nx_graph
+        roots = [n for n in nxg.nodes if not nxg.in_degree(n)]
+        for node in list(nxg.nodes):
+            above = ancestors(nxg, node) | {node}
+            expected = min(nx.shortest_path_length(nxg, r, node) for r in roots if r in above)
+            self.assertEqual(g.depth_of([node])[0], expected)
+        self.assertEqual(g.depth_of([999])[0], -1)
+        for group in [[3, 12], [1, 8], [14, 21], [5, 16], [3, 5], [3, 12, 14], [22, 3]]:
+            common = set.intersection(*[ancestors(nxg, n) | {n} for n in group])
+            lowest = {c for c in common if not any(d in descendants(nxg, c) for d in common)}
+            self.assertEqual(set(g.lowest_common_ancestors(group)), lowest)
+        self.assertEqual(CsrGraph.from_edges([1, 3], [2, 4]).lowest_common_ancestors([2, 4]), [])  # separate trees
+
+    def test_connect_roots(self):
+        """Fragments of a set are connected through their lowest common ancestor by shortest paths"""
+        g = self.graph
+        self.assertEqual(g.shortest_path(103, 3), [103, 6, 5, 4, 3])
+        self.assertEqual(g.shortest_path(3, 103), [])
+        roots, common, edges = g.connect_roots([3, 4, 14, 21])
+        self.assertEqual(roots, [4, 14, 21])
+        self.assertEqual(common, [103])
+        self.assertEqual(set(edges), {(103, 6), (6, 5), (5, 4), (103, 15), (15, 14), (103, 20), (20, 16),
+                                      (16, 21)})
+        self.assertEqual(g.connect_roots([4, 3]), ([4], [], []))
+        # Random graphs, one with cycles: paths are shortest, and paths to the roots lead down from the common ancestor
+        rng = np.random.default_rng(0)
+        random_dag = np.sort(rng.integers(0, 100, (200, 2)), axis=1)
+        random_dag = random_dag[random_dag[:, 0] != random_dag[:, 1]].tolist()
+        for edges in [random_dag, random_dag + [(80, 3), (50, 20)]]:
+            nxg = DiGraph(edges)
+            g = CsrGraph.from_edges([e[0] for e in edges], [e[1] for e in edges])
+            for top, bottom in rng.choice(list(nxg.nodes), (200, 2)).tolist():
+                path = g.shortest_path(top, bottom)
+                if top == bottom or not nx.has_path(nxg, top, bottom):
+                    self.assertEqual(path, [top] if top == bottom else [])
+                    continue
+                self.assertEqual(len(path) - 1, nx.shortest_path_length(nxg, top, bottom))
+                self.assertTrue(all(nxg.has_edge(*edge) for edge in zip(path, path[1:])))
+            members = rng.choice(list(nxg.nodes), 12, replace=False).tolist()
+            roots, common, path_edges = g.connect_roots(members)
+            common_ancestors = set.intersection(*[ancestors(nxg, n) | {n} for n in roots])
+            self.assertEqual(
+                set(common), {c for c in common_ancestors if not any(d in descendants(nxg, c) for d in common_ancestors)})
+            if common:
+                edge_graph = DiGraph(path_edges)
+                for root in roots:
+                    if root != common[0]:
+                        self.assertEqual(
+                            nx.shortest_path_length(edge_graph, common[0], root),
+                            nx.shortest_path_length(nxg, common[0], root))
+
+    def test_connected_components(self):
+        """Components match networkx's weakly connected components, and concepts in different ones don't connect"""
+        rng = np.random.default_rng(0)
+        for edges in [EDGES, EDGES + [(9, 6)], rng.integers(0, 3000, (2000, 2)).tolist()]:
+            nxg = DiGraph(edges)
+            g = CsrGraph.from_edges([e[0] for e in edges], [e[1] for e in edges])
+            expected = {frozenset(c) for c in nx.weakly_connected_components(nxg)}
+            self.assertEqual({frozenset(ids) for ids in g.components_spanned(g.node_ids).values()}, expected)
+            self.assertEqual(len(g.components), len(expected))
+        g = CsrGraph.from_edges([1, 2, 10], [2, 3, 11])
+        self.assertEqual(g.component_of([3, 11, 999]).tolist(), [0, 1, -1])
+        self.assertEqual(g.components_spanned([1, 3, 11, 999]), {0: [1, 3], 1: [11]})
+        self.assertEqual((g.shortest_path(1, 11), g.lowest_common_ancestors([3, 11])), ([], []))
+        self.assertEqual(g.nodes_between([1, 3, 10])[0].tolist(), [2])
+
+    def test_strong_components(self):
+        """Strongly connected components match networkx's, including self loops and cycles between cycles"""
+        rng = np.random.default_rng(0)
+        looped = [(1, 1), (1, 2), (2, 1), (2, 3)]
+        for edges in [EDGES, EDGES + [(9, 6)], looped, rng.integers(0, 300, (450, 2)).tolist()]:
+            nxg = DiGraph(edges)
+            g = CsrGraph.from_edges([e[0] for e in edges], [e[1] for e in edges])
+            labels = strong_component_labels(g)
+            found = {frozenset(g.node_ids[labels == label].tolist()) for label in np.unique(labels)}
+            self.assertEqual(found, {frozenset(c) for c in nx.strongly_connected_components(nxg)})
+
+    def test_descendant_rollups(self):
+        """Descendants reachable by more than one path are counted once, including across and within cycles"""
+        rng = np.random.default_rng(0)
+        for edges in [EDGES, EDGES + [(9, 6)], rng.integers(0, 300, (450, 2)).tolist()]:
+            nxg = DiGraph(edges)
+            g = CsrGraph.from_edges([e[0] for e in edges], [e[1] for e in edges])
+            total_cnt = {concept_id: concept_id * 10 for concept_id in g.nodes}
+            rollups = DescendantRollups.build(g, np.array([total_cnt[c] for c in g.nodes]))
+            result = rollups.lookup(g, list(nxg.nodes) + [999])
+            for concept_id in nxg.nodes:
+                below = descendants(nxg, concept_id)
+                self.assertEqual(result['descendant_count'][concept_id], len(below))
+                expected_total = total_cnt[concept_id] + sum(total_cnt[c] for c in below)
+                self.assertEqual(result['total_cnt'][concept_id], expected_total)
+            self.assertNotIn(999, result['total_cnt'])
+        self.assertIsNone(self.graph.rollups)  # computed with concept attributes, not on demand
+
+
+class TestGraphSnapshot(unittest.TestCase):
+    """Tests for the mmap-able graph snapshot format"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'graph.csr')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_round_trip(self):
+        """A graph saved and re-opened should be identical, and its arrays should be read-only views of the file"""
+        g = CsrGraph.from_edges([e[0] for e in EDGES], [e[1] for e in EDGES])
+        save_graph_snapshot(g, self.path, {'vocab_last_refreshed': '2024-11-18T00:00:00+00:00'})
+        g2 = load_graph_snapshot(self.path)
+        for name, arr in g.arrays().items():
+            self.assertEqual(g2.arrays()[name].dtype, arr.dtype)
+            np.testing.assert_array_equal(g2.arrays()[name], arr)
+            self.assertFalse(g2.arrays()[name].flags.writeable)
+        self.assertEqual(set(g2.edges), set(EDGES))
+        self.assertEqual(read_snapshot_meta(self.path)['n_edges'], len(EDGES))
+        self.assertEqual(g2.meta['vocab_last_refreshed'], '2024-11-18T00:00:00+00:00')
+        self.assertIsNone(g2._reachability)  # not built before saving, so built on first use
+        self.assertTrue(g2.is_descendant([(8, 100)])[0])
+        # No temp files left behind
+        self.assertEqual(os.listdir(self.tmpdir.name), ['graph.csr'])
+
+    def test_indexes_saved(self):
+        """Indexes built before saving are loaded with the snapshot, not rebuilt"""
+        g = CsrGraph.from_edges([e[0] for e in EDGES], [e[1] for e in EDGES])
+        g.build_indexes()
+        save_graph_snapshot(g, self.path)
+        g2 = load_graph_snapshot(self.path)
+        self.assertIsNotNone(g2._reachability)
+        np.testing.assert_array_equal(g2.reachability.pre, g.reachability.pre)
+        self.assertFalse(g2.reachability.pre.flags.writeable)
+        np.testing.assert_array_equal(g2._components.component, g.components.component)
+        self.assertIsNone(g2.rollups)
+        g.rollups = DescendantRollups.build(g)
+        save_graph_snapshot(g, self.path)
+        g2 = load_graph_snapshot(self.path)
+        np.testing.assert_array_equal(g2.rollups.descendant_count, g.rollups.descendant_count)
+
+    def test_empty_and_multidimensional_arrays(self):
+        """Edge cases for the array layout"""
+        write_snapshot(self.path, {'empty': np.empty(0, dtype=np.int32), 'grid': np.arange(6).reshape(2, 3)})
+        arrays, meta = read_snapshot(self.path)
+        self.assertEqual(len(arrays['empty']), 0)
+        np.testing.assert_array_equal(arrays['grid'], np.arange(6).reshape(2, 3))
+        self.assertEqual(meta, {})
+
+    def test_bad_file(self):
+        """Non-snapshot files are rejected"""
+        with open(self.path, 'wb') as f:
+            f.write(b'not a snapshot at all, just some bytes')
+        with self.assertRaises(SnapshotFormatError):
+            read_snapshot(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
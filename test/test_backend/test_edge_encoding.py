@@ -0,0 +1,64 @@
+"""Tests for the binary edge encoding
+
+How to run:
+    python -m unittest test.test_backend.test_edge_encoding
+"""
+import os
+import sys
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.edge_encoding import EDGES_MEDIA_TYPE, EdgeEncodingError, accepts_binary_edges, decode_response, \
+    decode_varints, encode_response, encode_varints
+
+
+class TestEdgeEncoding(unittest.TestCase):
+    """Tests for edge_encoding"""
+
+    def test_varints(self):
+        """Round trip at every byte length boundary"""
+        values = np.array([0, 1, 127, 128, 16383, 16384, 2 ** 35, 2 ** 63, 2 ** 64 - 1], dtype=np.uint64)
+        encoded = encode_varints(values)
+        self.assertEqual(encoded[:4].tolist(), [0, 1, 127, 0x80])
+        self.assertEqual(len(encoded), 1 + 1 + 1 + 2 + 2 + 3 + 6 + 10 + 10)
+        np.testing.assert_array_equal(decode_varints(encoded), values)
+        with self.assertRaises(EdgeEncodingError):
+            decode_varints(encoded[:-1])
+
+    def test_round_trip(self):
+        """Edges come back sorted by source then target, with the rest of the response"""
+        sources = [40000001, 1, 40000001, 1, 1738170]
+        targets = [40000000, 45766164, 3, 2, 1738171]
+        rest = {'concept_ids': {1, 2, 3}, 'descendants_truncated': False}
+        s, t, rest2 = decode_response(encode_response(np.array(sources), np.array(targets), rest))
+        self.assertEqual(list(zip(s.tolist(), t.tolist())), sorted(zip(sources, targets)))
+        self.assertEqual(rest2, {'concept_ids': [1, 2, 3], 'descendants_truncated': False})
+        s, t, rest2 = decode_response(encode_response(np.array([], dtype=int), np.array([], dtype=int)), False)
+        self.assertEqual((len(s), len(t), rest2), (0, 0, None))
+        with self.assertRaises(EdgeEncodingError):
+            decode_response(b'[[1, 2]]')
+
+    def test_smaller_than_json(self):
+        """Typical concept ids take a few bytes per edge instead of ~20"""
+        rng = np.random.default_rng(0)
+        sources = rng.integers(1_000_000, 45_000_000, 10_000)
+        data = encode_response(sources, sources + rng.integers(1, 1000, 10_000))
+        self.assertLess(len(data), 10_000 * 8)
+
+    def test_accept_header(self):
+        """Binary only when it's asked for, and preferred over anything else asked for"""
+        self.assertFalse(accepts_binary_edges(None))
+        self.assertFalse(accepts_binary_edges('*/*'))
+        self.assertTrue(accepts_binary_edges(EDGES_MEDIA_TYPE))
+        self.assertTrue(accepts_binary_edges(f'{EDGES_MEDIA_TYPE}, application/json;q=0.9'))
+        self.assertFalse(accepts_binary_edges(f'application/json, {EDGES_MEDIA_TYPE};q=0.5'))
+        self.assertFalse(accepts_binary_edges(f'{EDGES_MEDIA_TYPE};q=0'))
+
+
+if __name__ == '__main__':
+    unittest.main()
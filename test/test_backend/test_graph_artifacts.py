@@ -0,0 +1,123 @@
+"""Tests for the precompressed /wholegraph artifacts
+
+How to run:
+    python -m unittest test.test_backend.test_graph_artifacts
+"""
+import asyncio
+import gzip
+import json
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from typing import Dict
+
+from fastapi import HTTPException, Request, Response
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.csr_graph import CsrGraph
+from backend.edge_encoding import decode_response
+from backend.graph_artifacts import artifact_response, artifact_version, build_wholegraph_artifacts, choose_encoding, \
+    parse_range, zstandard
+
+
+def make_request(headers: Dict[str, str]) -> Request:
+    """Request with just these headers"""
+    return Request({'type': 'http', 'headers': [(k.lower().encode(), v.encode()) for k, v in headers.items()]})
+
+
+def body_of(response: Response) -> bytes:
+    """Whole body of a response, streaming or not"""
+    if not hasattr(response, 'body_iterator'):
+        return response.body
+
+    async def collect():
+        return b''.join([chunk async for chunk in response.body_iterator])
+    return asyncio.run(collect())
+
+
+class TestGraphArtifacts(unittest.TestCase):
+    """Tests for graph_artifacts"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.graph = CsrGraph.from_edges([1, 1, 2], [2, 3, 3])
+        self.graph.meta = {'vocab_last_refreshed': '2024-11-18T00:00:00+00:00'}
+        self.version = artifact_version(self.graph)
+        build_wholegraph_artifacts(self.graph, self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_full_and_not_modified(self):
+        """Full download, then a 304 for the same ETag"""
+        response = artifact_response(make_request({}), self.tmpdir.name, self.version, 'json', 'gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['content-encoding'], 'gzip')
+        body = body_of(response)
+        self.assertEqual(json.loads(gzip.decompress(body)), [[1, 2], [1, 3], [2, 3]])
+        self.assertEqual(int(response.headers['content-length']), len(body))
+        etag = response.headers['etag']
+        response = artifact_response(
+            make_request({'If-None-Match': f'"other", {etag}'}), self.tmpdir.name, self.version, 'json', 'gzip')
+        self.assertEqual(response.status_code, 304)
+        for if_none_match in [f'W/{etag}', f'"other",W/{etag}', '*']:  # weak comparison
+            response = artifact_response(
+                make_request({'If-None-Match': if_none_match}), self.tmpdir.name, self.version, 'json', 'gzip')
+            self.assertEqual(response.status_code, 304)
+        response = artifact_response(
+            make_request({'If-None-Match': 'W/"other"'}), self.tmpdir.name, self.version, 'json', 'gzip')
+        self.assertEqual(response.status_code, 200)
+        binary = artifact_response(make_request({}), self.tmpdir.name, self.version, 'edges', 'gzip')
+        self.assertNotEqual(binary.headers['etag'], etag)
+        sources, targets, _ = decode_response(gzip.decompress(body_of(binary)), has_rest=False)
+        self.assertEqual(list(zip(sources.tolist(), targets.tolist())), [(1, 2), (1, 3), (2, 3)])
+
+    def test_range(self):
+        """A resumed download gets the rest of the same file, unless the version changed"""
+        full = body_of(artifact_response(make_request({}), self.tmpdir.name, self.version, 'json', 'gzip'))
+        etag = artifact_response(make_request({}), self.tmpdir.name, self.version, 'json', 'gzip').headers['etag']
+        response = artifact_response(
+            make_request({'Range': 'bytes=10-', 'If-Range': etag}), self.tmpdir.name, self.version, 'json', 'gzip')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers['content-range'], f'bytes 10-{len(full) - 1}/{len(full)}')
+        self.assertEqual(body_of(response), full[10:])
+        response = artifact_response(
+            make_request({'Range': 'bytes=10-', 'If-Range': '"old"'}), self.tmpdir.name, self.version, 'json', 'gzip')
+        self.assertEqual((response.status_code, body_of(response)), (200, full))
+        self.assertEqual(parse_range('bytes=-5', 100), (95, 99))
+        self.assertEqual(parse_range('bytes=0-1000', 100), (0, 99))
+        self.assertIsNone(parse_range('bytes=0-1,5-6', 100))
+        with self.assertRaises(HTTPException):
+            parse_range('bytes=100-', 100)
+
+    def test_versions(self):
+        """A new version replaces the old one's files"""
+        old_files = set(os.listdir(self.tmpdir.name))
+        self.graph.meta['vocab_last_refreshed'] = '2024-12-01T00:00:00+00:00'
+        build_wholegraph_artifacts(self.graph, self.tmpdir.name)
+        new_files = set(os.listdir(self.tmpdir.name))
+        self.assertEqual(old_files & new_files, {'wholegraph.lock'})
+        with self.assertRaises(FileNotFoundError):
+            artifact_response(make_request({}), self.tmpdir.name, self.version, 'json', 'gzip')
+
+    def test_choose_encoding(self):
+        """Only codings the client accepts"""
+        self.assertEqual(choose_encoding('gzip, deflate, br'), 'gzip')
+        self.assertIsNone(choose_encoding('gzip;q=0, deflate'))
+        self.assertIsNone(choose_encoding(None))
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        """zstd is preferred when the client accepts it"""
+        self.assertEqual(choose_encoding('gzip, zstd'), 'zstd')
+        response = artifact_response(make_request({}), self.tmpdir.name, self.version, 'json', 'zstd')
+        body = zstandard.ZstdDecompressor().decompressobj().decompress(body_of(response))
+        self.assertEqual(json.loads(body), [[1, 2], [1, 3], [2, 3]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+"""Tests for the vocabulary-sharded graph
+
+How to run:
+    python -m unittest test.test_backend.test_graph_shards
+"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.concept_attributes import ConceptAttributes
+from backend.csr_graph import CsrGraph
+from backend.graph_rollups import DescendantRollups
+from backend.graph_shards import CROSS_SHARD, ShardedGraph, manifest_path, shard_path, shard_version, \
+    write_graph_shards
+
+VOCABULARIES = ['SNOMED', 'RxNorm', 'ICD10CM', 'LOINC']
+
+
+def random_graph(seed=0, n_nodes=2000, n_edges=6000) -> CsrGraph:
+    """DAG over concept ids 1..n_nodes, mostly within vocabularies but with some edges between them"""
+    rng = np.random.default_rng(seed)
+    sources = rng.integers(1, n_nodes, n_edges)
+    targets = sources + rng.integers(1, 50, n_edges)
+    keep = targets <= n_nodes
+    g = CsrGraph.from_edges(sources[keep], targets[keep], np.arange(1, n_nodes + 1))
+    # Vocabularies in runs of ids, so most edges stay inside one, and some concepts with no vocabulary
+    vocab = [VOCABULARIES[(i // 300) % len(VOCABULARIES)] if i % 97 else None for i in range(1, n_nodes + 1)]
+    g.attributes = ConceptAttributes.from_records([
+        {'concept_id': i, 'vocabulary_id': v, 'standard_concept': 'S', 'total_cnt': i}
+        for i, v in zip(range(1, n_nodes + 1), vocab)])
+    g.rollups = DescendantRollups.build(g)
+    g.meta = {'created': '2024-11-18T00:00:00+00:00'}
+    return g
+
+
+class TestGraphShards(unittest.TestCase):
+    """Tests for graph_shards"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.graph = random_graph()
+        self.version = write_graph_shards(self.graph, self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_same_as_full_graph(self):
+        """Traversals over shards give the same results as over the full graph"""
+        g = self.graph
+        sharded = ShardedGraph(self.tmpdir.name, self.version)
+        self.assertEqual(sharded.number_of_edges(), g.number_of_edges())
+        self.assertGreater(sharded.manifest[CROSS_SHARD]['edges'], 0)
+        rng = np.random.default_rng(1)
+        for _ in range(20):
+            ids = rng.choice(g.node_ids, 5, replace=False)
+            for reverse in (False, True):
+                expected, expected_depths, _ = g.traverse(ids, max_depth=6, reverse=reverse)
+                got, depths, _ = sharded.traverse(ids, max_depth=6, reverse=reverse)
+                self.assertEqual(dict(zip(got.tolist(), depths.tolist())),
+                                 dict(zip(expected.tolist(), expected_depths.tolist())))
+            self.assertEqual(set(sharded.subgraph(ids).edges), set(g.subgraph(ids).edges))
+            self.assertEqual(sharded.nodes_between(ids, 6)[0].tolist(), g.nodes_between(ids, 6)[0].tolist())
+            self.assertEqual(sharded.successors(int(ids[0])), g.successors(int(ids[0])))
+            self.assertEqual(sharded.predecessors(int(ids[0])), g.predecessors(int(ids[0])))
+            self.assertEqual(sharded.ancestors_within(ids), g.ancestors_within(ids))
+            self.assertEqual(sharded.lowest_common_ancestors(ids[:2]), g.lowest_common_ancestors(ids[:2]))
+            self.assertEqual(sharded.connect_roots(ids), g.connect_roots(ids))
+            pairs = rng.choice(g.node_ids, (50, 2))
+            np.testing.assert_array_equal(sharded.is_descendant(pairs), g.is_descendant(pairs))
+        self.assertEqual(sharded.shortest_path(1, 200), g.shortest_path(1, 200))
+        self.assertEqual(sharded.edges, g.edges)  # put together from the shards
+        self.assertEqual(sharded.in_degree(), g.in_degree())
+        self.assertEqual(sharded.rollups.lookup(sharded, [1, 5, 200]), g.rollups.lookup(g, [1, 5, 200]))
+        self.assertEqual(sharded.meta, g.meta)
+
+    def test_no_full_snapshot(self):
+        """Only the manifest and shards are opened: the full graph's CSR arrays aren't there to map"""
+        sharded = ShardedGraph(self.tmpdir.name, self.version)
+        with self.assertRaises(AttributeError):
+            _ = sharded.fwd_targets
+        self.assertEqual(
+            sorted(os.listdir(self.tmpdir.name)),
+            sorted([os.path.basename(manifest_path(self.tmpdir.name, self.version))] +
+                   [os.path.basename(shard_path(self.tmpdir.name, self.version, s)) for s in sharded.manifest]))
+
+    def test_lazy_loading_and_eviction(self):
+        """Shards are mapped on first use, and least recently used unpinned ones are unmapped over budget"""
+        sharded = ShardedGraph(self.tmpdir.name, self.version, budget_bytes=0, pinned_vocabularies=['SNOMED'])
+        snomed = next(s for s, info in sharded.manifest.items() if info['vocabulary'] == 'SNOMED')
+        self.assertEqual(sharded.stats()['mapped'], sorted([CROSS_SHARD, snomed]))
+        sharded.descendants_of([601])  # ICD10CM, plus whatever it reaches
+        stats = sharded.stats()
+        self.assertGreater(stats['loads'], 2)
+        self.assertIn(snomed, stats['mapped'])
+        self.assertIn(CROSS_SHARD, stats['mapped'])
+        self.assertLessEqual(len(stats['mapped']), 3)  # pinned ones, plus the one used last
+        self.assertGreater(stats['evictions'], 0)
+
+        # With room for the pinned shards and one more, the mapped shards stay within the budget
+        pinned_bytes = sum(sharded.manifest[s]['nbytes'] for s in (CROSS_SHARD, snomed))
+        budget = pinned_bytes + max(info['nbytes'] for info in sharded.manifest.values())
+        sharded = ShardedGraph(self.tmpdir.name, self.version, budget_bytes=budget, pinned_vocabularies=['SNOMED'])
+        rng = np.random.default_rng(2)
+        for _ in range(20):
+            sharded.descendants_of(rng.choice(self.graph.node_ids, 3), max_depth=3)
+            self.assertLessEqual(sharded.mapped_bytes(), budget)
+            self.assertEqual(
+                sharded.mapped_bytes(), sum(sharded.manifest[s]['nbytes'] for s in sharded.stats()['mapped']))
+
+    def test_versions(self):
+        """Shards are rewritten for a new graph version, keeping the previous version"""
+        versions = [set(os.listdir(self.tmpdir.name))]
+        for created in ('2024-12-01T00:00:00+00:00', '2025-01-01T00:00:00+00:00'):
+            time.sleep(0.01)  # so the versions' modification times differ
+            self.graph.meta['created'] = created
+            write_graph_shards(self.graph, self.tmpdir.name)
+            versions.append(set(os.listdir(self.tmpdir.name)) - set.union(*versions))
+        files = set(os.listdir(self.tmpdir.name))
+        self.assertFalse(versions[0] & files)
+        self.assertTrue(versions[1] <= files and versions[2] <= files)
+        self.assertEqual(len(ShardedGraph(self.tmpdir.name, shard_version(self.graph)).traverse([1])[0]),
+                         len(self.graph.traverse([1])[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
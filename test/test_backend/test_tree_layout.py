@@ -0,0 +1,65 @@
+"""Tests for the indented tree layout
+
+How to run:
+    python -m unittest test.test_backend.test_tree_layout
+"""
+import os
+import sys
+import unittest
+from pathlib import Path
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.tree_layout import IndentedTree
+
+#   1           9 (no edges)
+#  / \
+# 2   3
+# |\ /
+# 4 5
+#   |
+#   6
+EDGES = [(1, 2), (1, 3), (2, 4), (2, 5), (3, 5), (5, 6)]
+
+
+def collapsed(tree: IndentedTree, budget: int):
+    """collapse_points() as lists"""
+    rows, visible_rows = tree.collapse_points(budget)
+    return [rows.tolist(), visible_rows]
+
+
+class TestTreeLayout(unittest.TestCase):
+    """Tests for tree_layout"""
+
+    def test_rows(self):
+        """Depth-first, siblings biggest first, shared subtrees repeated under each parent"""
+        tree = IndentedTree.build(EDGES, [1, 9], sort_key={5: 1})
+        layout = tree.to_json([])
+        self.assertEqual(layout['columns'], ['concept_id', 'depth', 'subtree_rows'])
+        self.assertEqual(layout['rows'], [
+            [1, 0, 7], [2, 1, 3], [5, 2, 1], [6, 3, 0], [4, 2, 0], [3, 1, 2], [5, 2, 1], [6, 3, 0], [9, 0, 0]])
+        self.assertFalse(layout['truncated'])
+        truncated = IndentedTree.build(EDGES, [1, 9], max_rows=4)
+        self.assertEqual((len(truncated), truncated.truncated), (4, True))
+
+    def test_cycles(self):
+        """Cycles aren't followed, and parts only reachable from one still get rows"""
+        tree = IndentedTree.build([(1, 2), (2, 1), (2, 3), (4, 5)], [])
+        self.assertEqual(tree.to_json([])['rows'], [[4, 0, 1], [5, 1, 0], [1, 0, 2], [2, 1, 1], [3, 2, 0]])
+
+    def test_collapse_points(self):
+        """Expanded breadth-first while children fit in the budget"""
+        tree = IndentedTree.build(EDGES, [1, 9])
+        # rows: 1, 2, 4, 5, 6, 3, 5, 6, 9
+        self.assertEqual(collapsed(tree, 2), [[0], 2])  # just the roots
+        self.assertEqual(collapsed(tree, 4), [[1, 5], 4])  # 1 expanded, 2 and 3 not
+        self.assertEqual(collapsed(tree, 6), [[3, 5], 6])  # 2 expanded, then 3 doesn't fit
+        self.assertEqual(collapsed(tree, 9), [[], 9])
+        buckets = tree.to_json([9, 4, 4])['buckets']
+        self.assertEqual(buckets, [
+            {'budget': 4, 'collapsed': [1, 5], 'visible_rows': 4}, {'budget': 9, 'collapsed': [], 'visible_rows': 9}])
+
+
+if __name__ == '__main__':
+    unittest.main()
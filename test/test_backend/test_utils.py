@@ -0,0 +1,51 @@
+"""Tests for backend utilities
+
+How to run:
+    python -m unittest test.test_backend.test_utils
+"""
+import os
+import sys
+import unittest
+from pathlib import Path
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.utils import LruCache
+
+
+class TestLruCache(unittest.TestCase):
+    """Tests for LruCache"""
+
+    def test_lru_eviction(self):
+        """Least recently used entries are evicted first, by count and by cost"""
+        cache = LruCache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)  # 'b' is now least recently used
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+
+        cache = LruCache(max_entries=10, max_cost=5, cost=len)
+        cache.put('a', [1, 2])
+        cache.put('b', [1, 2])
+        cache.put('c', [1, 2])
+        self.assertEqual([cache.get(k) is not None for k in 'abc'], [False, True, True])
+        cache.put('d', list(range(6)))  # too big to cache at all
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(cache.stats()['cost'], 4)
+
+    def test_generation(self):
+        """A new generation empties the cache"""
+        cache = LruCache()
+        cache.put('a', 1, generation=('2024-11-18', 'v1'))
+        self.assertEqual(cache.get('a', generation=('2024-11-18', 'v1')), 1)
+        self.assertIsNone(cache.get('a', generation=('2024-11-19', 'v1')))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['invalidations'], stats['entries']), (1, 1, 1, 0))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()